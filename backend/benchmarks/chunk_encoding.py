@@ -0,0 +1,87 @@
+"""Encoding cost per chunk of the `/query` stream: `jsonable_encoder` + `json.dumps` (before) vs. `model_dump_json` and the content-only fast path (after).
+
+Usage (requires the usual environment, e.g., SECRET_KEY):
+
+    python benchmarks/chunk_encoding.py [--number 100000]
+"""
+
+import argparse
+import json
+import timeit
+import uuid
+from datetime import datetime, timezone
+
+
+def main(args):
+    from fastapi.encoders import jsonable_encoder
+
+    from marcel.models import SourceRead
+    from marcel.routes import (
+        ChatResponseChunk,
+        MessageRead,
+        encode_chunk,
+        encode_content,
+    )
+
+    def encode_chunk_before(chunk):
+        return json.dumps(jsonable_encoder(chunk, exclude_unset=True)) + "\n"
+
+    message = MessageRead(
+        id=1,
+        role="assistant",
+        content="The application deadline is July 15. " * 20,
+        non_answer=False,
+        feedback=None,
+        created_at=datetime.now(timezone.utc),
+        sources=[
+            SourceRead(url=f"example.com/{i}", score=1.0, title="Example", favicon="")
+            for i in range(5)
+        ],
+    )
+    token = " deadline"
+    cases = {
+        "content chunk": {
+            "before": lambda: encode_chunk_before(ChatResponseChunk(content=token)),
+            "model_dump_json": lambda: encode_chunk(ChatResponseChunk(content=token)),
+            "fast path": lambda: encode_content(token),
+        },
+        "final chunk": {
+            "before": lambda: encode_chunk_before(
+                ChatResponseChunk(
+                    conversation_id=uuid.uuid4(),
+                    user_message=message,
+                    assistant_message=message,
+                )
+            ),
+            "model_dump_json": lambda: encode_chunk(
+                ChatResponseChunk(
+                    conversation_id=uuid.uuid4(),
+                    user_message=message,
+                    assistant_message=message,
+                )
+            ),
+        },
+    }
+
+    print(f"{'chunk':<14} {'encoder':<16} {'µs/chunk':>9} {'speedup':>8}")
+    for case, encoders in cases.items():
+        baseline = None
+        for name, encode in encoders.items():
+            number = args.number if case == "content chunk" else args.number // 10
+            seconds = min(timeit.repeat(encode, number=number, repeat=args.repeat))
+            per_chunk = seconds / number * 1e6
+            baseline = baseline or per_chunk
+            print(
+                f"{case:<14} {name:<16} {per_chunk:>9.2f} {baseline / per_chunk:>7.1f}x"
+            )
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_arguments())
@@ -0,0 +1,139 @@
+"""Per-worker memory of the corpus and BM25 index, in-memory vs. memory-mapped.
+
+Starts `--workers` processes (like uvicorn workers) which each load the knowledge base and run a few BM25 queries, and reports their memory once all of them are loaded:
+
+- RSS: resident memory, counting shared pages in every worker
+- PSS: shared pages divided among the processes which map them (sums up to the actual usage)
+- USS: memory private to the worker
+
+Usage (Linux only, reads /proc/self/smaps_rollup):
+
+    python benchmarks/memory_report.py --data ../data/knowledgebase.jsonl --workers 4 [--model]
+"""
+
+import argparse
+import multiprocessing
+import tempfile
+from pathlib import Path
+
+QUERIES = [
+    "What are the admission requirements?",
+    "When is the application deadline?",
+    "Which documents do I need for the enrolment?",
+]
+
+
+def memory_usage():
+    """RSS, PSS and USS of the current process in MiB."""
+    fields = {}
+    with open("/proc/self/smaps_rollup") as fin:
+        for line in fin:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                fields[parts[0].rstrip(":")] = int(parts[1]) / 1024
+    uss = fields["Private_Clean"] + fields["Private_Dirty"]
+    return {"rss": fields["Rss"], "pss": fields["Pss"], "uss": uss}
+
+
+def worker(mode, data_path, index_path, with_model, barrier, results):
+    from haystack import Document
+    from haystack.components.retrievers.in_memory import InMemoryBM25Retriever
+
+    from marcel.experiments import bm25_index, data_loader
+    from marcel.experiments.bm25_index import MmapBM25Retriever, MmapCorpus
+    from marcel.experiments.components import VersionedInMemoryDocumentStore
+    from marcel.experiments.faq_retriever import ParentDocumentRetriever
+
+    before = memory_usage()
+
+    if mode == "in-memory":
+        documents = data_loader.load_documents(data_path)
+        document_store = VersionedInMemoryDocumentStore()
+        document_store.write_documents(documents)
+        retriever = InMemoryBM25Retriever(document_store, top_k=5, scale_score=True)
+    else:
+        documents = MmapCorpus.open(index_path, bm25_index.file_checksum(data_path))
+        retriever = MmapBM25Retriever(documents, top_k=5, scale_score=True)
+    parent_retriever = ParentDocumentRetriever(documents)
+
+    if with_model:
+        from haystack.components.embedders import SentenceTransformersTextEmbedder
+
+        embedder = SentenceTransformersTextEmbedder(
+            model="all-MiniLM-L6-v2", progress_bar=False, local_files_only=True
+        )
+        embedder.warm_up()
+        embedder.run(text=QUERIES[0])
+
+    for query in QUERIES:
+        retrieved = retriever.run(query=query)["documents"]
+        parent_retriever.run(
+            [Document(content="", meta={"parent_id": doc.id}) for doc in retrieved]
+        )
+
+    # Measure once all workers are loaded, so that PSS reflects the sharing between them
+    barrier.wait()
+    results.put({"before": before, "after": memory_usage()})
+    barrier.wait()
+
+
+def run(mode, data_path, index_path, workers, with_model):
+    ctx = multiprocessing.get_context("spawn")
+    barrier = ctx.Barrier(workers)
+    results = ctx.Queue()
+    processes = [
+        ctx.Process(
+            target=worker,
+            args=(mode, data_path, index_path, with_model, barrier, results),
+        )
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    reports = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return reports
+
+
+def main(args):
+    from marcel.experiments import bm25_index, data_loader
+
+    with tempfile.TemporaryDirectory() as index_path:
+        bm25_index.build(
+            data_loader.load_documents(args.data),
+            Path(index_path),
+            bm25_index.file_checksum(args.data),
+        )
+
+        print("Memory in MiB (before loading -> after loading)")
+        print(f"{'mode':<10} {'worker':>6} | {'RSS':^16} {'PSS':^16} {'USS':^16}")
+        for mode in ["in-memory", "mmap"]:
+            reports = run(mode, args.data, index_path, args.workers, args.model)
+            for i, report in enumerate(reports):
+                before, after = report["before"], report["after"]
+                print(
+                    f"{mode:<10} {i:>6} | "
+                    + " ".join(
+                        f"{before[key]:>6.1f} -> {after[key]:>6.1f}"
+                        for key in ["rss", "pss", "uss"]
+                    )
+                )
+            total_pss = sum(report["after"]["pss"] for report in reports)
+            print(f"{mode:<10} {'total':>6} | PSS {total_pss:.1f} MiB\n")
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data", required=True, help="Knowledge base (JSONL)")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument(
+        "--model",
+        action="store_true",
+        help="Also load the embedding model in each worker (not shared between workers)",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_arguments())
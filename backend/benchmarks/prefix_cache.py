@@ -0,0 +1,206 @@
+"""Prefix overlap of LLM requests with the default and the prefix-cache prompt layout.
+
+Starts a local stand-in for the OpenAI-compatible LLM server, which answers with a fixed text and simulates prefix caching like vLLM: prompts are tokenized and split into blocks of `--block-size` tokens, and a block is a cache hit if the same block with the same prefix was seen before. The benchmark runs simulated conversations (FAQ questions as user messages) through the HybridPipeline with both layouts and reports the share of prompt tokens which could be served from the cache.
+
+Usage (requires the usual environment, e.g., SECRET_KEY; LLM settings are overridden):
+
+    python benchmarks/prefix_cache.py --data ../data/knowledgebase.jsonl --faqs ../data/faq.json [--users 20 --turns 4]
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import socket
+import threading
+import time
+
+ANSWER = "Thank you for your question. Please find the details on the website [1]."
+
+
+class PrefixCache:
+    """Block-level prefix cache. A block is identified by its tokens and all tokens before it."""
+
+    def __init__(self, block_size: int):
+        self.block_size = block_size
+        self.blocks = set()
+
+    def lookup_and_insert(self, tokens) -> int:
+        """Number of leading tokens which were cached. Inserts all full blocks of the prompt."""
+        cached = 0
+        prefix_hash = b""
+        hit = True
+        for start in range(0, len(tokens) - self.block_size + 1, self.block_size):
+            block = tokens[start : start + self.block_size]
+            prefix_hash = hashlib.sha256(
+                prefix_hash + json.dumps(block).encode()
+            ).digest()
+            if hit and prefix_hash in self.blocks:
+                cached += self.block_size
+            else:
+                hit = False
+                self.blocks.add(prefix_hash)
+        return cached
+
+
+class StandInServer:
+    """OpenAI-compatible chat completions which records the prefix cache hits of streamed (answer) requests."""
+
+    def __init__(self, tokenizer, block_size: int):
+        from fastapi import FastAPI, Request
+        from fastapi.responses import StreamingResponse
+
+        self.tokenizer = tokenizer
+        self.block_size = block_size
+        self.reset()
+        self.app = FastAPI()
+
+        @self.app.post("/v1/chat/completions")
+        async def completions(request: Request):
+            body = await request.json()
+            if not body.get("stream"):
+                # The retrieval classifier
+                return completion_response(body["model"], "YES")
+
+            prompt = "".join(
+                f"<|{message['role']}|>\n{message['content']}\n"
+                for message in body["messages"]
+            )
+            tokens = self.tokenizer(prompt, add_special_tokens=False, verbose=False)[
+                "input_ids"
+            ]
+            self.prompt_tokens += len(tokens)
+            self.cached_tokens += self.cache.lookup_and_insert(tokens)
+            self.requests += 1
+            return StreamingResponse(
+                stream_response(body["model"], ANSWER),
+                media_type="text/event-stream",
+            )
+
+    def reset(self):
+        self.cache = PrefixCache(self.block_size)
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+
+    def start(self) -> str:
+        import uvicorn
+
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        server = uvicorn.Server(
+            uvicorn.Config(self.app, host="127.0.0.1", port=port, log_level="warning")
+        )
+        threading.Thread(target=server.run, daemon=True).start()
+        while not server.started:
+            time.sleep(0.05)
+        return f"http://127.0.0.1:{port}/v1"
+
+
+def completion_response(model: str, content: str):
+    return {
+        "id": "chatcmpl-0",
+        "object": "chat.completion",
+        "created": 0,
+        "model": model,
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }
+        ],
+    }
+
+
+async def stream_response(model: str, content: str):
+    for i, word in enumerate(content.split(" ")):
+        delta = {"content": word if i == 0 else f" {word}"}
+        chunk = {
+            "id": "chatcmpl-0",
+            "object": "chat.completion.chunk",
+            "created": 0,
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": None}],
+        }
+        yield f"data: {json.dumps(chunk)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+async def run_conversations(pipeline, conversations):
+    """Run the conversations turn by turn, interleaving the users like concurrent traffic."""
+    from marcel.routes import ChatMessage
+
+    histories = [[] for _ in conversations]
+    for turn in range(max(len(c) for c in conversations)):
+        for conversation, history in zip(conversations, histories):
+            if turn >= len(conversation):
+                continue
+            query = conversation[turn]
+            result = await pipeline.run_async(query, history)
+            answer = "".join([chunk async for chunk in result["generated_answer"]])
+            history += [
+                ChatMessage(role="user", content=query),
+                ChatMessage(role="assistant", content=answer),
+            ]
+
+
+def main(args):
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer, local_files_only=True)
+    server = StandInServer(tokenizer, args.block_size)
+    os.environ["LLM_BASE_URL"] = server.start()
+    os.environ["LLM_API_KEY"] = "stand-in"
+    os.environ["MODEL_NAME"] = "stand-in"
+
+    from marcel.experiments import data_loader
+    from marcel.experiments.hybrid_pipeline import PROMPT_LAYOUTS, HybridPipeline
+
+    documents = data_loader.load_documents(args.data)
+    faqs = data_loader.load_faqs(args.faqs)
+    questions = [faq.content for faq in faqs]
+    rng = random.Random(args.seed)
+    conversations = [
+        rng.sample(questions, min(args.turns, len(questions)))
+        for _ in range(args.users)
+    ]
+
+    print(
+        f"{args.users} conversations with {args.turns} turns, blocks of {args.block_size} tokens"
+    )
+    print(f"{'layout':<14} {'requests':>8} {'prompt tokens':>14} {'cached':>10}")
+    for layout in PROMPT_LAYOUTS:
+        pipeline = HybridPipeline(
+            documents, faqs, prompt_layout=layout, retrieval_cache_size=0
+        )
+        server.reset()
+        asyncio.run(run_conversations(pipeline, conversations))
+        pipeline.close()
+        print(
+            f"{layout:<14} {server.requests:>8} {server.prompt_tokens:>14} "
+            f"{server.cached_tokens / server.prompt_tokens:>10.1%}"
+        )
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data", required=True, help="Knowledge base (JSONL)")
+    parser.add_argument("--faqs", required=True, help="FAQs (JSON)")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=4)
+    parser.add_argument("--block-size", type=int, default=16)
+    parser.add_argument(
+        "--tokenizer",
+        default="sentence-transformers/all-MiniLM-L6-v2",
+        help="Approximates the tokenizer of the LLM",
+    )
+    parser.add_argument("--seed", type=int, default=42)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_arguments())
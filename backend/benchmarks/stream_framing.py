@@ -0,0 +1,186 @@
+"""CPU time and socket writes per streamed answer of `/query`, with and without frames.
+
+Runs the app in-process against a stand-in pipeline which streams `--tokens` tokens `--token-delay` seconds apart, with `--concurrency` answers at a time. The app is called through ASGI directly: every `http.response.body` message is one write (and usually one `send` syscall) of the ASGI server, so the benchmark counts those. CPU time is the process time of the run (app and SQLite) divided by the number of answers, without the CPU time of the stand-in pipeline, which is measured separately.
+
+Usage (requires the usual environment, e.g., SECRET_KEY; the database is a temporary SQLite file):
+
+    python benchmarks/stream_framing.py [--answers 200 --concurrency 50 --tokens 300 --intervals 0 0.02 0.05]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+import uuid
+
+
+class StandInPipeline:
+    def __init__(self, tokens: int, token_delay: float):
+        self.tokens = tokens
+        self.token_delay = token_delay
+
+    async def run_async(self, query, history):
+        async def chunk_generator():
+            for i in range(self.tokens):
+                await asyncio.sleep(self.token_delay)
+                yield f" token{i % 10}"
+
+        return {
+            "generated_answer": chunk_generator(),
+            "documents": [],
+            "answer_strategy": "retrieve",
+            "prompt_tokens": None,
+        }
+
+
+async def post_query(app) -> int:
+    """Send a query and return the number of body writes of the response."""
+    body = json.dumps({"messages": [{"role": "user", "content": "Hello"}]}).encode()
+    requests = [{"type": "http.request", "body": body, "more_body": False}]
+    disconnected = asyncio.Event()
+    writes = 0
+
+    async def receive():
+        if requests:
+            return requests.pop()
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal writes
+        if message["type"] == "http.response.body" and message.get("body"):
+            writes += 1
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/query",
+        "raw_path": b"/query",
+        "root_path": "",
+        "query_string": b"",
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"cookie", f"user_id={uuid.uuid4()}".encode()),
+        ],
+        "client": ("127.0.0.1", 12345),
+        "server": ("127.0.0.1", 9000),
+    }
+    await app(scope, receive, send)
+    disconnected.set()
+    return writes
+
+
+async def consume(pipeline: StandInPipeline, answers: int, concurrency: int):
+    """Consume the answers of the stand-in pipeline without the app."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            result = await pipeline.run_async("Hello", [])
+            async for _ in result["generated_answer"]:
+                pass
+
+    await asyncio.gather(*[one() for _ in range(answers)])
+
+
+async def run(app, answers: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            return await post_query(app)
+
+    return await asyncio.gather(*[one() for _ in range(answers)])
+
+
+def main(args):
+    os.environ["DATABASE_URI"] = (
+        f"sqlite:///{tempfile.mkdtemp(prefix='marcel-framing-')}/database.db"
+    )
+    from contextlib import asynccontextmanager
+
+    from asgi_lifespan import LifespanManager
+
+    from marcel import routes
+    from marcel.app import build_app
+    from marcel.chat_log import ChatLogWriter
+    from marcel.database import AsyncSessionLocal, engine, upgrade_schema
+    from marcel.pipeline_state import PipelineState
+
+    upgrade_schema(engine)
+    pipeline = StandInPipeline(args.tokens, args.token_delay)
+
+    @asynccontextmanager
+    async def lifespan(app):
+        log_writer = ChatLogWriter(AsyncSessionLocal)
+        log_writer.start()
+        yield {"pipeline_state": PipelineState(pipeline), "log_writer": log_writer}
+        await log_writer.close()
+
+    app = build_app(lifespan)
+
+    async def benchmark(interval: float):
+        routes.STREAM_FRAME_INTERVAL = interval
+        routes.STREAM_FRAME_MAX_BYTES = args.max_bytes
+        async with LifespanManager(app) as manager:
+            await run(manager.app, min(args.concurrency, 10), args.concurrency)
+            cpu_start, wall_start = time.process_time(), time.perf_counter()
+            writes = await run(manager.app, args.answers, args.concurrency)
+            cpu = time.process_time() - cpu_start
+            wall = time.perf_counter() - wall_start
+        return cpu, wall, writes
+
+    async def baseline():
+        cpu_start = time.process_time()
+        await consume(pipeline, args.answers, args.concurrency)
+        return time.process_time() - cpu_start
+
+    async def benchmark_all():
+        # One event loop for all runs, the database connections are bound to it
+        return await baseline(), [
+            await benchmark(interval) for interval in args.intervals
+        ]
+
+    print(
+        f"{args.answers} answers of {args.tokens} tokens ({args.token_delay * 1000:.0f}ms apart), "
+        f"{args.concurrency} concurrent, frames of at most {args.max_bytes} bytes"
+    )
+    baseline_cpu, results = asyncio.run(benchmark_all())
+    print(
+        f"CPU of the stand-in pipeline alone: {baseline_cpu / args.answers * 1000:.2f} ms/answer "
+        "(subtracted from the app CPU)"
+    )
+    print(
+        f"{'interval':>9} {'app CPU ms/answer':>18} {'writes/answer':>14} {'wall s':>8}"
+    )
+    for interval, (cpu, wall, writes) in zip(args.intervals, results):
+        print(
+            f"{interval * 1000:>7.0f}ms {(cpu - baseline_cpu) / args.answers * 1000:>18.2f} "
+            f"{sum(writes) / len(writes):>14.1f} {wall:>8.1f}"
+        )
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--answers", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--tokens", type=int, default=300)
+    parser.add_argument("--token-delay", type=float, default=0.01)
+    parser.add_argument("--max-bytes", type=int, default=512)
+    parser.add_argument(
+        "--intervals",
+        type=float,
+        nargs="+",
+        default=[0, 0.02, 0.05],
+        help="Frame intervals in seconds (0: one write per token)",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_arguments())
@@ -0,0 +1,98 @@
+"""Latency of resolving the user of a request (`user_id` cookie) with many users: the former select-then-insert on an unindexed `client_id` (before), with the unique index, and from the per-worker cache (after).
+
+Usage (requires the usual environment, e.g., SECRET_KEY; the database is a temporary SQLite file unless --database is given):
+
+    python benchmarks/user_lookup.py [--users 1000000 --lookups 20]
+"""
+
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+import uuid
+
+
+def measure(lookup, client_ids):
+    """Median and maximum latency of `lookup` in milliseconds."""
+    latencies = []
+    for client_id in client_ids:
+        start = time.perf_counter()
+        lookup(client_id)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return statistics.median(latencies), max(latencies)
+
+
+def main(args):
+    os.environ["DATABASE_URI"] = args.database or (
+        f"sqlite:///{tempfile.mkdtemp(prefix='marcel-users-')}/database.db"
+    )
+    from sqlalchemy import insert, select
+    from sqlalchemy.orm import Session
+
+    from marcel import routes
+    from marcel.database import engine
+    from marcel.models import Base, User
+
+    Base.metadata.create_all(engine)
+    (index,) = [i for i in User.__table__.indexes if i.name == "ix_user_client_id"]
+    with engine.begin() as connection:
+        index.drop(connection)
+        if connection.execute(select(User.id).limit(1)).first() is None:
+            print(f"Inserting {args.users} users")
+            for start in range(0, args.users, args.batch_size):
+                count = min(args.batch_size, args.users - start)
+                connection.execute(
+                    insert(User), [{"client_id": uuid.uuid4()} for _ in range(count)]
+                )
+    with Session(engine) as db:
+        client_ids = db.scalars(select(User.client_id)).all()
+    sample = random.Random(0).sample(client_ids, args.lookups)
+    print(f"{len(client_ids)} users, {args.lookups} lookups of existing users")
+
+    def before(client_id):
+        # The former `get_current_user`: load the user, insert it if missing
+        with Session(engine) as db:
+            user = db.query(User).filter(User.client_id == client_id).one_or_none()
+            assert user is not None
+
+    def after(client_id):
+        with Session(engine) as db:
+            routes.get_current_user_id(client_id, db)
+
+    def uncached(client_id):
+        routes.user_ids.clear()
+        after(client_id)
+
+    results = {"before (no index)": measure(before, sample)}
+    with engine.begin() as connection:
+        index.create(connection)
+    results["unique index"] = measure(uncached, sample)
+    for client_id in sample:
+        after(client_id)
+    results["unique index + cache"] = measure(after, sample)
+    # New clients: the upsert
+    results["first request"] = measure(
+        uncached, [uuid.uuid4() for _ in range(args.lookups)]
+    )
+
+    print(f"{'lookup':<22} {'median ms':>10} {'max ms':>10}")
+    for name, (median, maximum) in results.items():
+        print(f"{name:<22} {median:>10.3f} {maximum:>10.3f}")
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--lookups", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=50_000)
+    parser.add_argument(
+        "--database",
+        help="Database URI (e.g., a MySQL test database). Users are only inserted if the table is empty.",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_arguments())
@@ -1,13 +1,20 @@
 #!/bin/bash
 set -e
 
+python -m marcel.init_data schema
 python -m marcel.init_data documents
+python -m marcel.init_data faqs
 python -m marcel.init_data admins
 
 UVICORN_WORKERS="${UVICORN_WORKERS:-1}"
 UVICORN_PORT="${UVICORN_PORT:-9000}"
 UVICORN_ROOT_PATH="${UVICORN_ROOT_PATH:-/api}"
 
+# Workers share their metrics through this directory, cleared so that /metrics does not report samples of earlier runs
+export PROMETHEUS_MULTIPROC_DIR="${PROMETHEUS_MULTIPROC_DIR:-/tmp/marcel-metrics}"
+rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+
 # Start the app
 exec uvicorn marcel.main:app \
     --host 0.0.0.0 \
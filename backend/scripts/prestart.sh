@@ -3,5 +3,6 @@
 set -e
 set -x
 
+python -m marcel.init_data schema
 python -m marcel.init_data documents
 python -m marcel.init_data admins
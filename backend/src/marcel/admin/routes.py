@@ -10,17 +10,19 @@ We use following naming conventions for schemas where X is the model.
 | List Item           | `XListItem`               | `ConversationListItem`         |
 """
 
+import os
 import uuid
 from datetime import date, datetime, timedelta
-from typing import List, Optional
+from typing import Dict, List, Optional
 
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
 from pydantic import BaseModel, ConfigDict
 from sqlalchemy import func, select
 from sqlalchemy.orm import Session, selectinload
 
 from marcel.admin.auth import get_current_admin_user
 from marcel.database import get_db
+from marcel.experiments.llm_pool import LLMPool
 from marcel.models import (
     AdminUser,
     Conversation,
@@ -29,6 +31,8 @@ from marcel.models import (
     SourceRead,
     User,
 )
+from marcel.routes import get_admission
+from marcel.utils.admission import AdmissionController
 
 router = APIRouter()
 
@@ -41,6 +45,8 @@ class MessageRead(BaseModel):
     feedback: Optional[str]
     created_at: datetime
     sources: List[SourceRead]
+    # Milliseconds per stage of the answer (assistant messages only)
+    timings: Optional[Dict[str, int]] = None
 
 
 class ConversationRead(BaseModel):
@@ -137,6 +143,8 @@ class StatsTotal(BaseModel):
     total_conversations: int
     total_users: int
     total_messages: int
+    # Answers which are incomplete, because the client left or the generation stalled
+    total_cancelled_answers: int
     total_average_rating: float | None
 
 
@@ -287,6 +295,13 @@ def get_statistics(
             .where(func.date(Message.created_at).between(start_date, end_date))
             .scalar_subquery()
             .label("total_messages"),
+            select(func.count(Message.id))
+            .where(
+                Message.cancelled_answer.is_(True),
+                func.date(Message.created_at).between(start_date, end_date),
+            )
+            .scalar_subquery()
+            .label("total_cancelled_answers"),
             select(func.avg(Conversation.rating))
             .where(func.date(Conversation.created_at).between(start_date, end_date))
             .scalar_subquery()
@@ -314,6 +329,84 @@ def get_statistics(
             total_conversations=totals.total_conversations,
             total_users=totals.total_users,
             total_messages=totals.total_messages,
+            total_cancelled_answers=totals.total_cancelled_answers,
             total_average_rating=totals.total_average_rating,
         ),
     )
+
+
+class CacheStatistics(BaseModel):
+    size: int
+    maxsize: int
+    hits: int
+    misses: int
+    hit_rate: float | None
+    saved_generation_seconds: float | None = None
+
+
+class AdmissionStatistics(BaseModel):
+    max_concurrent: int
+    max_queue: int
+    active: int
+    queue_depth: int
+    admitted: int
+    rejected: int
+    cancelled: int
+    mean_wait_seconds: float
+    max_wait_seconds: float
+
+
+class LLMEndpointStatistics(BaseModel):
+    base_url: str
+    healthy: bool
+    outstanding: int
+    requests: int
+    failures: int
+    ejections: int
+    latency_seconds: float | None
+    first_token_seconds: float | None
+
+
+class ChatLogStatistics(BaseModel):
+    pending: int
+    written: int
+    failed: int
+    batches: int
+
+
+class RuntimeStatistics(BaseModel):
+    process_id: int
+    answer_cache: CacheStatistics | None
+    retrieval_cache: CacheStatistics | None
+    admission: AdmissionStatistics
+    coalesced_queries: int | None = None
+    llm_endpoints: List[LLMEndpointStatistics] | None = None
+    chat_log: ChatLogStatistics | None = None
+
+
+@router.get("/runtime", response_model=RuntimeStatistics)
+def get_runtime_statistics(
+    request: Request,
+    user: AdminUser = Depends(get_current_admin_user),
+    admission: AdmissionController = Depends(get_admission),
+) -> RuntimeStatistics:
+    """In-memory statistics of the worker process which serves this request. Each worker keeps its own caches."""
+    pipeline = request.state.pipeline_state.pipeline
+    answer_cache = getattr(pipeline, "answer_cache", None)
+    retrieval_cache = getattr(pipeline, "retrieval_cache", None)
+    in_flight = getattr(pipeline, "in_flight", None)
+    llm_pool = getattr(pipeline, "generator_async", None)
+    log_writer = getattr(request.state, "log_writer", None)
+    return RuntimeStatistics(
+        process_id=os.getpid(),
+        answer_cache=answer_cache.stats() if answer_cache is not None else None,
+        retrieval_cache=retrieval_cache.stats()
+        if retrieval_cache is not None
+        else None,
+        admission=AdmissionStatistics(**admission.stats()),
+        coalesced_queries=in_flight.coalesced if in_flight is not None else None,
+        llm_endpoints=llm_pool.stats() if isinstance(llm_pool, LLMPool) else None,
+        chat_log=ChatLogStatistics(**log_writer.stats())
+        if log_writer is not None
+        else None,
+    )
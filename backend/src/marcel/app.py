@@ -1,3 +1,7 @@
+import logging
+import threading
+from typing import Any, Callable
+
 from fastapi import FastAPI, Request, status
 from fastapi.concurrency import asynccontextmanager
 from fastapi.responses import JSONResponse
@@ -6,8 +10,25 @@ from starlette.types import Lifespan
 
 from marcel.admin.auth import router as auth_router
 from marcel.admin.routes import router as admin_router
+from marcel.chat_log import ChatLogWriter
+from marcel.database import AsyncSessionLocal, SessionLocal
+from marcel.metrics import mark_worker_exited
+from marcel.pipeline_state import PipelineState
 from marcel.routes import router
 
+logger = logging.getLogger(__name__)
+
+
+def startup(state: PipelineState, factory: Callable[..., Any]):
+    state.update("loading documents")
+    try:
+        with SessionLocal() as db:
+            state.documents.load(db)
+    except Exception:
+        # The catalog is loaded by the first query instead
+        logger.exception("Could not load documents")
+    state.build(factory)
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -16,8 +37,24 @@ async def lifespan(app: FastAPI):
     """
     from marcel.experiments.hybrid_pipeline import HybridPipeline
 
-    pipeline = HybridPipeline()
-    yield {"pipeline": pipeline}
+    # Build the pipeline in the background so that the worker answers health checks right away. Queries are rejected until the pipeline is ready (see `/ready`).
+    state = PipelineState()
+    builder = threading.Thread(
+        target=startup,
+        args=(state, HybridPipeline),
+        name="pipeline-startup",
+        daemon=True,
+    )
+    builder.start()
+    log_writer = ChatLogWriter(AsyncSessionLocal)
+    log_writer.start()
+    yield {"pipeline_state": state, "log_writer": log_writer}
+    # Write the chat logs of the last requests before the worker exits
+    await log_writer.close()
+    # A build which is still running is not waited for: the thread is a daemon and ends with the worker
+    if state.pipeline is not None:
+        state.pipeline.close()
+    mark_worker_exited()
 
 
 async def global_exception_handler(request: Request, exc: Exception):
@@ -0,0 +1,319 @@
+import asyncio
+import logging
+import time
+from collections import Counter, deque
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Deque, Dict, List, Optional, Set
+from uuid import UUID
+
+from sqlalchemy import Executable, func, insert, select, update
+from sqlalchemy import inspect as sa_inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.orm import Session
+
+from marcel.config import (
+    CHAT_LOG_BATCH_SIZE,
+    CHAT_LOG_FLUSH_INTERVAL,
+    CHAT_LOG_QUEUE_SIZE,
+    CHAT_LOG_WAIT_TIMEOUT,
+    MESSAGE_ID_BLOCK_SIZE,
+)
+from marcel.models import Conversation, IdBlock, Message, RetrievedDocument
+
+logger = logging.getLogger(__name__)
+
+# Seconds between lookups of rows which are not written yet
+WAIT_INTERVAL = 0.05
+
+
+class IdAllocator:
+    """Hands out primary keys from blocks which are reserved in the `id_block` table, so that rows can be referenced before they are inserted. Each worker reserves its own blocks, IDs are unique but only increase within a block.
+
+    The next block is reserved in the background once half of the current one is used, so that `allocate` only waits for the database when IDs are handed out faster than blocks are reserved.
+
+    Parameters
+    ----------
+    session_factory : async_sessionmaker[AsyncSession]
+        Sessions to reserve blocks with.
+    name : str
+        Name of the sequence in the `id_block` table.
+    column : Any
+        The primary key column. The first block of a sequence starts after its largest value.
+    block_size : int
+        IDs per block.
+    """
+
+    def __init__(
+        self,
+        session_factory: async_sessionmaker[AsyncSession],
+        name: str,
+        column: Any,
+        block_size: int = MESSAGE_ID_BLOCK_SIZE,
+    ):
+        self.session_factory = session_factory
+        self.name = name
+        self.column = column
+        self.block_size = block_size
+        self._blocks: Deque[range] = deque()
+        self._reserving: Optional[asyncio.Task] = None
+
+    @property
+    def available(self) -> int:
+        return sum(len(block) for block in self._blocks)
+
+    async def allocate(self, n: int) -> List[int]:
+        ids: List[int] = []
+        while len(ids) < n:
+            if not self._blocks:
+                await asyncio.shield(self._reserve_next())
+                continue
+            block = self._blocks[0]
+            taken = block[: n - len(ids)]
+            ids.extend(taken)
+            self._blocks[0] = block[len(taken) :]
+            if not self._blocks[0]:
+                self._blocks.popleft()
+
+        if self.available < self.block_size // 2:
+            self._reserve_next()
+        return ids
+
+    def _reserve_next(self) -> asyncio.Task:
+        """The task which reserves the next block. Concurrent callers share it."""
+        if self._reserving is None or self._reserving.done():
+            self._reserving = asyncio.create_task(self._append_block())
+            self._reserving.add_done_callback(self._reserved)
+        return self._reserving
+
+    def _reserved(self, task: asyncio.Task):
+        # Nobody awaits a reservation ahead of time, its error would go unnoticed. The next call tries again.
+        if self._reserving is task:
+            self._reserving = None
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(
+                "Could not reserve %s IDs", self.name, exc_info=task.exception()
+            )
+
+    async def _append_block(self):
+        self._blocks.append(await self.reserve())
+
+    async def reserve(self) -> range:
+        """Reserve the next block of IDs in the database."""
+        async with self.session_factory() as db:
+            # The update locks the row until the commit, concurrent workers get distinct blocks
+            result = await db.execute(
+                update(IdBlock)
+                .where(IdBlock.name == self.name)
+                .values(next_id=IdBlock.next_id + self.block_size)
+            )
+            if result.rowcount:
+                next_id = await db.scalar(
+                    select(IdBlock.next_id).where(IdBlock.name == self.name)
+                )
+                await db.commit()
+                return range(next_id - self.block_size, next_id)
+
+            start = (await db.scalar(select(func.max(self.column))) or 0) + 1
+            db.add(IdBlock(name=self.name, next_id=start + self.block_size))
+            try:
+                await db.commit()
+            except IntegrityError:
+                # Another worker created the sequence first
+                await db.rollback()
+                return await self.reserve()
+            return range(start, start + self.block_size)
+
+
+@dataclass
+class ChatLog:
+    """The messages of one request, with IDs already assigned (see `ChatLogWriter.message_ids`)."""
+
+    conversation_id: UUID
+    user_id: int
+    # Whether the conversation is inserted with the messages
+    new_conversation: bool
+    messages: List[Message]
+    created_at: datetime
+
+
+class ChatLogWriter:
+    """Writes chat logs in the background after the answers were streamed. Logs of concurrent requests are inserted in batches, one transaction per batch.
+
+    The queue holds at most `max_pending` logs, further requests wait in `submit` until the writer catches up. Pending logs are written by `close` on shutdown.
+
+    Parameters
+    ----------
+    session_factory : async_sessionmaker[AsyncSession]
+        Sessions to write with.
+    batch_size : int
+        Maximum logs per transaction.
+    flush_interval : float
+        Seconds to wait for more logs before a batch is written.
+    max_pending : int
+        Maximum logs in the queue.
+    id_block_size : int
+        Message IDs reserved at a time.
+    """
+
+    def __init__(
+        self,
+        session_factory: async_sessionmaker[AsyncSession],
+        batch_size: int = CHAT_LOG_BATCH_SIZE,
+        flush_interval: float = CHAT_LOG_FLUSH_INTERVAL,
+        max_pending: int = CHAT_LOG_QUEUE_SIZE,
+        id_block_size: int = MESSAGE_ID_BLOCK_SIZE,
+    ):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.message_ids = IdAllocator(
+            session_factory, "message", Message.id, id_block_size
+        )
+        self.queue: asyncio.Queue[ChatLog] = asyncio.Queue(max_pending)
+        self.pending_conversations: Counter[UUID] = Counter()
+        self.pending_messages: Set[int] = set()
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Write the pending logs and stop."""
+        if self._task is None:
+            return
+        await self.flush()
+        self._task.cancel()
+        await asyncio.wait([self._task])
+        self._task = None
+
+    async def submit(self, log: ChatLog):
+        """Queue a log. Waits while the queue is full."""
+        await self.queue.put(log)
+        self.pending_conversations[log.conversation_id] += 1
+        self.pending_messages.update(message.id for message in log.messages)
+
+    async def flush(self):
+        """Wait until the logs submitted so far are written."""
+        await self.queue.join()
+
+    def is_pending(
+        self,
+        conversation_id: Optional[UUID] = None,
+        message_id: Optional[int] = None,
+    ) -> bool:
+        """Whether logs of the conversation (or the message) are not written yet."""
+        return (
+            conversation_id in self.pending_conversations
+            or message_id in self.pending_messages
+        )
+
+    def stats(self):
+        return {
+            "pending": self.queue.qsize(),
+            "written": self.written,
+            "failed": self.failed,
+            "batches": self.batches,
+        }
+
+    async def _run(self):
+        while True:
+            batch = [await self.queue.get()]
+            if self.flush_interval > 0 and self.queue.qsize() < self.batch_size - 1:
+                await asyncio.sleep(self.flush_interval)
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            try:
+                await self._write(batch)
+            finally:
+                for log in batch:
+                    self.pending_conversations[log.conversation_id] -= 1
+                    if not self.pending_conversations[log.conversation_id]:
+                        del self.pending_conversations[log.conversation_id]
+                    self.pending_messages.difference_update(
+                        message.id for message in log.messages
+                    )
+                    self.queue.task_done()
+
+    async def _write(self, batch: List[ChatLog]):
+        try:
+            await self._insert(batch)
+        except Exception:
+            if len(batch) == 1:
+                logger.exception(
+                    "Could not write chat log of conversation %s",
+                    batch[0].conversation_id,
+                )
+                self.failed += 1
+                return
+            # Do not lose the whole batch because of one log
+            logger.warning(
+                "Could not write %d chat logs at once, retrying one by one",
+                len(batch),
+                exc_info=True,
+            )
+            for log in batch:
+                await self._write([log])
+            return
+        self.written += len(batch)
+        self.batches += 1
+
+    async def _insert(self, batch: List[ChatLog]):
+        conversations = [
+            {
+                "id": log.conversation_id,
+                "user_id": log.user_id,
+                "created_at": log.created_at,
+                "updated_at": log.created_at,
+            }
+            for log in batch
+            if log.new_conversation
+        ]
+        messages = [message for log in batch for message in log.messages]
+        documents = [document for message in messages for document in message.documents]
+        async with self.session_factory() as db:
+            # One multi-row insert per table
+            if conversations:
+                await db.execute(insert(Conversation), conversations)
+            await db.execute(insert(Message), [column_values(m) for m in messages])
+            if documents:
+                await db.execute(
+                    insert(RetrievedDocument), [column_values(d) for d in documents]
+                )
+            for log in batch:
+                if not log.new_conversation:
+                    await db.execute(
+                        update(Conversation)
+                        .where(Conversation.id == log.conversation_id)
+                        .values(updated_at=log.created_at)
+                    )
+            await db.commit()
+
+
+async def scalar_when_written_async(db: AsyncSession, statement: Executable) -> Any:
+    """The scalar result of `statement`, retried for up to `CHAT_LOG_WAIT_TIMEOUT` seconds while there is none. The rows of a chat log can still be pending in another worker."""
+    deadline = time.monotonic() + CHAT_LOG_WAIT_TIMEOUT
+    while (value := await db.scalar(statement)) is None and time.monotonic() < deadline:
+        await asyncio.sleep(WAIT_INTERVAL)
+    return value
+
+
+def scalar_when_written(db: Session, statement: Executable) -> Any:
+    """Like `scalar_when_written_async`, for sync routes."""
+    deadline = time.monotonic() + CHAT_LOG_WAIT_TIMEOUT
+    while (value := db.scalar(statement)) is None and time.monotonic() < deadline:
+        time.sleep(WAIT_INTERVAL)
+    return value
+
+
+def column_values(instance: Any) -> Dict[str, Any]:
+    """The column attributes of a model instance, to insert it without the session."""
+    return {
+        attribute.key: getattr(instance, attribute.key)
+        for attribute in sa_inspect(instance).mapper.column_attrs
+    }
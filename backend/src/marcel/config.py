@@ -1,4 +1,5 @@
 import os
+import tempfile
 from logging.config import dictConfig
 from pathlib import Path
 
@@ -7,10 +8,94 @@ DATA_PATH = DATA_ROOT / os.environ.get("DATA_PATH", "")
 FAQ_PATH = DATA_ROOT / os.environ.get("FAQ_PATH", "")
 ADMINS_PATH = DATA_ROOT / os.environ.get("ADMINS_PATH", "")
 
+# Writable directory for derived artifacts (e.g., FAQ embeddings) which are built once and shared by all workers
+INDEX_ROOT = Path(
+    os.environ.get("INDEX_ROOT", Path(tempfile.gettempdir()) / "marcel-index")
+)
+FAQ_INDEX_PATH = INDEX_ROOT / "faq_embeddings"
+BM25_INDEX_PATH = INDEX_ROOT / "bm25"
+
 LLM_BASE_URL = os.environ.get("LLM_BASE_URL")
 LLM_API_KEY = os.environ.get("LLM_API_KEY")
 MODEL_NAME = os.environ.get("MODEL_NAME")
 
+# OpenAI-compatible LLM servers (comma-separated, LLM_BASE_URL by default) which serve the same model. Requests go to the server with the fewest outstanding requests. Servers are ejected for LLM_EJECTION_SECONDS (longer if repeated) after LLM_FAILURE_THRESHOLD consecutive failures, or if their latency exceeds LLM_SLOW_FACTOR times the fastest server and LLM_SLOW_SECONDS (see marcel.experiments.llm_pool).
+LLM_BASE_URLS = [
+    url.strip()
+    for url in os.environ.get("LLM_BASE_URLS", LLM_BASE_URL or "").split(",")
+    if url.strip()
+] or [LLM_BASE_URL]
+LLM_FAILURE_THRESHOLD = int(os.environ.get("LLM_FAILURE_THRESHOLD", 3))
+LLM_EJECTION_SECONDS = float(os.environ.get("LLM_EJECTION_SECONDS", 30))
+LLM_SLOW_FACTOR = float(os.environ.get("LLM_SLOW_FACTOR", 3))
+LLM_SLOW_SECONDS = float(os.environ.get("LLM_SLOW_SECONDS", 5))
+
+# Seconds until the first token of a streamed answer (the request is retried on another server after that) and between later tokens (the answer fails after that). No limit if 0.
+LLM_FIRST_TOKEN_TIMEOUT = float(os.environ.get("LLM_FIRST_TOKEN_TIMEOUT", 30))
+LLM_TOKEN_TIMEOUT = float(os.environ.get("LLM_TOKEN_TIMEOUT", 15))
+
+# Number of threads that run the (synchronous) retrieval pipeline per worker process
+RETRIEVAL_WORKERS = int(os.environ.get("RETRIEVAL_WORKERS", 4))
+
+# Start retrieval concurrently with the LLM-based retrieval classifier (see HybridPipeline.run_async)
+SPECULATIVE_RETRIEVAL = (
+    os.environ.get("SPECULATIVE_RETRIEVAL", "false").lower() == "true"
+)
+
+# Local classifier which answers `requires_retrieval` without calling the LLM if it is confident (see marcel.experiments.query_classifier)
+QUERY_CLASSIFIER_PATH = (
+    DATA_ROOT / os.environ["QUERY_CLASSIFIER_PATH"]
+    if os.environ.get("QUERY_CLASSIFIER_PATH")
+    else None
+)
+QUERY_CLASSIFIER_THRESHOLD = float(os.environ.get("QUERY_CLASSIFIER_THRESHOLD", 0.9))
+
+# Concurrent history-less requests with the same (normalized) query share one run of the pipeline and one LLM stream (see HybridPipeline.run_async)
+COALESCE_QUERIES = os.environ.get("COALESCE_QUERIES", "true").lower() == "true"
+
+# Cache of retrieved documents per (normalized) query, invalidated when the document stores change (disabled if size is 0)
+RETRIEVAL_CACHE_SIZE = int(os.environ.get("RETRIEVAL_CACHE_SIZE", 1024))
+RETRIEVAL_CACHE_TTL = float(os.environ.get("RETRIEVAL_CACHE_TTL", 60 * 60))
+
+# Semantic cache of answers to history-less questions (disabled if size is 0)
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", 0))
+ANSWER_CACHE_TTL = float(os.environ.get("ANSWER_CACHE_TTL", 24 * 60 * 60))
+ANSWER_CACHE_SIMILARITY = float(os.environ.get("ANSWER_CACHE_SIMILARITY", 0.95))
+
+# Token budget of the RAG prompt, counted with a local tokenizer (no limit if 0, the default). Set PROMPT_TOKENIZER to the tokenizer of the served model along with a budget: the default one only approximates it. The history gets at most PROMPT_HISTORY_BUDGET tokens of the budget, documents fill the rest.
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", 0))
+PROMPT_HISTORY_BUDGET = int(os.environ.get("PROMPT_HISTORY_BUDGET", 1500))
+PROMPT_TOKENIZER = os.environ.get(
+    "PROMPT_TOKENIZER", "sentence-transformers/all-MiniLM-L6-v2"
+)
+
+# Order of the RAG prompt: "default", or "prefix_cache" to put the documents before the history for LLM servers with prefix caching (see hybrid_pipeline.py)
+PROMPT_LAYOUT = os.environ.get("PROMPT_LAYOUT", "default")
+
+# Conversation history loaded from the database for requests with `server_history`: the most recent messages, each truncated to a maximum length
+SERVER_HISTORY_MESSAGES = int(os.environ.get("SERVER_HISTORY_MESSAGES", 10))
+SERVER_HISTORY_MESSAGE_CHARS = int(os.environ.get("SERVER_HISTORY_MESSAGE_CHARS", 2000))
+
+# Streamed answers are sent in frames: the first token right away, later tokens every STREAM_FRAME_INTERVAL seconds or once STREAM_FRAME_MAX_BYTES are buffered. Every token is sent on its own if the interval is 0.
+STREAM_FRAME_INTERVAL = float(os.environ.get("STREAM_FRAME_INTERVAL", 0.05))
+STREAM_FRAME_MAX_BYTES = int(os.environ.get("STREAM_FRAME_MAX_BYTES", 512))
+
+# Concurrent LLM generations per worker (no limit if 0). Further requests wait in a queue of LLM_MAX_QUEUE and are rejected with 503 if it is full.
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", 0))
+LLM_MAX_QUEUE = int(os.environ.get("LLM_MAX_QUEUE", 100))
+
+# Chat logs are written in the background once the answer is streamed: batches of up to CHAT_LOG_BATCH_SIZE logs, after waiting CHAT_LOG_FLUSH_INTERVAL seconds for more. Requests wait once CHAT_LOG_QUEUE_SIZE logs are pending.
+CHAT_LOG_BATCH_SIZE = int(os.environ.get("CHAT_LOG_BATCH_SIZE", 100))
+CHAT_LOG_FLUSH_INTERVAL = float(os.environ.get("CHAT_LOG_FLUSH_INTERVAL", 0.05))
+CHAT_LOG_QUEUE_SIZE = int(os.environ.get("CHAT_LOG_QUEUE_SIZE", 1000))
+# Follow-up queries, feedback and ratings can reach a worker before another worker wrote the previous answer. Lookups which miss are retried for up to CHAT_LOG_WAIT_TIMEOUT seconds.
+CHAT_LOG_WAIT_TIMEOUT = float(os.environ.get("CHAT_LOG_WAIT_TIMEOUT", 2))
+# Message IDs each worker reserves in the database at a time
+MESSAGE_ID_BLOCK_SIZE = int(os.environ.get("MESSAGE_ID_BLOCK_SIZE", 100))
+
+# User IDs of recent clients cached per worker, so that requests do not look up the user of their cookie
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 10_000))
+
 SECRET_KEY = os.environ["SECRET_KEY"]
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.environ["ACCESS_TOKEN_EXPIRE_MINUTES"])
 
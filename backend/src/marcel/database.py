@@ -1,9 +1,18 @@
-from sqlalchemy import create_engine
+import time
+from pathlib import Path
+
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import Engine, create_engine, inspect
 from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 
 from marcel.config import DATABASE_URI
-from marcel.models import Base
+from marcel.metrics import DB_POOL_WAIT_SECONDS
+
+MIGRATIONS_PATH = Path(__file__).parent / "migrations"
+BASELINE_REVISION = "0001"
 
 
 def get_database_uri():
@@ -21,12 +30,42 @@ def get_database_uri():
     return uri, uri_async
 
 
+class TimedQueuePool(QueuePool):
+    """Records how long checkouts wait for a connection (including opening a new one)."""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_WAIT_SECONDS.labels("sync").observe(time.perf_counter() - start)
+
+
+class TimedAsyncAdaptedQueuePool(AsyncAdaptedQueuePool):
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_WAIT_SECONDS.labels("async").observe(time.perf_counter() - start)
+
+
 uri, uri_async = get_database_uri()
 engine = create_engine(
-    uri, pool_pre_ping=True, pool_size=5, max_overflow=10, pool_recycle=1800
+    uri,
+    poolclass=TimedQueuePool,
+    pool_pre_ping=True,
+    pool_size=5,
+    max_overflow=10,
+    pool_recycle=1800,
 )
 engine_async = create_async_engine(
-    uri_async, pool_pre_ping=True, pool_size=5, max_overflow=10, pool_recycle=1800
+    uri_async,
+    poolclass=TimedAsyncAdaptedQueuePool,
+    pool_pre_ping=True,
+    pool_size=5,
+    max_overflow=10,
+    pool_recycle=1800,
 )
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
@@ -34,8 +73,20 @@ AsyncSessionLocal = async_sessionmaker(
     autocommit=False, autoflush=False, bind=engine_async
 )
 
-# Make sure tables are created on app startup
-Base.metadata.create_all(engine)
+
+def upgrade_schema(engine: Engine):
+    """Create or upgrade the database schema to the latest migration (see `migrations/`).
+
+    Databases created before the migrations were introduced are marked as the baseline revision first.
+    """
+    config = Config()
+    config.set_main_option("script_location", str(MIGRATIONS_PATH))
+    with engine.begin() as connection:
+        config.attributes["connection"] = connection
+        tables = inspect(connection).get_table_names()
+        if "alembic_version" not in tables and "message" in tables:
+            command.stamp(config, BASELINE_REVISION)
+        command.upgrade(config, "head")
 
 
 def get_db():
@@ -0,0 +1,77 @@
+import asyncio
+import logging
+from typing import Dict, Iterable, NamedTuple, Optional, Tuple
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from marcel.models import Document
+
+logger = logging.getLogger(__name__)
+
+
+class DocumentRef(NamedTuple):
+    """What answers need of a document: its ID for `RetrievedDocument` rows, and the fields of its source."""
+
+    id: int
+    url: str
+    title: str
+    favicon: str
+
+
+COLUMNS = (
+    Document.fingerprint,
+    Document.id,
+    Document.url,
+    Document.title,
+    Document.favicon,
+)
+# Documents are only added (by `init_data`), the number of rows and the largest ID change with every import
+VERSION = select(func.count(Document.id), func.max(Document.id))
+
+
+class DocumentCatalog:
+    """The documents of the database by fingerprint, without their content. Loaded at startup, so that answers reference their documents without a query.
+
+    The catalog is reloaded when a fingerprint is missing and the documents in the database changed since it was loaded.
+    """
+
+    def __init__(self):
+        self.documents: Dict[str, DocumentRef] = {}
+        self.version: Optional[Tuple[int, Optional[int]]] = None
+        self.reloads = 0
+        self._lock = asyncio.Lock()
+
+    def __len__(self):
+        return len(self.documents)
+
+    def load(self, db: Session):
+        self.version = tuple(db.execute(VERSION).one())
+        self._set(db.execute(select(*COLUMNS)).all())
+
+    async def load_async(self, db: AsyncSession):
+        self.version = tuple((await db.execute(VERSION)).one())
+        self._set((await db.execute(select(*COLUMNS))).all())
+
+    def _set(self, rows: Iterable):
+        self.documents = {
+            fingerprint: DocumentRef(*document) for fingerprint, *document in rows
+        }
+        logger.info("Loaded %d document references", len(self.documents))
+
+    async def resolve(
+        self, fingerprints: Iterable[str], db: AsyncSession
+    ) -> Dict[str, DocumentRef]:
+        """The documents with the given fingerprints. Raises `KeyError` if one is not in the database."""
+        fingerprints = list(fingerprints)
+        if any(fingerprint not in self.documents for fingerprint in fingerprints):
+            async with self._lock:
+                # Another request may have reloaded the catalog meanwhile
+                missing = [f for f in fingerprints if f not in self.documents]
+                if missing and tuple((await db.execute(VERSION)).one()) != self.version:
+                    await self.load_async(db)
+                    self.reloads += 1
+        return {
+            fingerprint: self.documents[fingerprint] for fingerprint in fingerprints
+        }
@@ -0,0 +1,77 @@
+import logging
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from haystack import Document
+
+from marcel.utils.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CachedAnswer:
+    query: str
+    embedding: np.ndarray
+    answer: str
+    documents: List[Document]
+    answer_strategy: str
+    corpus_version: str
+    generator_latency: float
+
+
+class SemanticAnswerCache:
+    """Cache of generated answers for history-less questions.
+
+    A query hits the cache if its (normalized) embedding is at least `similarity_threshold` similar to the embedding of a cached query, and the answer was generated on the same knowledge base version. Entries are evicted by LRU and expire after `ttl` seconds.
+    """
+
+    def __init__(self, maxsize: int, ttl: Optional[float], similarity_threshold=0.95):
+        self.entries: LRUCache[str, CachedAnswer] = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.similarity_threshold = similarity_threshold
+        self.hits = 0
+        self.misses = 0
+        self.saved_generation_seconds = 0.0
+
+    def lookup(
+        self, embedding: np.ndarray, corpus_version: str
+    ) -> Optional[CachedAnswer]:
+        candidates = [
+            (key, entry)
+            for key, entry in self.entries.items()
+            if entry.corpus_version == corpus_version
+        ]
+        if candidates:
+            similarities = np.stack([entry.embedding for _, entry in candidates]) @ (
+                embedding
+            )
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.similarity_threshold:
+                key, entry = candidates[best]
+                self.entries.touch(key)
+                self.hits += 1
+                self.saved_generation_seconds += entry.generator_latency
+                logger.debug(
+                    "Answer cache hit (similarity: %.3f, cached query: %s)",
+                    similarities[best],
+                    entry.query,
+                )
+                return entry
+
+        self.misses += 1
+        return None
+
+    def put(self, entry: CachedAnswer):
+        self.entries.put(entry.query, entry)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "maxsize": self.entries.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+            "saved_generation_seconds": self.saved_generation_seconds,
+        }
@@ -0,0 +1,332 @@
+import asyncio
+import bisect
+import json
+import logging
+import math
+import os
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+from hashlib import sha256
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from haystack import Document, component
+from haystack.document_stores.in_memory.document_store import BM25_SCALING_FACTOR
+from haystack.utils import expit
+
+from marcel.experiments.components import VersionedInMemoryDocumentStore
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 2
+MANIFEST = "manifest.json"
+
+
+class CorruptIndexError(ValueError):
+    pass
+
+
+def file_checksum(path: Path) -> str:
+    digest = sha256()
+    with open(path, "rb") as fin:
+        for block in iter(lambda: fin.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class StringTable:
+    """Read-only sequence of strings, stored as one UTF-8 blob and the offsets of its items."""
+
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray):
+        self.blob = blob
+        self.offsets = offsets
+
+    @staticmethod
+    def write(path: Path, name: str, strings: List[str]):
+        encoded = [s.encode("utf-8") for s in strings]
+        offsets = np.cumsum([0] + [len(s) for s in encoded], dtype=np.int64)
+        (path / f"{name}.bin").write_bytes(b"".join(encoded))
+        np.save(path / f"{name}.offsets.npy", offsets)
+
+    @classmethod
+    def open(cls, path: Path, name: str) -> "StringTable":
+        offsets = np.load(path / f"{name}.offsets.npy", mmap_mode="r")
+        # np.memmap does not support empty files
+        blob = (
+            np.memmap(path / f"{name}.bin", dtype=np.uint8, mode="r")
+            if offsets[-1] > 0
+            else np.zeros(0, dtype=np.uint8)
+        )
+        return cls(blob, offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.blob[self.offsets[i] : self.offsets[i + 1]].tobytes().decode()
+
+    def __iter__(self) -> Iterator[str]:
+        return (self[i] for i in range(len(self)))
+
+
+class MmapCorpus:
+    """Documents and BM25 postings of the knowledge base, memory-mapped from the index built by `build`.
+
+    All workers map the same files, so the operating system keeps a single copy of the corpus in its page cache instead of one set of Document objects and BM25 statistics per worker. Documents are only materialized when they are retrieved.
+    """
+
+    def __init__(self, path: Path, manifest: Dict):
+        self.path = path
+        self.manifest = manifest
+        self.tokenization_regex = manifest["tokenization_regex"]
+        self.avg_doc_len = manifest["avg_doc_len"]
+
+        self.ids = StringTable.open(path, "ids")
+        self.contents = StringTable.open(path, "content")
+        self.metas = StringTable.open(path, "meta")
+        self.terms = StringTable.open(path, "terms")
+        self.indptr = np.load(path / "indptr.npy", mmap_mode="r")
+        self.doc_indices = np.load(path / "doc_indices.npy", mmap_mode="r")
+        self.term_freqs = np.load(path / "term_freqs.npy", mmap_mode="r")
+        self.doc_lengths = np.load(path / "doc_lengths.npy", mmap_mode="r")
+
+        n_documents = manifest["n_documents"]
+        if not (
+            len(self.ids) == len(self.contents) == len(self.metas) == n_documents
+            and len(self.doc_lengths) == n_documents
+            and len(self.terms) == manifest["n_terms"]
+            and len(self.indptr) == len(self.terms) + 1
+            and len(self.doc_indices) == len(self.term_freqs) == self.indptr[-1]
+        ):
+            raise CorruptIndexError(f"Inconsistent index: {path}")
+
+    @classmethod
+    def open(
+        cls, path: Path, source_checksum: str, verify=True
+    ) -> Optional["MmapCorpus"]:
+        """Open the index at `path`.
+
+        Returns None if there is no index or it was built from other source data (the caller then indexes the raw data). Raises CorruptIndexError if the index exists but cannot be used.
+        """
+        path = Path(path)
+        try:
+            manifest = json.loads((path / MANIFEST).read_text())
+        except FileNotFoundError:
+            logger.warning("No BM25 index at %s", path)
+            return None
+        except ValueError as e:
+            raise CorruptIndexError(f"Invalid manifest: {path / MANIFEST}") from e
+
+        if manifest.get("format_version") != FORMAT_VERSION:
+            raise CorruptIndexError(
+                f"Unsupported format version {manifest.get('format_version')} (expected: {FORMAT_VERSION}). Rebuild the index with `python -m marcel.init_data documents`."
+            )
+        if manifest["source_checksum"] != source_checksum:
+            logger.warning("BM25 index at %s was built from other data", path)
+            return None
+
+        data_path = path / manifest["data"]
+        if verify:
+            for name, checksum in manifest["files"].items():
+                try:
+                    actual = file_checksum(data_path / name)
+                except OSError as e:
+                    raise CorruptIndexError(f"Missing file: {data_path / name}") from e
+                if actual != checksum:
+                    raise CorruptIndexError(f"Checksum mismatch: {data_path / name}")
+
+        corpus = cls(data_path, manifest)
+        logger.info(
+            "Opened BM25 index (documents: %d, terms: %d)",
+            len(corpus),
+            len(corpus.terms),
+        )
+        return corpus
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __getitem__(self, i: int) -> Document:
+        meta = json.loads(self.metas[i])
+        # JSON turns the (numeric) link references of data_loader.load_documents into strings
+        if "links" in meta:
+            meta["links"] = {int(k): v for k, v in meta["links"].items()}
+        return Document(id=self.ids[i], content=self.contents[i], meta=meta)
+
+    def __iter__(self) -> Iterator[Document]:
+        return (self[i] for i in range(len(self)))
+
+    def iter_meta(self) -> Iterator[Tuple[str, Dict]]:
+        """Iterate over (id, meta) of all documents without decoding their content."""
+        for doc_id, meta in zip(self.ids, self.metas):
+            yield doc_id, json.loads(meta)
+
+    def postings(self, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Indices of the documents which contain `term` and the term frequencies."""
+        t = bisect.bisect_left(self.terms, term)
+        if t == len(self.terms) or self.terms[t] != term:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
+        start, end = self.indptr[t], self.indptr[t + 1]
+        return self.doc_indices[start:end], self.term_freqs[start:end]
+
+
+def build(documents: List[Document], path: Path, source_checksum: str):
+    """Write the documents and their BM25 statistics to `path`, to be opened with MmapCorpus.
+
+    Data files are written to a subdirectory named after their content:
+    - terms: the term dictionary (sorted)
+    - indptr, doc_indices, term_freqs: per term, the documents which contain it with the term frequency (CSR layout)
+    - doc_lengths: number of tokens per document
+    - ids, content, meta: the cleaned documents
+    The manifest records the format version, checksum of the source data, tokenization, corpus statistics and checksums of the data files. It is replaced last (atomically), which switches workers to the new index.
+
+    Statistics are computed by the document store itself, so that tokenization is identical to indexing at runtime.
+    """
+    store = VersionedInMemoryDocumentStore()
+    store.write_documents(documents)
+
+    postings: Dict[str, List[Tuple[int, int]]] = {}
+    for i, doc in enumerate(documents):
+        for term, freq in store._bm25_attr[doc.id].freq_token.items():
+            postings.setdefault(term, []).append((i, freq))
+    terms = sorted(postings)
+    entries = [entry for term in terms for entry in postings[term]]
+
+    path = Path(path)
+    tmp = path / f"build.{os.getpid()}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+
+    StringTable.write(tmp, "terms", terms)
+    np.save(
+        tmp / "indptr.npy",
+        np.cumsum([0] + [len(postings[term]) for term in terms], dtype=np.int64),
+    )
+    np.save(tmp / "doc_indices.npy", np.array([i for i, _ in entries], dtype=np.int32))
+    np.save(tmp / "term_freqs.npy", np.array([f for _, f in entries], dtype=np.int32))
+    np.save(
+        tmp / "doc_lengths.npy",
+        np.array([store._bm25_attr[doc.id].doc_len for doc in documents], np.int32),
+    )
+    StringTable.write(tmp, "ids", [doc.id for doc in documents])
+    StringTable.write(tmp, "content", [doc.content or "" for doc in documents])
+    StringTable.write(tmp, "meta", [json.dumps(doc.meta) for doc in documents])
+
+    files = {f.name: file_checksum(f) for f in sorted(tmp.iterdir())}
+    data = f"build-{sha256(json.dumps(files).encode()).hexdigest()[:16]}"
+    if (path / data).exists():
+        shutil.rmtree(tmp)
+    else:
+        os.replace(tmp, path / data)
+
+    manifest = {
+        "format_version": FORMAT_VERSION,
+        "source_checksum": source_checksum,
+        "tokenization_regex": store.bm25_tokenization_regex,
+        "n_documents": len(documents),
+        "n_terms": len(terms),
+        # As computed by the document store, so that scores are identical to indexing the raw data
+        "avg_doc_len": store._avg_doc_len,
+        "data": data,
+        "files": files,
+    }
+    tmp_manifest = path / f"{MANIFEST}.{os.getpid()}.tmp"
+    tmp_manifest.write_text(json.dumps(manifest, indent=2))
+    os.replace(tmp_manifest, path / MANIFEST)
+
+    for old in path.glob("build-*"):
+        if old.name != data:
+            shutil.rmtree(old, ignore_errors=True)
+
+    logger.info(
+        "Wrote BM25 index (documents: %d, terms: %d) to %s",
+        len(documents),
+        len(terms),
+        path / data,
+    )
+
+
+@component
+class MmapBM25Retriever:
+    """BM25 retriever over a MmapCorpus.
+
+    Scores are identical to InMemoryBM25Retriever with the BM25L algorithm (the default of InMemoryDocumentStore), but computed from the memory-mapped postings. Only the top-k documents are materialized.
+    """
+
+    def __init__(
+        self,
+        corpus: MmapCorpus,
+        top_k: int = 10,
+        scale_score: bool = False,
+        bm25_parameters: Optional[Dict[str, float]] = None,
+        async_executor: Optional[ThreadPoolExecutor] = None,
+    ):
+        self.corpus = corpus
+        self.top_k = top_k
+        self.scale_score = scale_score
+        bm25_parameters = bm25_parameters or {}
+        self.k = bm25_parameters.get("k1", 1.5)
+        self.b = bm25_parameters.get("b", 0.75)
+        self.delta = bm25_parameters.get("delta", 0.5)
+        self.async_executor = async_executor
+        self.tokenizer = re.compile(corpus.tokenization_regex).findall
+        # Per-document length normalization of term frequencies
+        self.length_norm = (
+            1 - self.b + self.b * np.asarray(corpus.doc_lengths) / (corpus.avg_doc_len)
+        )
+
+    def score(self, query: str) -> np.ndarray:
+        n_corpus = len(self.corpus)
+        scores = np.zeros(n_corpus)
+        if n_corpus == 0:
+            return scores
+        for token in dict.fromkeys(self.tokenizer(query.lower())):
+            doc_indices, term_freqs = self.corpus.postings(token)
+            n = len(doc_indices)
+            idf = math.log((n_corpus + 1.0) / (n + 0.5)) * int(n != 0)
+            freq = np.zeros(n_corpus)
+            freq[doc_indices] = term_freqs
+            ctd = freq / self.length_norm
+            scores += idf * (
+                (1.0 + self.k) * (ctd + self.delta) / (self.k + ctd + self.delta)
+            )
+        return scores
+
+    @component.output_types(documents=List[Document])
+    def run(
+        self,
+        query: str,
+        top_k: Optional[int] = None,
+        scale_score: Optional[bool] = None,
+    ):
+        if not query:
+            raise ValueError("Query should be a non-empty string")
+        top_k = top_k or self.top_k
+        scale_score = self.scale_score if scale_score is None else scale_score
+
+        scores = self.score(query)
+        documents = []
+        for i in np.argsort(-scores, kind="stable")[:top_k]:
+            score = float(scores[i])
+            if scale_score:
+                score = expit(score / BM25_SCALING_FACTOR)
+            if score <= 0.0:
+                continue
+            documents.append(replace(self.corpus[int(i)], score=score))
+        return {"documents": documents}
+
+    @component.output_types(documents=List[Document])
+    async def run_async(
+        self,
+        query: str,
+        top_k: Optional[int] = None,
+        scale_score: Optional[bool] = None,
+    ):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.async_executor, lambda: self.run(query, top_k, scale_score)
+        )
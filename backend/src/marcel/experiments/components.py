@@ -6,6 +6,30 @@ from haystack import (
     Document,
     component,
 )
+from haystack.document_stores.in_memory import InMemoryDocumentStore
+from haystack.document_stores.types import DuplicatePolicy
+
+
+class VersionedInMemoryDocumentStore(InMemoryDocumentStore):
+    """InMemoryDocumentStore which counts changes to its documents, so that cached retrieval results can be invalidated when the store changes.
+
+    The async variants of the write methods delegate to the sync ones and are covered as well.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.version = 0
+
+    def write_documents(
+        self, documents: List[Document], policy: DuplicatePolicy = DuplicatePolicy.NONE
+    ) -> int:
+        written = super().write_documents(documents=documents, policy=policy)
+        self.version += 1
+        return written
+
+    def delete_documents(self, document_ids: List[str]) -> None:
+        super().delete_documents(document_ids=document_ids)
+        self.version += 1
 
 
 @component
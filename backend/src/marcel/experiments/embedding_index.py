@@ -0,0 +1,116 @@
+import json
+import logging
+import os
+from dataclasses import replace
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+from haystack import Document
+
+from marcel.experiments.data_loader import fingerprint
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingIndex:
+    """Document embeddings persisted on disk, so that they are computed once instead of by every worker at startup.
+
+    The index consists of a manifest and a `.npy` file with one embedding per row. The manifest records the embedding model and the fingerprint of the content embedded in each row. Embeddings are reused for documents with known content; only new or changed documents are embedded.
+
+    Parameters
+    ----------
+    path : Path
+        Directory of the index. Needs to be writable to create or update the index (see `embed`).
+    model : str
+        Name of the embedding model. An index of another model is ignored.
+    """
+
+    MANIFEST = "manifest.json"
+
+    def __init__(self, path: Path, model: str):
+        self.path = Path(path)
+        self.model = model
+
+    def load(self) -> Dict[str, np.ndarray]:
+        """Map content fingerprints to (memory-mapped) embeddings. Empty if there is no usable index."""
+        try:
+            manifest = json.loads((self.path / self.MANIFEST).read_text())
+            if manifest["model"] != self.model:
+                logger.info(
+                    "Ignoring embedding index of another model (%s)", manifest["model"]
+                )
+                return {}
+            embeddings = np.load(self.path / manifest["embeddings"], mmap_mode="r")
+        except (OSError, ValueError, KeyError):
+            logger.info("No usable embedding index at %s", self.path)
+            return {}
+
+        if len(embeddings) != len(manifest["fingerprints"]):
+            logger.warning("Corrupt embedding index at %s", self.path)
+            return {}
+        return dict(zip(manifest["fingerprints"], embeddings))
+
+    def save(self, fingerprints: List[str], embeddings: np.ndarray):
+        self.path.mkdir(parents=True, exist_ok=True)
+        # Embeddings are written to a file named after their content and the manifest is replaced last (atomically). Workers which start concurrently therefore never read a partially written index.
+        name = f"embeddings-{fingerprint(fingerprints)[:16]}.npy"
+        tmp_suffix = f".{os.getpid()}.tmp"
+
+        tmp = self.path / (name + tmp_suffix)
+        with open(tmp, "wb") as fout:
+            np.save(fout, embeddings)
+        os.replace(tmp, self.path / name)
+
+        manifest = {
+            "model": self.model,
+            "embeddings": name,
+            "fingerprints": fingerprints,
+        }
+        tmp = self.path / (self.MANIFEST + tmp_suffix)
+        tmp.write_text(json.dumps(manifest))
+        os.replace(tmp, self.path / self.MANIFEST)
+
+        for old in self.path.glob("embeddings-*.npy"):
+            if old.name != name:
+                old.unlink(missing_ok=True)
+
+    def embed(
+        self, documents: List[Document], embedder, save: bool = True
+    ) -> List[Document]:
+        """Set the embeddings of `documents`, computing only those which are not in the index yet.
+
+        `embedder` is a document embedder (e.g., SentenceTransformersDocumentEmbedder) of the index model. It is only warmed up if documents need to be embedded.
+
+        With `save`, the index is updated to exactly `documents`: new embeddings are added and those of other documents are dropped. Without, the index is only read, e.g., by workers which embed a subset of the documents the index was built for.
+        """
+        index = self.load()
+        fingerprints = [fingerprint(doc.content) for doc in documents]
+        missing = [doc for doc, fp in zip(documents, fingerprints) if fp not in index]
+        if missing:
+            embedder.warm_up()
+            for doc in embedder.run(documents=missing)["documents"]:
+                index[fingerprint(doc.content)] = np.asarray(
+                    doc.embedding, dtype=np.float32
+                )
+        logger.info(
+            "Embedding index: %d reused, %d embedded",
+            len(documents) - len(missing),
+            len(missing),
+        )
+
+        if not documents:
+            return []
+
+        # Only keep current documents, so that the index does not grow with outdated content
+        current = list(dict.fromkeys(fingerprints))
+        if save and (missing or len(index) != len(current)):
+            try:
+                self.save(current, np.stack([index[fp] for fp in current]))
+            except OSError:
+                logger.exception("Could not save embedding index to %s", self.path)
+
+        return [
+            replace(doc, embedding=index[fp].tolist())
+            for doc, fp in zip(documents, fingerprints)
+        ]
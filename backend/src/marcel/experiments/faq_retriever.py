@@ -1,7 +1,10 @@
 import logging
-from typing import List, Literal
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+from pathlib import Path
+from typing import Dict, Iterator, List, Literal, Optional, Sequence, Tuple
 
-from haystack import Document, Pipeline, component, super_component
+from haystack import AsyncPipeline, Document, component, super_component
 from haystack.components.embedders import (
     SentenceTransformersDocumentEmbedder,
     SentenceTransformersTextEmbedder,
@@ -9,8 +12,10 @@ from haystack.components.embedders import (
 from haystack.components.retrievers import (
     InMemoryEmbeddingRetriever,
 )
-from haystack.components.writers import DocumentWriter
-from haystack.document_stores.in_memory import InMemoryDocumentStore
+
+from marcel.experiments.bm25_index import MmapCorpus
+from marcel.experiments.components import VersionedInMemoryDocumentStore
+from marcel.experiments.embedding_index import EmbeddingIndex
 
 logger = logging.getLogger(__name__)
 
@@ -28,35 +33,34 @@ class DocumentDeduplicator:
         return {"documents": filtered}
 
 
+def iter_meta(documents: Sequence[Document]) -> Iterator[Tuple[str, Dict]]:
+    """Iterate over (id, meta) of documents. Does not decode the content of a MmapCorpus."""
+    if isinstance(documents, MmapCorpus):
+        return documents.iter_meta()
+    return ((doc.id, doc.meta) for doc in documents)
+
+
 @component
 class ParentDocumentRetriever:
-    def __init__(self, documents: List[Document]):
-        document_store = InMemoryDocumentStore()
-        document_store.write_documents(documents=documents)
-        self.document_store = document_store
+    def __init__(self, documents: Sequence[Document]):
+        # Parents are looked up by position, so that a MmapCorpus is not copied into memory
+        self.documents = documents
+        self.index_by_id = {
+            doc_id: i for i, (doc_id, _) in enumerate(iter_meta(documents))
+        }
 
     @component.output_types(documents=List[Document])
     def run(self, documents: List[Document]):
         result = []
         for doc in documents:
             parent_id = doc.meta["parent_id"]
-            if isinstance(parent_id, list):
-                parent_filter = {
-                    "operator": "OR",
-                    "conditions": [
-                        {"field": "id", "operator": "==", "value": id_}
-                        for id_ in parent_id
-                    ],
-                }
-            else:
-                parent_filter = {"field": "id", "operator": "==", "value": parent_id}
-
-            parents = self.document_store.filter_documents(parent_filter)
-            for parent_doc in parents:
-                parent_doc = parent_doc.to_dict()
-                parent_doc["score"] = doc.score
-                parent_doc = Document.from_dict(parent_doc)
-                result.append(parent_doc)
+            parent_ids = parent_id if isinstance(parent_id, list) else [parent_id]
+            # Parents in corpus order
+            positions = sorted(
+                {self.index_by_id[id_] for id_ in parent_ids if id_ in self.index_by_id}
+            )
+            for i in positions:
+                result.append(replace(self.documents[i], score=doc.score))
         return {"documents": result}
 
 
@@ -64,15 +68,17 @@ class ParentDocumentRetriever:
 class FAQRetriever:
     def __init__(
         self,
-        documents: List[Document],
+        documents: Sequence[Document],
         faqs: List[Document],
         embedding_model="all-MiniLM-L6-v2",
         embedding_similarity_function: Literal["dot_product", "cosine"] = "cosine",
         top_k=1,
+        async_executor: Optional[ThreadPoolExecutor] = None,
+        index_path: Optional[Path] = None,
     ):
         # Assign parent IDs to FAQs.
         # NOTE: this assumes 1-1 mapping of url to doc. Needs to be revisited if we chunk documents (1-n relation).
-        url_to_doc_id = {doc.meta["url"]: doc.id for doc in documents}
+        url_to_doc_id = {meta["url"]: doc_id for doc_id, meta in iter_meta(documents)}
         faqs_with_parent = []
         for faq in faqs:
             try:
@@ -85,23 +91,27 @@ class FAQRetriever:
                 logger.warning("No parent for faq: %s", faq)
 
         # Index FAQs
-        faq_store = InMemoryDocumentStore(
-            embedding_similarity_function=embedding_similarity_function
+        faq_store = VersionedInMemoryDocumentStore(
+            embedding_similarity_function=embedding_similarity_function,
+            async_executor=async_executor,
         )
-        faq_indexing = Pipeline()
-        faq_indexing.add_component(
-            "embedder",
-            SentenceTransformersDocumentEmbedder(
-                model=embedding_model,
-                progress_bar=False,
-                local_files_only=True,
-            ),
+        embedder = SentenceTransformersDocumentEmbedder(
+            model=embedding_model,
+            progress_bar=False,
+            local_files_only=True,
         )
-        faq_indexing.add_component("writer", DocumentWriter(document_store=faq_store))
-        faq_indexing.connect("embedder", "writer")
-        faq_indexing.run({"documents": faqs_with_parent})
+        if index_path is None:
+            embedder.warm_up()
+            faqs_with_parent = embedder.run(documents=faqs_with_parent)["documents"]
+        else:
+            # Reuse the embeddings persisted by `init_data faqs`, which is the only writer of the index: workers only embed the FAQs with a parent, and FAQs which are not in the index are embedded in memory
+            faqs_with_parent = EmbeddingIndex(index_path, embedding_model).embed(
+                faqs_with_parent, embedder, save=False
+            )
+        faq_store.write_documents(faqs_with_parent)
 
-        pipeline = Pipeline()
+        # As a super component, FAQRetriever runs asynchronously within an AsyncPipeline, which requires the wrapped pipeline to be async as well.
+        pipeline = AsyncPipeline()
         pipeline.add_component(
             "query_embedder",
             SentenceTransformersTextEmbedder(
@@ -1,25 +1,62 @@
+import asyncio
 import logging
-from typing import List
-
-from haystack import Document, Pipeline
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+from haystack import AsyncPipeline, Document
 from haystack.components.builders import ChatPromptBuilder
+from haystack.components.embedders import SentenceTransformersTextEmbedder
 from haystack.components.joiners.document_joiner import DocumentJoiner
 from haystack.components.retrievers.in_memory import InMemoryBM25Retriever
 from haystack.dataclasses import ChatMessage
-from haystack.document_stores.in_memory import InMemoryDocumentStore
-from openai import AsyncOpenAI, OpenAI
 
-from marcel.config import DATA_PATH, FAQ_PATH, LLM_API_KEY, LLM_BASE_URL, MODEL_NAME
-from marcel.experiments import data_loader
-from marcel.experiments.components import ContentLinkNormalizer
-from marcel.experiments.faq_retriever import FAQRetriever
+from marcel.config import (
+    ANSWER_CACHE_SIMILARITY,
+    ANSWER_CACHE_SIZE,
+    ANSWER_CACHE_TTL,
+    BM25_INDEX_PATH,
+    COALESCE_QUERIES,
+    DATA_PATH,
+    FAQ_INDEX_PATH,
+    FAQ_PATH,
+    MODEL_NAME,
+    PROMPT_LAYOUT,
+    QUERY_CLASSIFIER_PATH,
+    QUERY_CLASSIFIER_THRESHOLD,
+    RETRIEVAL_CACHE_SIZE,
+    RETRIEVAL_CACHE_TTL,
+    RETRIEVAL_WORKERS,
+    SPECULATIVE_RETRIEVAL,
+)
+from marcel.experiments import bm25_index, data_loader
+from marcel.experiments.answer_cache import CachedAnswer, SemanticAnswerCache
+from marcel.experiments.bm25_index import MmapBM25Retriever, MmapCorpus
+from marcel.experiments.components import (
+    ContentLinkNormalizer,
+    VersionedInMemoryDocumentStore,
+)
+from marcel.experiments.faq_retriever import FAQRetriever, iter_meta
+from marcel.experiments.llm_pool import LLMPool
+from marcel.experiments.query_classifier import QueryClassifier
+from marcel.experiments.token_budget import TokenBudget
+from marcel.metrics import TOKENS_PER_SECOND
 from marcel.routes import ChatMessage as InputChatMessage
+from marcel.utils.cache import LRUCache
+from marcel.utils.single_flight import SingleFlight
 
 FAQ_EMBEDDING_MODEL = "all-MiniLM-L6-v2"
 
 logger = logging.getLogger(__name__)
 
 
+class RetrievalCancelled(Exception):
+    """The retrieval was cancelled before it completed (see `HybridPipeline.retrieve`)."""
+
+
 system_prompt_general = """You are a helpful and engaging chatbot called Marcel. Your name is Marcel and you are employed at the Marburg University. You help students with questions regarding admission and enrolment to the MSc Data Science Program. Only engage in topics related to admission and enrolment. Do not engage in other discussions."""
 
 system_prompt_rag = """
@@ -42,14 +79,63 @@ Given these documents, answer the question.
 {{ query }}
 """.strip()
 
+# Layout for LLM servers with prefix caching (e.g., vLLM): the documents follow the system prompt, in a fixed order instead of by score, and the question comes last. Requests which retrieve the same documents share the prefix up to the history, and the server reuses its KV cache for it.
+system_prompt_rag_prefix_cache = (
+    system_prompt_rag
+    + """
 
-def get_pipeline(documents: List[Document], faqs: List[Document]):
-    # Index documents
-    document_store = InMemoryDocumentStore()
-    document_store.write_documents(documents=documents)
+## Documents
+{% for doc in documents | sort(attribute="id") %}
+### {{ doc.meta['og:title'] }}
+{{ doc.content | replace("\n", "\\\\n") }}
 
-    # Setup retrieval pipeline
-    pipeline = Pipeline()
+{% endfor %}
+""".rstrip()
+)
+
+user_prompt_template_rag_prefix_cache = """
+Given the documents above, answer the question.
+
+## Question
+{{ query }}
+""".strip()
+
+PROMPT_LAYOUTS = ["default", "prefix_cache"]
+
+
+def rag_template(history: List[ChatMessage], layout: str) -> List[ChatMessage]:
+    """The chat template of the RAG prompt (`[system, *history, user]`) in the given layout."""
+    if layout == "prefix_cache":
+        system, user = (
+            system_prompt_rag_prefix_cache,
+            user_prompt_template_rag_prefix_cache,
+        )
+    else:
+        system, user = system_prompt_rag, user_prompt_template_rag
+    return [ChatMessage.from_system(system), *history, ChatMessage.from_user(user)]
+
+
+def get_pipeline(
+    documents: Union[List[Document], MmapCorpus],
+    faqs: List[Document],
+    async_executor: Optional[ThreadPoolExecutor] = None,
+    faq_index_path: Optional[Path] = None,
+    token_budget: Optional[TokenBudget] = None,
+):
+    # Index documents, unless they are memory-mapped from the BM25 index. Within an AsyncPipeline, retrievers serve queries on `async_executor`. Without it, each document store creates a single-threaded executor which serializes retrieval across concurrent requests.
+    if isinstance(documents, MmapCorpus):
+        bm25_retriever = MmapBM25Retriever(
+            documents, top_k=5, scale_score=True, async_executor=async_executor
+        )
+    else:
+        document_store = VersionedInMemoryDocumentStore(async_executor=async_executor)
+        document_store.write_documents(documents=documents)
+        bm25_retriever = InMemoryBM25Retriever(
+            document_store=document_store, top_k=5, scale_score=True
+        )
+
+    # Setup retrieval pipeline. The BM25 and FAQ branches are independent inputs to the joiner; AsyncPipeline runs them concurrently.
+    pipeline = AsyncPipeline()
 
     def add(name, component):
         pipeline.add_component(name, component)
@@ -57,13 +143,20 @@ def get_pipeline(documents: List[Document], faqs: List[Document]):
     def connect(component_a, component_b):
         pipeline.connect(component_a, component_b)
 
+    add("bm25_retriever", bm25_retriever)
     add(
-        "bm25_retriever",
-        InMemoryBM25Retriever(document_store=document_store, top_k=5, scale_score=True),
+        "faq_retriever",
+        FAQRetriever(
+            documents=documents,
+            faqs=faqs,
+            top_k=1,
+            async_executor=async_executor,
+            index_path=faq_index_path,
+        ),
     )
-    add("faq_retriever", FAQRetriever(documents=documents, faqs=faqs, top_k=1))
     add("result_joiner", DocumentJoiner(join_mode="merge", top_k=5, weights=[1, 2]))
     add("content_link_normalizer", ContentLinkNormalizer())
+    add("token_budget", token_budget or TokenBudget())
     add(
         "prompt_builder",
         ChatPromptBuilder(
@@ -74,31 +167,180 @@ def get_pipeline(documents: List[Document], faqs: List[Document]):
     connect("bm25_retriever", "result_joiner")
     connect("faq_retriever", "result_joiner")
     connect("result_joiner", "content_link_normalizer")
-    connect("content_link_normalizer", "prompt_builder")
+    connect("content_link_normalizer", "token_budget")
+    connect("token_budget.documents", "prompt_builder.documents")
+    connect("token_budget.template", "prompt_builder.template")
 
     return pipeline
 
 
+def check_cancelled(cancelled: Optional[threading.Event]):
+    if cancelled is not None and cancelled.is_set():
+        raise RetrievalCancelled()
+
+
+def normalize_query(query: str) -> str:
+    """Normalize queries which retrieve the same documents: case, whitespace and trailing punctuation."""
+    return " ".join(query.casefold().split()).strip(".?! ")
+
+
 class HybridPipeline:
-    def __init__(self, documents=None, faqs=None):
+    def __init__(
+        self,
+        documents=None,
+        faqs=None,
+        speculative_retrieval=SPECULATIVE_RETRIEVAL,
+        retrieval_workers=RETRIEVAL_WORKERS,
+        query_classifier: Optional[QueryClassifier] = None,
+        answer_cache: Optional[SemanticAnswerCache] = None,
+        retrieval_cache_size=RETRIEVAL_CACHE_SIZE,
+        on_progress: Optional[Callable[[str], None]] = None,
+        prompt_layout=PROMPT_LAYOUT,
+        coalesce_queries=COALESCE_QUERIES,
+        llm_pool: Optional[LLMPool] = None,
+    ):
         logger.info("init hybrid pipeline")
+        report = on_progress or (lambda phase: None)
+        if prompt_layout not in PROMPT_LAYOUTS:
+            raise ValueError(
+                f"Unknown prompt layout {prompt_layout!r}. Choose from {PROMPT_LAYOUTS}."
+            )
+        self.prompt_layout = prompt_layout
+        self.speculative_retrieval = speculative_retrieval
+        self.in_flight: Optional[SingleFlight[tuple, Dict[str, Any]]] = (
+            SingleFlight() if coalesce_queries else None
+        )
+
+        # The retrieval components are synchronous (BM25, query embedding, prompt building). We run the pipeline on a bounded pool of threads so that it does not block the event loop which serves all other streams of this worker. Running the pipeline from several threads is safe: components are warmed up below and do not mutate their state in `run`, and each thread runs the pipeline on its own event loop with all intermediate results local to the call.
+        self.retrieval_executor = ThreadPoolExecutor(
+            max_workers=retrieval_workers, thread_name_prefix="retrieval"
+        )
+        # The pipeline runs sync components on the default executor of the event loop. The loops of all retrieval threads share this one (see `_run_in_loop`).
+        self.component_executor = ThreadPoolExecutor(
+            max_workers=retrieval_workers, thread_name_prefix="retrieval-component"
+        )
+        self._thread_loops = threading.local()
+        self._event_loops: List[asyncio.AbstractEventLoop] = []
+        self.document_store_executor = ThreadPoolExecutor(
+            max_workers=retrieval_workers, thread_name_prefix="document-store"
+        )
+
+        report("loading documents")
         if documents is None:
-            documents = data_loader.load_documents(data_path=DATA_PATH)
+            # Map the index built by `init_data documents`. This saves cleaning and tokenizing the raw data in every worker, and all workers share one copy of the corpus. Fails on a corrupt index.
+            documents = MmapCorpus.open(
+                BM25_INDEX_PATH, bm25_index.file_checksum(DATA_PATH)
+            )
+            if documents is None:
+                documents = data_loader.load_documents(data_path=DATA_PATH)
         if faqs is None:
             faqs = data_loader.load_faqs(faq_path=FAQ_PATH)
 
-        self.retriever = get_pipeline(documents, faqs)
-        self.generator = OpenAI(
-            api_key=LLM_API_KEY,
-            base_url=LLM_BASE_URL,
-        )
-        self.generator_async = AsyncOpenAI(
-            api_key=LLM_API_KEY,
-            base_url=LLM_BASE_URL,
+        report("indexing FAQs")
+        self.retriever = get_pipeline(
+            documents,
+            faqs,
+            async_executor=self.document_store_executor,
+            faq_index_path=FAQ_INDEX_PATH,
         )
+        self.generator_async = llm_pool or LLMPool()
+        report("loading models")
         self.retriever.warm_up()
+        self.token_budget: TokenBudget = self.retriever.get_component("token_budget")
+
+        # The memory-mapped corpus is read-only, only document stores can change
+        self.document_stores: List[VersionedInMemoryDocumentStore] = [
+            self.retriever.get_component("faq_retriever")
+            .pipeline.get_component("faq_retriever")
+            .document_store
+        ]
+        bm25_retriever = self.retriever.get_component("bm25_retriever")
+        if isinstance(bm25_retriever, InMemoryBM25Retriever):
+            self.document_stores.append(bm25_retriever.document_store)
+        self.retrieval_cache: Optional[LRUCache[tuple, List[Document]]] = (
+            LRUCache(maxsize=retrieval_cache_size, ttl=RETRIEVAL_CACHE_TTL)
+            if retrieval_cache_size > 0
+            else None
+        )
 
-    def retrieve(self, query: str, history: List[InputChatMessage]):
+        if query_classifier is None and QUERY_CLASSIFIER_PATH:
+            query_classifier = QueryClassifier.load(
+                QUERY_CLASSIFIER_PATH, threshold=QUERY_CLASSIFIER_THRESHOLD
+            )
+            logger.info(
+                "Loaded query classifier (metrics: %s)", query_classifier.metrics
+            )
+        if query_classifier is not None:
+            query_classifier.warm_up()
+        self.query_classifier = query_classifier
+
+        if answer_cache is None and ANSWER_CACHE_SIZE > 0:
+            answer_cache = SemanticAnswerCache(
+                maxsize=ANSWER_CACHE_SIZE,
+                ttl=ANSWER_CACHE_TTL,
+                similarity_threshold=ANSWER_CACHE_SIMILARITY,
+            )
+        self.answer_cache = answer_cache
+        self._corpus_fingerprint = data_loader.fingerprint(
+            sorted(
+                [
+                    *(doc_id for doc_id, _ in iter_meta(documents)),
+                    *(doc.id for doc in faqs),
+                ]
+            )
+        )
+        self.query_embedder = SentenceTransformersTextEmbedder(
+            model=FAQ_EMBEDDING_MODEL, progress_bar=False, local_files_only=True
+        )
+        if self.answer_cache is not None:
+            self.query_embedder.warm_up()
+
+    @property
+    def corpus_version(self) -> str:
+        """Identifies the current state of the knowledge base. Cached answers and retrieval results are only valid for the version they were created from."""
+        versions = ".".join(str(store.version) for store in self.document_stores)
+        return f"{self._corpus_fingerprint}:{versions}"
+
+    def close(self):
+        self.retrieval_executor.shutdown(wait=False, cancel_futures=True)
+        self.component_executor.shutdown(wait=False, cancel_futures=True)
+        self.document_store_executor.shutdown(wait=False, cancel_futures=True)
+        for loop in self._event_loops:
+            if not loop.is_running():
+                loop.close()
+
+    def _run_in_loop(self, coro):
+        """Run `coro` on the event loop of the calling thread. Unlike `asyncio.run`, the loop and its executor are created once per thread instead of for each call."""
+        loop = getattr(self._thread_loops, "loop", None)
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            loop.set_default_executor(self.component_executor)
+            self._thread_loops.loop = loop
+            self._event_loops.append(loop)
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            # Like `asyncio.run`, do not leave tasks behind (e.g., of a pipeline which failed)
+            pending = asyncio.all_tasks(loop)
+            for task in pending:
+                task.cancel()
+            if pending:
+                loop.run_until_complete(
+                    asyncio.gather(*pending, return_exceptions=True)
+                )
+
+    def retrieve(
+        self,
+        query: str,
+        history: List[InputChatMessage],
+        timings: Optional[Dict[str, float]] = None,
+        cancelled: Optional[threading.Event] = None,
+    ):
+        """Retrieve the documents of the query and build the prompt.
+
+        Threads cannot be interrupted, so a retrieval which is not needed anymore is cancelled by setting `cancelled`: the remaining components are skipped, and `RetrievalCancelled` is raised.
+        """
+        check_cancelled(cancelled)
         history_messages = [
             ChatMessage.from_user(message.content)
             if message.role == "user"
@@ -106,30 +348,128 @@ class HybridPipeline:
             for message in history
         ]
 
-        retriever_results = self.retriever.run(
-            {
-                "bm25_retriever": {"query": query},
-                "faq_retriever": {"text": query},
-                "prompt_builder": {
-                    "template": [ChatMessage.from_system(system_prompt_rag)]
-                    + history_messages
-                    + [ChatMessage.from_user(user_prompt_template_rag)],
-                    "template_variables": {"query": query},
-                },
+        data = {
+            "bm25_retriever": {"query": query},
+            "faq_retriever": {"text": query},
+            "token_budget": {
+                "template": rag_template(history_messages, self.prompt_layout),
+                "query": query,
             },
+            "prompt_builder": {"template_variables": {"query": query}},
+        }
+        if self.retrieval_cache is None:
+            return self._run_in_loop(self._run_retriever(data, timings, cancelled))
+
+        # The key is computed before retrieval: if the stores change meanwhile, the result is cached under the outdated version and never served.
+        key = (normalize_query(query), self.corpus_version)
+        documents = self.retrieval_cache.get(key)
+        if documents is None:
+            retriever_results = self._run_in_loop(
+                self._run_retriever(data, timings, cancelled)
+            )
+            self.retrieval_cache.put(
+                key, retriever_results["content_link_normalizer"]["documents"]
+            )
+            return retriever_results
+
+        # Cache hit: the prompt still depends on the query and history
+        check_cancelled(cancelled)
+        start = time.perf_counter()
+        budgeted = self.token_budget.run(documents=documents, **data["token_budget"])
+        if timings is not None:
+            timings["token_budget"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        prompt = self.retriever.get_component("prompt_builder").run(
+            **budgeted, **data["prompt_builder"]
+        )
+        if timings is not None:
+            timings["prompt_builder"] = time.perf_counter() - start
+        return {
+            "content_link_normalizer": {"documents": documents},
+            "token_budget": budgeted,
+            "prompt_builder": prompt,
+        }
+
+    async def _run_retriever(
+        self,
+        data: Dict[str, Any],
+        timings: Optional[Dict[str, float]],
+        cancelled: Optional[threading.Event] = None,
+    ):
+        """Run the retrieval pipeline and record how long each component took.
+
+        Components run as soon as their inputs are ready, so the duration of a component is measured from the moment its last predecessor finished.
+        """
+        start = time.perf_counter()
+        finished: Dict[str, float] = {}
+        retriever_results: Dict[str, Any] = {}
+        async for partial_results in self.retriever.run_async_generator(
+            data,
             include_outputs_from=set(
                 [
                     "faq_retriever",
                     "bm25_retriever",
+                    "result_joiner",
                     "content_link_normalizer",
+                    "token_budget",
                     "prompt_builder",
                 ]
             ),
-        )
+        ):
+            now = time.perf_counter() - start
+            for name in partial_results:
+                finished.setdefault(name, now)
+            retriever_results.update(partial_results)
+            # The components which are still running are cancelled by `_run_in_loop`
+            check_cancelled(cancelled)
+
+        if timings is not None:
+            for name, finished_at in finished.items():
+                started_at = max(
+                    (finished[p] for p in self.retriever.graph.predecessors(name)),
+                    default=0.0,
+                )
+                timings[name] = finished_at - started_at
 
         return retriever_results
 
-    async def requires_retrieval(self, query: str, max_retries=1, timeout=2):
+    async def retrieve_async(
+        self,
+        query: str,
+        history: List[InputChatMessage],
+        timings: Optional[Dict[str, float]] = None,
+        cancelled: Optional[threading.Event] = None,
+    ):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.retrieval_executor, self.retrieve, query, history, timings, cancelled
+        )
+
+    def embed_query(self, query: str) -> np.ndarray:
+        embedding = np.asarray(self.query_embedder.run(text=query)["embedding"])
+        return embedding / np.linalg.norm(embedding)
+
+    async def classify_query(self, query: str) -> Optional[bool]:
+        """The verdict of the local query classifier. None without a classifier, or if it is not confident."""
+        if self.query_classifier is None:
+            return None
+        loop = asyncio.get_running_loop()
+        verdict = await loop.run_in_executor(
+            self.retrieval_executor, self.query_classifier.classify, query
+        )
+        if verdict is None:
+            logger.debug("Query classifier is not confident. Ask the LLM.")
+        return verdict
+
+    async def requires_retrieval(
+        self, query: str, max_retries=1, timeout=2, use_classifier=True
+    ):
+        if use_classifier:
+            verdict = await self.classify_query(query)
+            if verdict is not None:
+                return verdict
+
         prompt = (
             "Please determine if the following user utterance is a question. "
             "Respond with 'YES' if it is a genuine question. Respond with 'NO' if it is chit-chat or if the user asks the chatbot what kind of information it could provide, unrelated to earlier conversation."
@@ -152,22 +492,167 @@ class HybridPipeline:
 
         raise ValueError("Unexpected response")
 
-    async def run_async(self, query: str, history: List[InputChatMessage], debug=False):
+    async def _retrieve_timed(
+        self,
+        query: str,
+        history: List[InputChatMessage],
+        timings: Dict[str, float],
+        cancelled: Optional[threading.Event] = None,
+    ):
+        # Components report into a separate dict which is only merged once retrieval completed. A discarded speculative retrieval therefore leaves no trace in `timings`.
+        start = time.perf_counter()
+        component_timings: Dict[str, float] = {}
+        retriever_results = await self.retrieve_async(
+            query, history, component_timings, cancelled
+        )
+        timings["retrieval"] = time.perf_counter() - start
+        timings.update(component_timings)
+        return retriever_results
+
+    async def _answer_strategy(
+        self, query: str, timings: Dict[str, float]
+    ) -> Tuple[str, str]:
+        """The answer strategy of the query, and where the verdict came from: the local `classifier`, the `llm`, or the `fallback` if neither could tell."""
+        start = time.perf_counter()
         try:
-            answer_strategy = (
-                "retrieve"
-                if await self.requires_retrieval(query)
-                else "generate_with_history"
-            )
+            verdict = await self.classify_query(query)
+            source = "classifier"
+            if verdict is None:
+                verdict = await self.requires_retrieval(query, use_classifier=False)
+                source = "llm"
+            answer_strategy = "retrieve" if verdict else "generate_with_history"
         except Exception as e:
             logger.info(
                 "Could not determine if query needs retrieval. Run retrieval.",
                 exc_info=e,
             )
-            answer_strategy = "retrieve"
+            answer_strategy, source = "retrieve", "fallback"
+        timings["classifier"] = time.perf_counter() - start
+        return answer_strategy, source
+
+    def _cached_result(self, cached: CachedAnswer, timings: Dict[str, float]):
+        async def replay():
+            yield cached.answer
+
+        return {
+            "generated_answer": replay(),
+            "documents": cached.documents,
+            "answer_strategy": cached.answer_strategy,
+            "answer_strategy_source": "cache",
+            "speculative_retrieval": None,
+            "answer_cache_hit": True,
+            "coalesced": False,
+            "prompt_tokens": None,
+            "stalls": [],
+            "timings": timings,
+        }
+
+    async def _cache_answer(
+        self,
+        chunks,
+        query: str,
+        embedding: np.ndarray,
+        documents: List[Document],
+        answer_strategy: str,
+    ):
+        """Pass through the streamed answer and cache it once it is complete."""
+        answer = ""
+        start = time.perf_counter()
+        async for chunk in chunks:
+            answer += chunk
+            yield chunk
+
+        self.answer_cache.put(
+            CachedAnswer(
+                query=query,
+                embedding=embedding,
+                answer=answer,
+                documents=documents,
+                answer_strategy=answer_strategy,
+                corpus_version=self.corpus_version,
+                generator_latency=time.perf_counter() - start,
+            )
+        )
+
+    async def run_async(self, query: str, history: List[InputChatMessage], debug=False):
+        """Answer a query. Concurrent history-less requests with the same (normalized) query are coalesced: only the first one runs the pipeline, and its answer is streamed to all of them."""
+        if self.in_flight is None or history or debug:
+            return await self._run_async(query, history, debug)
+
+        async def run():
+            result = await self._run_async(query, history)
+            return result, result["generated_answer"]
+
+        key = (normalize_query(query), self.corpus_version)
+        start = time.perf_counter()
+        result, generated_answer, coalesced = await self.in_flight.run(key, run)
+        if coalesced:
+            # The timings and stalls belong to the request which ran the pipeline, and keep changing while it generates
+            result = {
+                **result,
+                "answer_strategy_source": "coalesced",
+                "stalls": [],
+                "timings": {"coalesced_wait": time.perf_counter() - start},
+            }
+        return {**result, "generated_answer": generated_answer, "coalesced": coalesced}
+
+    async def _run_async(
+        self, query: str, history: List[InputChatMessage], debug=False
+    ):
+        timings: Dict[str, float] = {}
+
+        # Answers only depend on the query if there is no history, which makes them cacheable.
+        embedding = None
+        if self.answer_cache is not None and not history:
+            start = time.perf_counter()
+            loop = asyncio.get_running_loop()
+            embedding = await loop.run_in_executor(
+                self.retrieval_executor, self.embed_query, query
+            )
+            cached = self.answer_cache.lookup(embedding, self.corpus_version)
+            timings["answer_cache"] = time.perf_counter() - start
+            if cached:
+                return self._cached_result(cached, timings)
+
+        # In speculative mode, retrieval runs while we wait for the classifier. Its result is dropped if the classifier decides that the query does not need retrieval.
+        speculative_retrieval = None
+        speculative_task = None
+        cancel_speculation = threading.Event()
+        if self.speculative_retrieval:
+            speculative_task = asyncio.create_task(
+                self._retrieve_timed(query, history, timings, cancel_speculation)
+            )
+
+        try:
+            answer_strategy, answer_strategy_source = await self._answer_strategy(
+                query, timings
+            )
+
+            if speculative_task and answer_strategy == "generate_with_history":
+                speculative_retrieval = "discarded"
+                logger.debug(
+                    "Speculative retrieval discarded. Its remaining components are skipped."
+                )
+            elif speculative_task:
+                wait_start = time.perf_counter()
+                retriever_results = await speculative_task
+                timings["retrieval_wait"] = time.perf_counter() - wait_start
+                speculative_retrieval = "used"
+                logger.debug(
+                    "Speculative retrieval used (classifier: %.3fs, retrieval: %.3fs, saved: %.3fs).",
+                    timings["classifier"],
+                    timings["retrieval"],
+                    timings["retrieval"] - timings["retrieval_wait"],
+                )
+        finally:
+            # Also if the request is cancelled while the classifier runs. A retrieval which did not start yet is dropped from the executor queue, a running one stops at its next component.
+            if speculative_task is not None and not speculative_task.done():
+                cancel_speculation.set()
+                speculative_task.cancel()
 
-        retriever_results = None
         if answer_strategy == "generate_with_history":
+            # Prefix-cache friendly in both layouts: the invariant system prompt comes first and the new message last
+            retriever_results = None
             messages = [
                 {"role": "system", "content": system_prompt_general},
                 *[
@@ -177,31 +662,68 @@ class HybridPipeline:
                 {"role": "user", "content": query},
             ]
         else:
-            retriever_results = self.retrieve(query, history)
+            if not speculative_task:
+                retriever_results = await self._retrieve_timed(query, history, timings)
             messages = [
                 message.to_openai_dict_format()
                 for message in retriever_results["prompt_builder"]["prompt"]
             ]
 
-        generator_results = await self.generator_async.chat.completions.create(
-            model=MODEL_NAME,
-            messages=messages,
-            stream=True,
-        )  # type: ignore
+        start = time.perf_counter()
+        prompt_tokens = await asyncio.get_running_loop().run_in_executor(
+            self.retrieval_executor, self.token_budget.count_messages, messages
+        )
+        timings["token_count"] = time.perf_counter() - start
+
+        stalls: List[str] = []
 
         async def chunk_generator():
+            # The LLM request is only sent once the answer is consumed, so that callers can wait for a generation slot first (see routes.query)
+            start = time.perf_counter()
+            generator_results = await self.generator_async.chat.completions.create(
+                model=MODEL_NAME,
+                messages=messages,
+                stream=True,
+                on_stall=stalls.append,
+            )  # type: ignore
+            # Until the response headers arrived, or the first token with an LLM pool
+            timings["llm_request"] = time.perf_counter() - start
+            # Servers stream about one token per chunk. Only counted here, the rate is recorded once the answer is complete.
+            tokens = 0
+            first_token = last_token = 0.0
             async for chunk in generator_results:
                 if len(chunk.choices) > 0:
                     delta = chunk.choices[0].delta
                     if delta.content:
+                        last_token = time.perf_counter()
+                        if not tokens:
+                            first_token = last_token
+                        tokens += 1
                         yield delta.content
+            if tokens > 1 and last_token > first_token:
+                TOKENS_PER_SECOND.observe((tokens - 1) / (last_token - first_token))
+
+        # Only the documents which made it into the prompt are sources of the answer
+        documents = (
+            retriever_results["token_budget"]["documents"] if retriever_results else []
+        )
+        generated_answer = chunk_generator()
+        if embedding is not None:
+            generated_answer = self._cache_answer(
+                generated_answer, query, embedding, documents, answer_strategy
+            )
 
         result = {
-            "generated_answer": chunk_generator(),
-            "documents": retriever_results["content_link_normalizer"]["documents"]
-            if retriever_results
-            else [],
+            "generated_answer": generated_answer,
+            "documents": documents,
             "answer_strategy": answer_strategy,
+            "answer_strategy_source": answer_strategy_source,
+            "speculative_retrieval": speculative_retrieval,
+            "answer_cache_hit": False,
+            "coalesced": False,
+            "prompt_tokens": prompt_tokens,
+            "stalls": stalls,
+            "timings": timings,
         }
 
         if debug:
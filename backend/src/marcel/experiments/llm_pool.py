@@ -0,0 +1,305 @@
+import asyncio
+import copy
+import logging
+import time
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Sequence
+
+import openai
+from openai import AsyncOpenAI
+
+from marcel.config import (
+    LLM_API_KEY,
+    LLM_BASE_URLS,
+    LLM_EJECTION_SECONDS,
+    LLM_FAILURE_THRESHOLD,
+    LLM_FIRST_TOKEN_TIMEOUT,
+    LLM_SLOW_FACTOR,
+    LLM_SLOW_SECONDS,
+    LLM_TOKEN_TIMEOUT,
+)
+
+logger = logging.getLogger(__name__)
+
+# Weight of the latest latency in the moving average of an endpoint
+LATENCY_SMOOTHING = 0.3
+
+
+class GenerationStalled(Exception):
+    """A stream did not deliver its next token in time."""
+
+
+def is_endpoint_failure(error: Exception) -> bool:
+    """Errors which indicate that the server is unavailable, overloaded or stalled, rather than a bad request."""
+    if isinstance(error, (openai.APIConnectionError, GenerationStalled)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code >= 500 or error.status_code == 429
+    return False
+
+
+class LLMEndpoint:
+    """An OpenAI-compatible server and its health."""
+
+    def __init__(self, base_url: Optional[str], client: Any):
+        self.base_url = base_url
+        self.client = client
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        # Moving averages of the time to the first token of streams ("first_token") and to the response of other requests ("response")
+        self.latency: Dict[str, float] = {}
+
+    def stats(self, now: float) -> Dict[str, Any]:
+        return {
+            "base_url": self.base_url or "default",
+            "healthy": self.ejected_until <= now,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "ejections": self.ejections,
+            "latency_seconds": self.latency.get("response"),
+            "first_token_seconds": self.latency.get("first_token"),
+        }
+
+
+class LLMPool:
+    """Spreads LLM requests over several OpenAI-compatible servers. Exposes `chat.completions.create` and `with_options` like `AsyncOpenAI`.
+
+    A request goes to the healthy endpoint with the fewest outstanding requests (streams count until they are consumed). Endpoints are ejected for a while after `failure_threshold` consecutive failures, or if their latency exceeds `slow_factor` times the latency of the fastest endpoint and `slow_seconds`. Latencies of streams (time to the first token) and of other requests (time to the response, e.g., of short classifier calls) are compared separately. Repeated ejections last longer. If a request fails (or a stream stalls) before it returns, it is retried on another endpoint. If all endpoints are ejected, they are used anyway.
+
+    The pool lives on the event loop of the worker and is not thread-safe.
+
+    Parameters
+    ----------
+    base_urls : Sequence[Optional[str]]
+        Base URLs of the servers. None uses the default URL of the OpenAI client.
+    api_key : str, optional
+        API key for all servers.
+    failure_threshold : int
+        Consecutive failures after which an endpoint is ejected.
+    ejection_seconds : float
+        Duration of the first ejection.
+    slow_factor : float
+        Endpoints slower than this factor times the fastest endpoint are ejected.
+    slow_seconds : float
+        Endpoints with a lower latency are never ejected as slow.
+    first_token_timeout : float
+        Seconds until the first token of a stream, after which it is retried on another endpoint. No limit if 0.
+    token_timeout : float
+        Maximum seconds between the chunks of a stream. No limit if 0.
+    timer : Callable[[], float]
+        Clock used for ejections and latencies (monotonic by default).
+    client_factory : Callable[[Optional[str]], Any], optional
+        Creates the client of an endpoint (`AsyncOpenAI` by default).
+    """
+
+    def __init__(
+        self,
+        base_urls: Sequence[Optional[str]] = LLM_BASE_URLS,
+        api_key: Optional[str] = LLM_API_KEY,
+        failure_threshold: int = LLM_FAILURE_THRESHOLD,
+        ejection_seconds: float = LLM_EJECTION_SECONDS,
+        slow_factor: float = LLM_SLOW_FACTOR,
+        slow_seconds: float = LLM_SLOW_SECONDS,
+        first_token_timeout: float = LLM_FIRST_TOKEN_TIMEOUT,
+        token_timeout: float = LLM_TOKEN_TIMEOUT,
+        timer: Callable[[], float] = time.monotonic,
+        client_factory: Optional[Callable[[Optional[str]], Any]] = None,
+    ):
+        if not base_urls:
+            raise ValueError("At least one LLM endpoint is required.")
+        if client_factory is None:
+
+            def client_factory(base_url):
+                return AsyncOpenAI(api_key=api_key, base_url=base_url)
+
+        self.endpoints = [LLMEndpoint(url, client_factory(url)) for url in base_urls]
+        self.failure_threshold = failure_threshold
+        self.ejection_seconds = ejection_seconds
+        self.slow_factor = slow_factor
+        self.slow_seconds = slow_seconds
+        self.first_token_timeout = first_token_timeout
+        self.token_timeout = token_timeout
+        self.timer = timer
+        self._options: Dict[str, Any] = {}
+        self._turn = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def with_options(self, **options) -> "LLMPool":
+        """A view of the pool which passes `options` to the clients (e.g., timeout, max_retries). The endpoints and their health are shared."""
+        view = copy.copy(self)
+        view._options = {**self._options, **options}
+        view.chat = SimpleNamespace(completions=SimpleNamespace(create=view.create))
+        return view
+
+    def stats(self) -> List[Dict[str, Any]]:
+        now = self.timer()
+        return [endpoint.stats(now) for endpoint in self.endpoints]
+
+    def _choose(self, exclude: List[LLMEndpoint]) -> Optional[LLMEndpoint]:
+        candidates = [e for e in self.endpoints if e not in exclude]
+        if not candidates:
+            return None
+        now = self.timer()
+        healthy = [e for e in candidates if e.ejected_until <= now]
+        # Ties are broken in turns, so that idle endpoints share the load
+        self._turn += 1
+        ordered = healthy or candidates
+        start = self._turn % len(ordered)
+        ordered = ordered[start:] + ordered[:start]
+        return min(ordered, key=lambda e: e.outstanding)
+
+    def _eject(self, endpoint: LLMEndpoint, reason: str):
+        endpoint.ejections += 1
+        duration = self.ejection_seconds * min(2 ** (endpoint.ejections - 1), 16)
+        endpoint.ejected_until = self.timer() + duration
+        endpoint.consecutive_failures = 0
+        logger.warning(
+            "Ejected LLM endpoint %s for %.0fs (%s).",
+            endpoint.base_url,
+            duration,
+            reason,
+        )
+
+    def _record_failure(self, endpoint: LLMEndpoint, error: Exception):
+        endpoint.failures += 1
+        endpoint.consecutive_failures += 1
+        if endpoint.consecutive_failures >= self.failure_threshold:
+            self._eject(endpoint, f"{type(error).__name__}: {error}")
+
+    def _record_latency(self, endpoint: LLMEndpoint, latency: float, kind: str):
+        endpoint.consecutive_failures = 0
+        average = endpoint.latency.get(kind)
+        if average is None:
+            endpoint.latency[kind] = latency
+        else:
+            endpoint.latency[kind] = average + LATENCY_SMOOTHING * (latency - average)
+
+        self._eject_slow(kind)
+
+    def _eject_slow(self, kind: str):
+        now = self.timer()
+        measured = [
+            e for e in self.endpoints if kind in e.latency and e.ejected_until <= now
+        ]
+        if len(measured) < 2:
+            return
+        fastest = min(e.latency[kind] for e in measured)
+        for endpoint in measured:
+            latency = endpoint.latency[kind]
+            if latency > self.slow_seconds and latency > self.slow_factor * fastest:
+                self._eject(endpoint, f"{kind} latency {latency:.2f}s")
+                # Start over once it is back, rather than being ejected right away
+                endpoint.latency.clear()
+
+    async def create(self, on_stall: Optional[Callable[[str], None]] = None, **kwargs):
+        """Create a chat completion on the least busy endpoint. Streams are returned as async iterators of chunks.
+
+        Streams which do not deliver their first token within `first_token_timeout` are retried on another endpoint, and fail with `GenerationStalled` if no endpoint is left. Later, they fail if no chunk arrives within `token_timeout`. `on_stall` is called with a description of each stall.
+        """
+        tried: List[LLMEndpoint] = []
+        while (endpoint := self._choose(tried)) is not None:
+            tried.append(endpoint)
+            client = (
+                endpoint.client.with_options(**self._options)
+                if self._options
+                else endpoint.client
+            )
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            start = self.timer()
+            try:
+                if kwargs.get("stream"):
+                    response = await asyncio.wait_for(
+                        self._open_stream(client, kwargs),
+                        timeout=self.first_token_timeout or None,
+                    )
+                else:
+                    response = await client.chat.completions.create(**kwargs)
+            except Exception as e:
+                endpoint.outstanding -= 1
+                if isinstance(e, asyncio.TimeoutError):
+                    e = GenerationStalled(
+                        f"No first token from {endpoint.base_url} within {self.first_token_timeout}s"
+                    )
+                    if on_stall is not None:
+                        on_stall(str(e))
+                elif not is_endpoint_failure(e):
+                    raise
+                self._record_failure(endpoint, e)
+                if len(tried) == len(self.endpoints):
+                    raise e
+                logger.info(
+                    "LLM endpoint %s failed. Try another one.",
+                    endpoint.base_url,
+                    exc_info=e,
+                )
+                continue
+
+            self._record_latency(
+                endpoint,
+                self.timer() - start,
+                "first_token" if kwargs.get("stream") else "response",
+            )
+            if kwargs.get("stream"):
+                return self._track_stream(endpoint, *response, on_stall)
+            endpoint.outstanding -= 1
+            return response
+
+    async def _open_stream(self, client: Any, kwargs: Dict[str, Any]):
+        """Send the request and read the stream up to the first chunk with content."""
+        stream = await client.chat.completions.create(**kwargs)
+        chunks = stream.__aiter__()
+        buffered = []
+        try:
+            while (chunk := await anext(chunks, None)) is not None:
+                buffered.append(chunk)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    break
+        except BaseException:
+            await close(stream)
+            raise
+        return stream, chunks, buffered
+
+    async def _track_stream(
+        self,
+        endpoint: LLMEndpoint,
+        stream: Any,
+        chunks: AsyncIterator,
+        buffered: List[Any],
+        on_stall: Optional[Callable[[str], None]],
+    ):
+        try:
+            for chunk in buffered:
+                yield chunk
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(
+                        anext(chunks), timeout=self.token_timeout or None
+                    )
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    stall = GenerationStalled(
+                        f"No token from {endpoint.base_url} for {self.token_timeout}s"
+                    )
+                    if on_stall is not None:
+                        on_stall(str(stall))
+                    raise stall from None
+                yield chunk
+        except Exception as e:
+            if is_endpoint_failure(e):
+                self._record_failure(endpoint, e)
+            raise
+        finally:
+            endpoint.outstanding -= 1
+            await close(stream)
+
+
+async def close(stream: Any):
+    if hasattr(stream, "close"):
+        await stream.close()
@@ -0,0 +1,247 @@
+"""
+Local classifier that decides whether a query requires retrieval.
+
+The classifier is a logistic regression on top of sentence embeddings. It is trained on the verdicts of the LLM-based classifier (`HybridPipeline.requires_retrieval`), which are stored as `answer_strategy` of user messages. Messages whose strategy came from elsewhere (this classifier, the answer cache, ...) are left out, see `answer_strategy_source`. At inference time, it answers for queries where it is confident and leaves the remaining ones to the LLM.
+
+Train and evaluate a classifier on the logged messages:
+
+    python -m marcel.experiments.query_classifier train --output query_classifier.json
+
+Evaluate an existing classifier against the current database:
+
+    python -m marcel.experiments.query_classifier evaluate --model query_classifier.json
+"""
+
+import argparse
+import json
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from haystack.components.embedders import SentenceTransformersTextEmbedder
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from marcel.config import setup_logging
+from marcel.database import engine
+from marcel.models import Message
+
+logger = logging.getLogger(__name__)
+
+LABELS = {"retrieve": 1, "generate_with_history": 0}
+
+
+def sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+
+def fit_logistic_regression(
+    X: np.ndarray, y: np.ndarray, l2=1e-3, learning_rate=1.0, epochs=1000
+) -> Tuple[np.ndarray, float]:
+    """Fit a class-balanced, L2-regularized logistic regression with full-batch gradient descent."""
+    n, d = X.shape
+    weights = np.zeros(d)
+    bias = 0.0
+
+    # Most queries require retrieval. Balance classes so that the minority class is not ignored.
+    positive_rate = y.mean()
+    sample_weight = np.where(
+        y == 1, 0.5 / max(positive_rate, 1e-6), 0.5 / max(1 - positive_rate, 1e-6)
+    )
+
+    for _ in range(epochs):
+        error = (sigmoid(X @ weights + bias) - y) * sample_weight
+        weights -= learning_rate * (X.T @ error / n + l2 * weights)
+        bias -= learning_rate * error.mean()
+
+    return weights, float(bias)
+
+
+class QueryClassifier:
+    def __init__(
+        self,
+        weights: np.ndarray,
+        bias: float,
+        threshold=0.9,
+        embedding_model="all-MiniLM-L6-v2",
+        metrics: Optional[Dict] = None,
+    ):
+        self.weights = np.asarray(weights, dtype=np.float32)
+        self.bias = bias
+        self.threshold = threshold
+        self.embedding_model = embedding_model
+        self.metrics = metrics or {}
+        self.embedder = None
+
+    def warm_up(self):
+        # The embedding backend is shared with other embedders of the same model (e.g., the FAQ retriever), so this does not load the model a second time.
+        if self.embedder is None:
+            self.embedder = SentenceTransformersTextEmbedder(
+                model=self.embedding_model, progress_bar=False, local_files_only=True
+            )
+            self.embedder.warm_up()
+
+    def embed(self, text: str) -> np.ndarray:
+        self.warm_up()
+        embedding = np.asarray(self.embedder.run(text=text)["embedding"])
+        return embedding / np.linalg.norm(embedding)
+
+    def predict_proba(self, embeddings: np.ndarray) -> np.ndarray:
+        """Probability that queries require retrieval."""
+        return sigmoid(embeddings @ self.weights + self.bias)
+
+    def classify(self, query: str) -> Optional[bool]:
+        """Returns whether the query requires retrieval, or None if the classifier is not confident."""
+        probability = float(self.predict_proba(self.embed(query)))
+        if max(probability, 1 - probability) < self.threshold:
+            return None
+        return probability >= 0.5
+
+    def save(self, path):
+        with open(path, "w") as fout:
+            json.dump(
+                {
+                    "embedding_model": self.embedding_model,
+                    "threshold": self.threshold,
+                    "weights": self.weights.tolist(),
+                    "bias": self.bias,
+                    "metrics": self.metrics,
+                },
+                fout,
+                indent=2,
+            )
+
+    @classmethod
+    def load(cls, path, threshold: Optional[float] = None) -> "QueryClassifier":
+        with open(path) as fin:
+            data = json.load(fin)
+        return cls(
+            weights=np.array(data["weights"]),
+            bias=data["bias"],
+            threshold=threshold if threshold is not None else data["threshold"],
+            embedding_model=data["embedding_model"],
+            metrics=data.get("metrics"),
+        )
+
+
+def load_training_data(db_session: Session) -> List[Tuple[str, int]]:
+    """Load user messages labeled with the answer strategy the LLM classifier chose. The classifier must not learn from its own verdicts."""
+    rows = db_session.execute(
+        select(Message.content, Message.answer_strategy).where(
+            Message.role == "user",
+            Message.answer_strategy.in_(LABELS.keys()),
+            Message.answer_strategy_source == "llm",
+        )
+    ).all()
+    return [(content, LABELS[answer_strategy]) for content, answer_strategy in rows]
+
+
+def evaluate(
+    classifier: QueryClassifier, queries: List[str], labels: np.ndarray
+) -> Dict:
+    """Measure agreement with the LLM labels and the latency of the local classifier (embedding + prediction)."""
+    classifier.warm_up()  # exclude model loading from latency
+    latencies = []
+    probabilities = []
+    for query in queries:
+        start = time.perf_counter()
+        probabilities.append(float(classifier.predict_proba(classifier.embed(query))))
+        latencies.append(time.perf_counter() - start)
+
+    probabilities = np.array(probabilities)
+    predictions = (probabilities >= 0.5).astype(int)
+    confident = np.maximum(probabilities, 1 - probabilities) >= classifier.threshold
+    latencies_ms = np.array(latencies) * 1000
+
+    return {
+        "n": len(queries),
+        "threshold": classifier.threshold,
+        "agreement": float((predictions == labels).mean()),
+        "coverage": float(confident.mean()),
+        "confident_agreement": float((predictions == labels)[confident].mean())
+        if confident.any()
+        else None,
+        "latency_ms": {
+            "mean": float(latencies_ms.mean()),
+            "p50": float(np.percentile(latencies_ms, 50)),
+            "p95": float(np.percentile(latencies_ms, 95)),
+        },
+    }
+
+
+def train(args):
+    with Session(engine) as session:
+        data = load_training_data(session)
+    if len(data) < 10:
+        raise ValueError(f"Not enough labeled messages to train ({len(data)}).")
+
+    rng = np.random.default_rng(args.seed)
+    rng.shuffle(data)
+    n_test = max(1, int(len(data) * args.test_size))
+    train_data, test_data = data[n_test:], data[:n_test]
+    logger.info("Train: %d | Test: %d", len(train_data), len(test_data))
+
+    classifier = QueryClassifier(
+        weights=np.zeros(0),
+        bias=0,
+        threshold=args.threshold,
+        embedding_model=args.embedding_model,
+    )
+    X = np.stack([classifier.embed(query) for query, _ in train_data])
+    y = np.array([label for _, label in train_data])
+    weights, bias = fit_logistic_regression(X, y)
+    classifier.weights, classifier.bias = weights.astype(np.float32), bias
+
+    classifier.metrics = {
+        "trained_at": datetime.now(timezone.utc).isoformat(),
+        "n_train": len(train_data),
+        "test": evaluate(
+            classifier,
+            [query for query, _ in test_data],
+            np.array([label for _, label in test_data]),
+        ),
+    }
+    logger.info("Metrics: %s", json.dumps(classifier.metrics["test"]))
+    classifier.save(args.output)
+    logger.info("Saved classifier to %s", args.output)
+
+
+def evaluate_saved(args):
+    with Session(engine) as session:
+        data = load_training_data(session)
+
+    classifier = QueryClassifier.load(args.model)
+    metrics = evaluate(
+        classifier,
+        [query for query, _ in data],
+        np.array([label for _, label in data]),
+    )
+    logger.info("Metrics: %s", json.dumps(metrics))
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    train_parser = subparsers.add_parser("train", help="Train and evaluate.")
+    train_parser.add_argument("--output", required=True, help="Path of the model.")
+    train_parser.add_argument("--embedding-model", default="all-MiniLM-L6-v2")
+    train_parser.add_argument("--threshold", type=float, default=0.9)
+    train_parser.add_argument("--test-size", type=float, default=0.2)
+    train_parser.add_argument("--seed", type=int, default=42)
+    train_parser.set_defaults(func=train)
+
+    evaluate_parser = subparsers.add_parser(
+        "evaluate", help="Evaluate a trained model on all labeled messages."
+    )
+    evaluate_parser.add_argument("--model", required=True, help="Path of the model.")
+    evaluate_parser.set_defaults(func=evaluate_saved)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    setup_logging()
+    args = parse_arguments()
+    args.func(args)
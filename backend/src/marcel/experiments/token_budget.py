@@ -0,0 +1,124 @@
+from dataclasses import replace
+from typing import Any, Dict, List, Optional
+
+from haystack import Document, component
+from haystack.dataclasses import ChatMessage
+
+from marcel.config import PROMPT_HISTORY_BUDGET, PROMPT_TOKEN_BUDGET, PROMPT_TOKENIZER
+
+# Tokens of the chat format around each message (role, separators)
+MESSAGE_OVERHEAD = 4
+
+
+@component
+class TokenBudget:
+    """Fits the documents and the history of the RAG prompt into a token budget.
+
+    The template (`[system, *history, user]`) and the query are always kept. The history keeps the most recent messages within `max_history_tokens`, and the documents fill the remaining budget by descending score: a document which does not fit is truncated, or dropped if less than `min_document_tokens` remain for it. Documents keep their order.
+
+    Tokens are counted with a local tokenizer, which approximates the tokenizer of the LLM.
+
+    Parameters
+    ----------
+    max_tokens : int
+        Token budget of the prompt. No limit if 0.
+    max_history_tokens : int
+        Tokens of the budget which the history may use.
+    tokenizer : str
+        Name or path of a Hugging Face tokenizer.
+    min_document_tokens : int
+        Documents are not truncated to fewer content tokens.
+    """
+
+    def __init__(
+        self,
+        max_tokens: int = PROMPT_TOKEN_BUDGET,
+        max_history_tokens: int = PROMPT_HISTORY_BUDGET,
+        tokenizer: str = PROMPT_TOKENIZER,
+        min_document_tokens: int = 64,
+    ):
+        self.max_tokens = max_tokens
+        self.max_history_tokens = max_history_tokens
+        self.tokenizer_name = tokenizer
+        self.min_document_tokens = min_document_tokens
+        self.tokenizer: Any = None
+
+    def warm_up(self):
+        if self.tokenizer is None:
+            from transformers import AutoTokenizer
+
+            self.tokenizer = AutoTokenizer.from_pretrained(
+                self.tokenizer_name, local_files_only=True
+            )
+
+    def _encode(self, text: str) -> Dict[str, Any]:
+        # verbose=False silences warnings about texts longer than the model input
+        return self.tokenizer(
+            text,
+            add_special_tokens=False,
+            return_offsets_mapping=True,
+            verbose=False,
+        )
+
+    def count(self, text: Optional[str]) -> int:
+        return len(self._encode(text)["input_ids"]) if text else 0
+
+    def count_messages(self, messages: List[Dict[str, str]]) -> int:
+        """Tokens of a prompt in the OpenAI message format."""
+        return sum(self.count(m["content"]) + MESSAGE_OVERHEAD for m in messages)
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        offsets = self._encode(text)["offset_mapping"]
+        if len(offsets) <= max_tokens:
+            return text
+        return text[: offsets[max_tokens - 1][1]] if max_tokens > 0 else ""
+
+    @component.output_types(documents=List[Document], template=List[ChatMessage])
+    def run(self, documents: List[Document], template: List[ChatMessage], query: str):
+        if self.max_tokens <= 0:
+            return {"documents": documents, "template": template}
+
+        system, *history, user = template
+        remaining = (
+            self.max_tokens
+            - self.count(system.text)
+            - self.count(user.text)
+            - self.count(query)
+            - 2 * MESSAGE_OVERHEAD
+        )
+
+        # Keep the most recent messages, and drop everything before the first message which does not fit
+        history_budget = min(self.max_history_tokens, remaining)
+        kept_history: List[ChatMessage] = []
+        for message in reversed(history):
+            tokens = self.count(message.text) + MESSAGE_OVERHEAD
+            if tokens > history_budget:
+                break
+            history_budget -= tokens
+            remaining -= tokens
+            kept_history.insert(0, message)
+
+        by_score = sorted(
+            range(len(documents)),
+            key=lambda i: documents[i].score or 0.0,
+            reverse=True,
+        )
+        kept: Dict[int, Document] = {}
+        for i in by_score:
+            document = documents[i]
+            header = self.count(document.meta.get("og:title")) + MESSAGE_OVERHEAD
+            content = self.count(document.content)
+            if header + content <= remaining:
+                kept[i] = document
+                remaining -= header + content
+            elif remaining - header >= self.min_document_tokens:
+                available = remaining - header
+                kept[i] = replace(
+                    document, content=self.truncate(document.content, available)
+                )
+                remaining -= header + available
+            # Otherwise the document is dropped, lower-scored documents may still fit
+        return {
+            "documents": [kept[i] for i in sorted(kept)],
+            "template": [system, *kept_history, user],
+        }
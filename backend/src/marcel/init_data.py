@@ -4,12 +4,23 @@ import logging
 from typing import List
 
 import haystack
+from haystack.components.embedders import SentenceTransformersDocumentEmbedder
 from sqlalchemy import select
 from sqlalchemy.orm import Session
 
-from marcel.config import ADMINS_PATH, DATA_PATH, setup_logging
-from marcel.database import engine
-from marcel.experiments.data_loader import load_documents
+from marcel.config import (
+    ADMINS_PATH,
+    BM25_INDEX_PATH,
+    DATA_PATH,
+    FAQ_INDEX_PATH,
+    FAQ_PATH,
+    setup_logging,
+)
+from marcel.database import engine, upgrade_schema
+from marcel.experiments import bm25_index
+from marcel.experiments.data_loader import load_documents, load_faqs
+from marcel.experiments.embedding_index import EmbeddingIndex
+from marcel.experiments.hybrid_pipeline import FAQ_EMBEDDING_MODEL
 from marcel.models import AdminUser, Document
 
 logger = logging.getLogger(__name__)
@@ -66,10 +77,24 @@ def ingest_admin_users(db_session: Session, admins: List[dict[str, str]]):
 def main(args):
     logger.info(f"Seeding: {args.data}")
 
+    if args.data == "schema":
+        upgrade_schema(engine)
+
     if args.data == "documents":
         documents = load_documents(DATA_PATH)
         with Session(engine) as session:
             ingest_documents(session, documents)
+        bm25_index.build(
+            documents, BM25_INDEX_PATH, bm25_index.file_checksum(DATA_PATH)
+        )
+
+    if args.data == "faqs":
+        # Workers load the persisted embeddings at startup instead of embedding all FAQs themselves
+        index = EmbeddingIndex(FAQ_INDEX_PATH, FAQ_EMBEDDING_MODEL)
+        embedder = SentenceTransformersDocumentEmbedder(
+            model=FAQ_EMBEDDING_MODEL, progress_bar=False, local_files_only=True
+        )
+        index.embed(load_faqs(FAQ_PATH), embedder)
 
     if args.data == "admins":
         try:
@@ -92,7 +117,7 @@ def parse_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "data",
-        choices=["admins", "documents"],
+        choices=["schema", "admins", "documents", "faqs"],
         help="Choose data to seed.",
     )
     return parser.parse_args()
@@ -0,0 +1,90 @@
+import os
+from typing import Dict
+
+from prometheus_client import (
+    REGISTRY,
+    CollectorRegistry,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# Set by `scripts/entrypoint.sh`: each worker writes its samples to this directory, `/metrics` aggregates them
+MULTIPROCESS = "PROMETHEUS_MULTIPROC_DIR" in os.environ
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+ANSWER_BUCKETS = (0.25, 0.5, 1, 2, 3, 5, 7.5, 10, 15, 20, 30, 60, 120)
+
+CLASSIFIER_SECONDS = Histogram(
+    "marcel_classifier_seconds",
+    "Time to decide if a query needs retrieval.",
+    buckets=LATENCY_BUCKETS,
+)
+RETRIEVAL_SECONDS = Histogram(
+    "marcel_retrieval_seconds",
+    "Time of the retrieval pipeline (total) and of its retrievers.",
+    ["branch"],
+    buckets=LATENCY_BUCKETS,
+)
+TIME_TO_FIRST_TOKEN_SECONDS = Histogram(
+    "marcel_time_to_first_token_seconds",
+    "Time from the start of the generation to the first token.",
+    buckets=ANSWER_BUCKETS,
+)
+TOKENS_PER_SECOND = Histogram(
+    "marcel_generation_tokens_per_second",
+    "Streamed tokens per second after the first token.",
+    buckets=(5, 10, 20, 30, 40, 50, 75, 100, 150, 200, 300),
+)
+E2E_SECONDS = Histogram(
+    "marcel_e2e_seconds",
+    "Time from the start of the query to the complete answer.",
+    buckets=ANSWER_BUCKETS,
+)
+DB_POOL_WAIT_SECONDS = Histogram(
+    "marcel_db_pool_wait_seconds",
+    "Time to check out a connection from the database pool.",
+    ["pool"],
+    buckets=LATENCY_BUCKETS,
+)
+STREAMS_IN_FLIGHT = Gauge(
+    "marcel_streams_in_flight",
+    "Answers which are being streamed, per worker.",
+    multiprocess_mode="liveall",
+)
+
+# Stages of the answer timings (see `routes.query`) which are recorded as retrieval branches
+RETRIEVAL_BRANCHES = {
+    "retrieval": "total",
+    "bm25_retriever": "bm25",
+    "faq_retriever": "faq",
+}
+
+
+def observe_answer(timings: Dict[str, float]):
+    """Record the stage timings (in seconds) of a complete answer."""
+    if "classifier" in timings:
+        CLASSIFIER_SECONDS.observe(timings["classifier"])
+    for stage, branch in RETRIEVAL_BRANCHES.items():
+        if stage in timings:
+            RETRIEVAL_SECONDS.labels(branch).observe(timings[stage])
+    if "first_token" in timings:
+        TIME_TO_FIRST_TOKEN_SECONDS.observe(timings["first_token"])
+    if "total" in timings:
+        E2E_SECONDS.observe(timings["total"])
+
+
+def render() -> bytes:
+    """The metrics in the Prometheus text format, of all workers in multiprocess mode."""
+    if not MULTIPROCESS:
+        return generate_latest(REGISTRY)
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
+
+
+def mark_worker_exited():
+    """Drop the live gauges of this worker. Called on shutdown."""
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(os.getpid())
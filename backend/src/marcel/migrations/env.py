@@ -0,0 +1,26 @@
+from alembic import context
+from sqlalchemy import create_engine
+
+from marcel.database import get_database_uri
+from marcel.models import Base
+
+config = context.config
+
+
+def run_migrations(connection):
+    # Batch mode recreates tables for changes which SQLite cannot ALTER
+    context.configure(
+        connection=connection, target_metadata=Base.metadata, render_as_batch=True
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+# `upgrade_schema` passes its connection, the alembic CLI connects to DATABASE_URI
+connection = config.attributes.get("connection")
+if connection is not None:
+    run_migrations(connection)
+else:
+    uri, _ = get_database_uri()
+    with create_engine(uri).connect() as connection:
+        run_migrations(connection)
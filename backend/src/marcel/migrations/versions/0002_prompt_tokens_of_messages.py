@@ -0,0 +1,30 @@
+"""Prompt tokens of messages
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-16 23:20:32.831900
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "0002"
+down_revision: Union[str, Sequence[str], None] = "0001"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    with op.batch_alter_table("message") as batch_op:
+        batch_op.add_column(sa.Column("prompt_tokens", sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table("message") as batch_op:
+        batch_op.drop_column("prompt_tokens")
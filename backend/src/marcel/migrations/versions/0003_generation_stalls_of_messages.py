@@ -0,0 +1,30 @@
+"""Generation stalls of messages
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17 09:12:05.114203
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "0003"
+down_revision: Union[str, Sequence[str], None] = "0002"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    with op.batch_alter_table("message") as batch_op:
+        batch_op.add_column(sa.Column("generation_stalls", sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table("message") as batch_op:
+        batch_op.drop_column("generation_stalls")
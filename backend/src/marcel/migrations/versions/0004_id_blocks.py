@@ -0,0 +1,34 @@
+"""ID blocks for primary keys assigned by the app
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-17 14:02:41.530218
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "0004"
+down_revision: Union[str, Sequence[str], None] = "0003"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Sequences are created on first use, starting after the largest existing ID
+    op.create_table(
+        "id_block",
+        sa.Column("name", sa.String(length=50), nullable=False),
+        sa.Column("next_id", sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint("name"),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table("id_block")
@@ -0,0 +1,76 @@
+"""Unique client ID of users
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-17 16:25:09.671345
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "0005"
+down_revision: Union[str, Sequence[str], None] = "0004"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+user = sa.table(
+    "user",
+    sa.column("id", sa.Integer()),
+    sa.column("client_id", sa.Uuid()),
+    sa.column("consent_given", sa.Boolean()),
+    sa.column("consent_given_at", sa.DateTime()),
+)
+conversation = sa.table(
+    "conversation", sa.column("id", sa.Uuid()), sa.column("user_id", sa.Integer())
+)
+
+
+def merge_duplicate_users():
+    """Concurrent first requests of a client could create several users. The conversations of a client are moved to its first user, which keeps the consent."""
+    connection = op.get_bind()
+    duplicates = connection.execute(
+        sa.select(user.c.client_id)
+        .group_by(user.c.client_id)
+        .having(sa.func.count(user.c.id) > 1)
+    ).scalars()
+    for client_id in duplicates.all():
+        users = connection.execute(
+            sa.select(user.c.id, user.c.consent_given, user.c.consent_given_at)
+            .where(user.c.client_id == client_id)
+            .order_by(user.c.id)
+        ).all()
+        keep, *others = users
+        other_ids = [other.id for other in others]
+        consents = [u.consent_given_at for u in users if u.consent_given]
+        connection.execute(
+            conversation.update()
+            .where(conversation.c.user_id.in_(other_ids))
+            .values(user_id=keep.id)
+        )
+        if consents and not keep.consent_given:
+            connection.execute(
+                user.update()
+                .where(user.c.id == keep.id)
+                .values(
+                    consent_given=True,
+                    consent_given_at=min(
+                        (c for c in consents if c is not None), default=None
+                    ),
+                )
+            )
+        connection.execute(user.delete().where(user.c.id.in_(other_ids)))
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    merge_duplicate_users()
+    op.create_index("ix_user_client_id", "user", ["client_id"], unique=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index("ix_user_client_id", table_name="user")
@@ -0,0 +1,30 @@
+"""Timings of messages
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-17 16:40:21.530417
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "0006"
+down_revision: Union[str, Sequence[str], None] = "0005"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    with op.batch_alter_table("message") as batch_op:
+        batch_op.add_column(sa.Column("timings", sa.JSON(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table("message") as batch_op:
+        batch_op.drop_column("timings")
@@ -0,0 +1,32 @@
+"""Source of the answer strategy of messages
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-17 19:12:47.208331
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "0007"
+down_revision: Union[str, Sequence[str], None] = "0006"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    with op.batch_alter_table("message") as batch_op:
+        batch_op.add_column(
+            sa.Column("answer_strategy_source", sa.String(length=50), nullable=True)
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table("message") as batch_op:
+        batch_op.drop_column("answer_strategy_source")
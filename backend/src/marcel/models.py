@@ -1,9 +1,9 @@
 from datetime import datetime, timezone
-from typing import List, Optional
+from typing import Dict, List, Optional
 from uuid import UUID, uuid4
 
 from pydantic import BaseModel
-from sqlalchemy import CHAR, ForeignKey, String, Text
+from sqlalchemy import CHAR, JSON, ForeignKey, String, Text
 from sqlalchemy.orm import (
     DeclarativeBase,
     Mapped,
@@ -53,7 +53,8 @@ class User(Base):
 
     id: Mapped[int] = mapped_column(primary_key=True, index=True, init=False)
 
-    client_id: Mapped[UUID]
+    # The cookie of the client, see `routes.get_current_user_id`
+    client_id: Mapped[UUID] = mapped_column(index=True, unique=True)
     consent_given: Mapped[bool] = mapped_column(default=False)
     consent_given_at: Mapped[Optional[datetime]] = mapped_column(default=None)
 
@@ -86,8 +87,11 @@ class Conversation(Base):
     user_id: Mapped[int] = mapped_column(ForeignKey("user.id"), init=False)
 
     # Relationships
+    # IDs are reserved in blocks per worker and do not follow the order of the messages
     messages: Mapped[List["Message"]] = relationship(
-        back_populates="conversation", default_factory=list
+        back_populates="conversation",
+        default_factory=list,
+        order_by="(Message.created_at, Message.id)",
     )
     user: Mapped["User"] = relationship(back_populates="conversations", default=None)
 
@@ -108,9 +112,16 @@ class Message(Base):
     non_answer: Mapped[Optional[bool]] = mapped_column(default=None)
     cancelled_answer: Mapped[Optional[bool]] = mapped_column(default=False)
     answer_strategy: Mapped[str50] = mapped_column(default=None, nullable=True)
+    # Where the answer strategy came from: llm, classifier, fallback, cache or coalesced (see HybridPipeline._answer_strategy)
+    answer_strategy_source: Mapped[Optional[str50]] = mapped_column(default=None)
 
     generator_latency: Mapped[Optional[float]] = mapped_column(default=None)
     e2e_latency: Mapped[Optional[float]] = mapped_column(default=None)
+    prompt_tokens: Mapped[Optional[int]] = mapped_column(default=None)
+    # Times the LLM stopped streaming while generating the answer (see marcel.experiments.llm_pool)
+    generation_stalls: Mapped[Optional[int]] = mapped_column(default=None)
+    # Milliseconds spent in each stage of the answer, e.g., {"classifier": 12, "first_token": 480} (see marcel.routes.query)
+    timings: Mapped[Optional[Dict[str, int]]] = mapped_column(JSON, default=None)
 
     feedback: Mapped[Optional[str100]] = mapped_column(default=None)
     created_at: Mapped[datetime] = mapped_column(default_factory=datetime_now_utc)
@@ -161,3 +172,11 @@ class RetrievedDocument(Base):
     )
 
     document: Mapped["Document"] = relationship(default=None)
+
+
+class IdBlock(Base):
+    """The next free ID of a sequence. Workers reserve blocks of IDs from it (see marcel.chat_log.IdAllocator)."""
+
+    __tablename__ = "id_block"
+    name: Mapped[str50] = mapped_column(primary_key=True)
+    next_id: Mapped[int]
@@ -0,0 +1,57 @@
+import logging
+import time
+from typing import Any, Callable, Literal, Optional
+
+from marcel.document_catalog import DocumentCatalog
+
+logger = logging.getLogger(__name__)
+
+
+class PipelineState:
+    """The pipeline of this worker. It is built in the background at startup, so that the app serves health checks (and rejects queries) while warming up.
+
+    Parameters
+    ----------
+    pipeline : Any, optional
+        An already built pipeline. The state is ready right away.
+    documents : DocumentCatalog, optional
+        The documents referenced by answers. Loaded on first use if empty.
+    """
+
+    def __init__(
+        self,
+        pipeline: Optional[Any] = None,
+        documents: Optional[DocumentCatalog] = None,
+    ):
+        self.pipeline = pipeline
+        self.documents = documents if documents is not None else DocumentCatalog()
+        self.phase = "ready" if pipeline is not None else "starting"
+        self.error: Optional[str] = None
+        self.started_at = time.monotonic()
+        self.startup_seconds: Optional[float] = 0.0 if pipeline is not None else None
+
+    @property
+    def status(self) -> Literal["starting", "ready", "failed"]:
+        if self.pipeline is not None:
+            return "ready"
+        if self.error is not None:
+            return "failed"
+        return "starting"
+
+    def update(self, phase: str):
+        logger.info("Startup: %s (%.1fs)", phase, time.monotonic() - self.started_at)
+        self.phase = phase
+
+    def build(self, factory: Callable[..., Any]):
+        """Build the pipeline with `factory`, which reports its progress through the `on_progress` callback."""
+        try:
+            pipeline = factory(on_progress=self.update)
+        except Exception as e:
+            logger.exception("Could not build pipeline")
+            self.error = f"{type(e).__name__}: {e}"
+            self.phase = "failed"
+            return
+
+        self.startup_seconds = time.monotonic() - self.started_at
+        self.pipeline = pipeline
+        self.update("ready")
@@ -1,11 +1,14 @@
+import asyncio
 import json
 import logging
 import time
 import uuid
 from datetime import datetime, timezone
 from enum import Enum
-from typing import Annotated, Any, Dict, List, Literal, Optional
+from typing import Annotated, Any, Dict, List, Literal, Optional, Tuple
 
+import anyio
+from anyio import from_thread
 from fastapi import (
     APIRouter,
     Cookie,
@@ -15,29 +18,64 @@ from fastapi import (
     Response,
 )
 from fastapi import status as http_status
-from fastapi.encoders import jsonable_encoder
 from fastapi.responses import StreamingResponse
 from haystack.dataclasses import Document as HaystackDocument
+from prometheus_client import CONTENT_TYPE_LATEST
 from pydantic import BaseModel, ConfigDict
 from sqlalchemy import select
+from sqlalchemy.dialects import mysql, sqlite
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session, selectinload
 
-from marcel import __git_commit__, __version__
+from marcel import __git_commit__, __version__, metrics
+from marcel.chat_log import (
+    ChatLog,
+    ChatLogWriter,
+    scalar_when_written,
+    scalar_when_written_async,
+)
+from marcel.config import (
+    LLM_MAX_CONCURRENCY,
+    LLM_MAX_QUEUE,
+    SERVER_HISTORY_MESSAGE_CHARS,
+    SERVER_HISTORY_MESSAGES,
+    STREAM_FRAME_INTERVAL,
+    STREAM_FRAME_MAX_BYTES,
+    USER_CACHE_SIZE,
+)
 from marcel.database import get_db, get_db_async
+from marcel.document_catalog import DocumentCatalog
+from marcel.experiments.llm_pool import GenerationStalled
 from marcel.models import (
     Conversation,
-    Document,
     Message,
     RetrievedDocument,
     SourceRead,
     User,
 )
-from marcel.utils.route_preprocessing import detect_non_answer, format_known_links
+from marcel.pipeline_state import PipelineState
+from marcel.utils.admission import AdmissionController, QueueFullError
+from marcel.utils.cache import LRUCache
+from marcel.utils.route_preprocessing import (
+    compact_message,
+    detect_non_answer,
+    format_known_links,
+)
+from marcel.utils.single_flight import StreamAbandoned, Subscription
+from marcel.utils.streaming import coalesce_chunks
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
+# Seconds after which clients should retry while the pipeline warms up
+STARTUP_RETRY_AFTER = 5
+
+# Limits the concurrent LLM generations of this worker
+admission = AdmissionController(LLM_MAX_CONCURRENCY, LLM_MAX_QUEUE)
+
+# User IDs by client ID (cookie) of recent clients. Users are never deleted, so entries do not expire.
+user_ids: LRUCache[uuid.UUID, int] = LRUCache(maxsize=USER_CACHE_SIZE)
+
 
 class StartSessionResponse(BaseModel):
     user_id: uuid.UUID
@@ -56,6 +94,10 @@ class ChatMessage(BaseModel):
 class ChatRequest(BaseModel):
     conversation_id: Optional[uuid.UUID] = None
     messages: List[ChatMessage]
+    # The client only sends the new message and the server loads the history of the conversation
+    server_history: bool = False
+    # The last message of the conversation the client received. The server waits until it is written, which can happen in another worker.
+    last_message_id: Optional[int] = None
 
 
 class MessageRead(BaseModel):
@@ -76,6 +118,8 @@ class ChatResponseChunk(BaseModel):
     assistant_message: Optional[MessageRead] = None
     content: Optional[str] = None
     non_answer: Optional[bool] = None
+    # Sent while the request waits for a free generation slot
+    queue_position: Optional[int] = None
 
     # Once streaming started, the request is marked successfull (i.e., http-status 200).
     # We return the attributes below to alert clients of errors *while* streaming.
@@ -83,6 +127,16 @@ class ChatResponseChunk(BaseModel):
     error_content: Optional[Dict[str, Any]] = None
 
 
+def encode_chunk(chunk: ChatResponseChunk) -> str:
+    """One line of the NDJSON stream. Serialized by the compiled schema of pydantic-core, unset fields are left out."""
+    return chunk.model_dump_json(exclude_unset=True) + "\n"
+
+
+def encode_content(content: str) -> str:
+    """Same as `encode_chunk(ChatResponseChunk(content=content))` for the most frequent chunk, without building a model."""
+    return '{"content":' + json.dumps(content, ensure_ascii=False) + "}\n"
+
+
 class ConversationRead(BaseModel):
     model_config = ConfigDict(from_attributes=True)
 
@@ -113,11 +167,70 @@ class ConversationRatingRequest(BaseModel):
     rating: int
 
 
+class ReadinessResponse(BaseModel):
+    status: Literal["starting", "ready", "failed"]
+    phase: str
+    uptime_seconds: float
+    startup_seconds: Optional[float] = None
+    error: Optional[str] = None
+
+
 @router.get("/status")
-def status():
+def status(request: Request, response: Response):
+    """Liveness: the worker serves requests. Fails only if the pipeline could not be built, so that the container gets restarted."""
+    if request.state.pipeline_state.status == "failed":
+        response.status_code = http_status.HTTP_503_SERVICE_UNAVAILABLE
+        return {"status": "failed"}
     return {"status": "ok"}
 
 
+@router.get("/ready", response_model=ReadinessResponse)
+def ready(request: Request, response: Response) -> ReadinessResponse:
+    """Readiness: the pipeline is built and queries can be answered. Reports the startup phase otherwise."""
+    state: PipelineState = request.state.pipeline_state
+    if state.status != "ready":
+        response.status_code = http_status.HTTP_503_SERVICE_UNAVAILABLE
+    return ReadinessResponse(
+        status=state.status,
+        phase=state.phase,
+        uptime_seconds=time.monotonic() - state.started_at,
+        startup_seconds=state.startup_seconds,
+        error=state.error,
+    )
+
+
+@router.get("/metrics", include_in_schema=False)
+def get_metrics() -> Response:
+    """Metrics in the Prometheus text format, of all workers (see marcel.metrics)."""
+    return Response(metrics.render(), media_type=CONTENT_TYPE_LATEST)
+
+
+def get_admission() -> AdmissionController:
+    return admission
+
+
+def get_log_writer(request: Request) -> ChatLogWriter:
+    return request.state.log_writer
+
+
+def get_document_catalog(request: Request) -> DocumentCatalog:
+    return request.state.pipeline_state.documents
+
+
+def get_pipeline(request: Request):
+    """The pipeline of this worker. Rejects the request right away while it is not ready, instead of waiting for the startup."""
+    state: PipelineState = request.state.pipeline_state
+    if state.pipeline is None:
+        raise HTTPException(
+            status_code=http_status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f"Service is starting ({state.phase}). Please try again shortly."
+            if state.status == "starting"
+            else "Service unavailable.",
+            headers={"Retry-After": str(STARTUP_RETRY_AFTER)},
+        )
+    return state.pipeline
+
+
 class VersionResponse(BaseModel):
     version: str
     commit: str
@@ -147,29 +260,59 @@ def start_session(
     return StartSessionResponse(user_id=user_id)
 
 
-def get_current_user(
+def insert_user(dialect: str, client_id: uuid.UUID):
+    """Insert a user unless one with the client ID exists. Concurrent first requests of a client create a single user."""
+    if dialect == "mysql":
+        statement = mysql.insert(User).values(client_id=client_id)
+        return statement.on_duplicate_key_update(client_id=statement.inserted.client_id)
+    return (
+        sqlite.insert(User)
+        .values(client_id=client_id)
+        .on_conflict_do_nothing(index_elements=["client_id"])
+    )
+
+
+def get_current_user_id(
     user_id: Annotated[uuid.UUID, Cookie()], db: Session = Depends(get_db)
-) -> User:
-    user = db.query(User).filter(User.client_id == user_id).one_or_none()
-    if not user:
-        user = User(client_id=user_id)
-        db.add(user)
+) -> int:
+    """The ID of the user with the cookie. Created on the first request of a client."""
+    cached = user_ids.get(user_id)
+    if cached is not None:
+        return cached
+
+    select_id = select(User.id).where(User.client_id == user_id)
+    db_user_id = db.scalar(select_id)
+    if db_user_id is None:
+        db.execute(insert_user(db.get_bind().dialect.name, user_id))
         db.commit()
-        db.refresh(user)
-    return user
+        db_user_id = db.scalar(select_id)
+    user_ids.put(user_id, db_user_id)
+    return db_user_id
 
 
-async def get_current_user_async(
+async def get_current_user_id_async(
     user_id: Annotated[uuid.UUID, Cookie()], db: AsyncSession = Depends(get_db_async)
-) -> User:
-    result = await db.execute(select(User).filter(User.client_id == user_id))
-    user = result.scalar_one_or_none()
-    if not user:
-        user = User(client_id=user_id)
-        db.add(user)
+) -> int:
+    """See `get_current_user_id`."""
+    cached = user_ids.get(user_id)
+    if cached is not None:
+        return cached
+
+    select_id = select(User.id).where(User.client_id == user_id)
+    db_user_id = await db.scalar(select_id)
+    if db_user_id is None:
+        await db.execute(insert_user(db.get_bind().dialect.name, user_id))
         await db.commit()
-        await db.refresh(user)
-    return user
+        db_user_id = await db.scalar(select_id)
+    user_ids.put(user_id, db_user_id)
+    return db_user_id
+
+
+def get_current_user(
+    user_id: Annotated[uuid.UUID, Cookie()], db: Session = Depends(get_db)
+) -> User:
+    """The user with the cookie, for routes which change it. Other routes only need `get_current_user_id`."""
+    return db.get_one(User, get_current_user_id(user_id, db))
 
 
 @router.put("/me/consent")
@@ -184,88 +327,223 @@ def put_consent(user: User = Depends(get_current_user), db: Session = Depends(ge
 @router.post("/query", response_model=ChatResponseChunk)
 async def query(
     chat_request: ChatRequest,
-    request: Request,
-    user: User = Depends(get_current_user_async),
+    pipeline: Any = Depends(get_pipeline),
+    user_id: int = Depends(get_current_user_id_async),
     db: AsyncSession = Depends(get_db_async),
+    admission: AdmissionController = Depends(get_admission),
+    log_writer: ChatLogWriter = Depends(get_log_writer),
+    catalog: DocumentCatalog = Depends(get_document_catalog),
 ):
     if not chat_request.messages:
         raise HTTPException(status_code=422, detail="No messages provided.")
+    if chat_request.server_history and len(chat_request.messages) > 1:
+        raise HTTPException(
+            status_code=422,
+            detail="Only send the new message if the server loads the history.",
+        )
 
+    # Seconds spent in each stage, stored with the answer together with the stages of the pipeline
+    timings: Dict[str, float] = {}
     if chat_request.conversation_id:
+        start = time.perf_counter()
+        if log_writer.is_pending(
+            conversation_id=chat_request.conversation_id,
+            message_id=chat_request.last_message_id,
+        ):
+            # The previous answer of the conversation is not written yet
+            await log_writer.flush()
+        elif chat_request.last_message_id is not None:
+            # Another worker might still write it
+            await scalar_when_written_async(
+                db, select(Message.id).where(Message.id == chat_request.last_message_id)
+            )
         # verify conversation existence and ownership before proceeding
-        await get_conversation_db_async(db, chat_request.conversation_id, user)
+        await verify_conversation_async(db, chat_request.conversation_id, user_id)
+        timings["conversation"] = time.perf_counter() - start
 
     e2e_start = time.time()
     query = chat_request.messages[-1].content
-    history = [message for message in chat_request.messages[:-1]]
-    response = await request.state.pipeline.run_async(query, history)
-
-    def encode_chunk(chunk: ChatResponseChunk):
-        # Each streaming chunk contains different payload.
-        # exclude_unset=True keeps the returned json clean
-        return json.dumps(jsonable_encoder(chunk, exclude_unset=True)) + "\n"
+    if chat_request.server_history and chat_request.conversation_id:
+        start = time.perf_counter()
+        history = await load_history_async(
+            db,
+            chat_request.conversation_id,
+            max_messages=SERVER_HISTORY_MESSAGES,
+            max_chars=SERVER_HISTORY_MESSAGE_CHARS,
+        )
+        timings["history"] = time.perf_counter() - start
+    else:
+        history = [message for message in chat_request.messages[:-1]]
+    start = time.perf_counter()
+    response = await pipeline.run_async(query, history)
+    timings["pipeline"] = time.perf_counter() - start
+
+    async def log_answer(
+        generated_answer: str, generator_latency: float, cancelled: bool
+    ) -> Tuple[Message, Message, List[Tuple[int, SourceRead]], str]:
+        """Queue the messages of the request for writing. Returns them with the sources and the formatted links of the answer."""
+        links = {}
+        for doc in response["documents"]:
+            links.update(doc.meta.get("links", {}))
+        formatted_answer, formatted_links = format_known_links(generated_answer, links)
+        start = time.perf_counter()
+        sources = await lookup_sources(catalog, db, response["documents"])
+        timings["sources"] = time.perf_counter() - start
+        # IDs are known before the messages are written, which happens in the background (see marcel.chat_log)
+        start = time.perf_counter()
+        message_ids = await log_writer.message_ids.allocate(2)
+        timings["message_ids"] = time.perf_counter() - start
+        conversation_id = chat_request.conversation_id or uuid.uuid4()
+
+        e2e_end = time.time()
+        timings["total"] = e2e_end - e2e_start
+        answer_timings = {**response.get("timings", {}), **timings}
+        if not cancelled:
+            # The pipeline stages of a coalesced request were recorded by the request which ran the pipeline
+            metrics.observe_answer(
+                timings if response.get("coalesced") else answer_timings
+            )
+        user_log = Message(
+            role="user",
+            content=query,
+            answer_strategy=response["answer_strategy"],
+            answer_strategy_source=response.get("answer_strategy_source"),
+        )
+        assistant_log = Message(
+            role="assistant",
+            content=formatted_answer,
+            documents=[RetrievedDocument(score=source.score) for _, source in sources],
+            non_answer=detect_non_answer(formatted_answer),
+            e2e_latency=e2e_end - e2e_start,
+            generator_latency=generator_latency,
+            prompt_tokens=response.get("prompt_tokens"),
+            generation_stalls=len(response.get("stalls", [])),
+            # Incomplete answers are left out of the history
+            cancelled_answer=cancelled,
+            # The pipeline keeps adding to its timings while the answer is generated (e.g., `llm_request`)
+            timings=compact_timings(answer_timings),
+        )
+        user_log.id, assistant_log.id = message_ids
+        for message in [user_log, assistant_log]:
+            message.conversation_id = conversation_id
+        for retrieved_document, (document_id, _) in zip(
+            assistant_log.documents, sources
+        ):
+            retrieved_document.message_id = assistant_log.id
+            retrieved_document.document_id = document_id
+        await log_writer.submit(
+            ChatLog(
+                conversation_id=conversation_id,
+                user_id=user_id,
+                new_conversation=chat_request.conversation_id is None,
+                messages=[user_log, assistant_log],
+                created_at=datetime.now(timezone.utc),
+            )
+        )
+        return user_log, assistant_log, sources, formatted_links
 
     async def response_generator():
+        holds_slot = False
+        generating = False
+        # Whether the client left while the answer was generated
+        disconnected = False
+        generated_answer = ""
+        generator_start = time.time()
+        metrics.STREAMS_IN_FLIGHT.inc()
         try:
-            generated_answer = ""
+            stream = response["generated_answer"]
+            start = time.perf_counter()
+            if isinstance(stream, Subscription):
+                # The slot belongs to the shared generation: it is taken by the request which starts it (the one which ran the pipeline, or a coalesced request if that one left before), and given back once the generation ended
+                if await stream.wait_for_turn():
+                    async for position in admission.admit():
+                        yield encode_chunk(ChatResponseChunk(queue_position=position))
+                    broadcast = stream.broadcast
+                    broadcast.add_done_callback(
+                        lambda: admission.release(
+                            cancelled=isinstance(broadcast.error, StreamAbandoned)
+                        )
+                    )
+                    broadcast.start()
+                    timings["admission"] = time.perf_counter() - start
+            # Cached answers do not need the LLM, coalesced requests share the generation of another request
+            elif not response.get("answer_cache_hit") and not response.get("coalesced"):
+                async for position in admission.admit():
+                    yield encode_chunk(ChatResponseChunk(queue_position=position))
+                holds_slot = True
+                timings["admission"] = time.perf_counter() - start
+
             generator_start = time.time()
-            async for chunk in response["generated_answer"]:
-                generated_answer += chunk
-                yield encode_chunk(ChatResponseChunk(content=chunk))
+            stalled = False
+            generating = True
+            try:
+                async for chunk in coalesce_chunks(
+                    response["generated_answer"],
+                    interval=STREAM_FRAME_INTERVAL,
+                    max_bytes=STREAM_FRAME_MAX_BYTES,
+                ):
+                    if not generated_answer:
+                        timings["first_token"] = time.time() - generator_start
+                    generated_answer += chunk
+                    yield encode_content(chunk)
+            except GenerationStalled as e:
+                # The partial answer is stored, so that the stall is recorded with the message
+                logger.warning(
+                    "Generation stalled (%s). Request: %s", e, repr(chat_request)
+                )
+                stalled = True
+            generating = False
             generator_end = time.time()
-
-            links = {}
-            for doc in response["documents"]:
-                links.update(doc.meta.get("links", {}))
-            formatted_answer, formatted_links = format_known_links(
-                generated_answer, links
+            timings["generation"] = generator_end - generator_start
+            # Cached and shared answers did not take a slot of their own
+            if holds_slot:
+                admission.release()
+                holds_slot = False
+
+            # Queued before the final chunk, so that the log is kept if the client leaves right after it
+            user_log, assistant_log, sources, formatted_links = await log_answer(
+                generated_answer, generator_end - generator_start, cancelled=stalled
             )
-            non_answer_verdict = detect_non_answer(formatted_answer)
-            if formatted_links.strip():
-                yield encode_chunk(ChatResponseChunk(content=f"\n\n{formatted_links}"))
-            yield encode_chunk(ChatResponseChunk(non_answer=non_answer_verdict))
 
-            if chat_request.conversation_id:
-                conversation = await get_conversation_db_async(
-                    db, chat_request.conversation_id, user
+            if stalled:
+                yield encode_chunk(
+                    ChatResponseChunk(
+                        error_status_code=http_status.HTTP_504_GATEWAY_TIMEOUT,
+                        error_content={
+                            "detail": "The answer took too long. Please retry."
+                        },
+                    )
                 )
-            else:
-                conversation = Conversation(user=user)
-
-            e2e_end = time.time()
-            user_log = Message(
-                role="user",
-                content=query,
-                answer_strategy=response["answer_strategy"],
-            )
-            assistant_log = Message(
-                role="assistant",
-                content=formatted_answer,
-                documents=await build_retrieved_docs(db, response["documents"]),
-                non_answer=non_answer_verdict,
-                e2e_latency=e2e_end - e2e_start,
-                generator_latency=generator_end - generator_start,
-            )
-            conversation.messages.append(user_log)
-            conversation.messages.append(assistant_log)
-            conversation.updated_at = datetime.now(timezone.utc)
-            db.add(conversation)
-            await db.flush()  # ensure IDs are populated
+                return
 
+            if formatted_links.strip():
+                yield encode_chunk(ChatResponseChunk(content=f"\n\n{formatted_links}"))
+            yield encode_chunk(ChatResponseChunk(non_answer=assistant_log.non_answer))
             yield encode_chunk(
                 ChatResponseChunk(
-                    conversation_id=conversation.id,
-                    user_message=MessageRead.model_validate(user_log),
-                    assistant_message=MessageRead.model_validate(assistant_log),
+                    conversation_id=user_log.conversation_id,
+                    user_message=message_read(user_log, sources=[]),
+                    assistant_message=message_read(
+                        assistant_log, sources=[source for _, source in sources]
+                    ),
                 )
             )
-            await db.commit()
+        except (asyncio.CancelledError, GeneratorExit):
+            # The client disconnected: Starlette cancels the response (or closes the generator with newer ASGI servers)
+            disconnected = generating
+            raise
         except Exception as e:
-            logger.exception("Streaming failed. Request: %s", repr(chat_request))
+            if isinstance(e, QueueFullError):
+                logger.warning("Generation queue is full. Request rejected.")
+            else:
+                logger.exception("Streaming failed. Request: %s", repr(chat_request))
 
             if isinstance(e, HTTPException):
                 status_code = e.status_code
                 content = {"detail": e.detail}
+            elif isinstance(e, QueueFullError):
+                status_code = http_status.HTTP_503_SERVICE_UNAVAILABLE
+                content = {"detail": "Too many requests right now. Please retry."}
             else:
                 status_code = http_status.HTTP_500_INTERNAL_SERVER_ERROR
                 content = {"detail": "Could not generate response. Please retry."}
@@ -277,73 +555,144 @@ async def query(
                 )
             )
         finally:
-            # Ensure session is properly closed once the generator ends. The call to db.rollback() does nothing if the transaction was already committed. It added as we can't be certain whether or not the current session was dirty (e.g., when catching an exception).
-            await db.rollback()
-            await db.close()
+            metrics.STREAMS_IN_FLIGHT.dec()
+            # Cleanup must not be interrupted, the task is cancelled if the client left
+            with anyio.CancelScope(shield=True):
+                if holds_slot:
+                    admission.release(cancelled=disconnected)
+                # Leave the stream if it was not read until the end, which closes the LLM stream (coalesced requests keep generating for the others)
+                await response["generated_answer"].aclose()
+                if disconnected:
+                    logger.info(
+                        "Client disconnected after %d characters of the answer",
+                        len(generated_answer),
+                    )
+                    try:
+                        await log_answer(
+                            generated_answer,
+                            time.time() - generator_start,
+                            cancelled=True,
+                        )
+                    except Exception:
+                        logger.exception(
+                            "Could not log cancelled answer. Request: %s",
+                            repr(chat_request),
+                        )
+                # Ensure session is properly closed once the generator ends. It only reads (the messages are written by the log writer), closing it ends its transaction.
+                await db.close()
 
     return StreamingResponse(response_generator())
 
 
-async def build_retrieved_docs(db: AsyncSession, documents: List[HaystackDocument]):
-    fingerprints = [doc.meta["fingerprint"] for doc in documents]
-    result = await db.execute(
-        select(Document).where(Document.fingerprint.in_(fingerprints))
+def compact_timings(timings: Dict[str, float]) -> Dict[str, int]:
+    """Timings in whole milliseconds, as stored with messages."""
+    return {stage: round(seconds * 1000) for stage, seconds in timings.items()}
+
+
+async def lookup_sources(
+    catalog: DocumentCatalog, db: AsyncSession, documents: List[HaystackDocument]
+) -> List[Tuple[int, SourceRead]]:
+    """The database ID and source of each retrieved document. The database is only queried for documents which are not in the catalog."""
+    fingerprint_to_doc = await catalog.resolve(
+        (doc.meta["fingerprint"] for doc in documents), db
     )
-    fingerprint_to_doc = {doc.fingerprint: doc for doc in result.scalars().all()}
-    retrieved_docs = [
-        RetrievedDocument(
-            document=fingerprint_to_doc[doc.meta["fingerprint"]],
+    sources = []
+    for doc in documents:
+        ref = fingerprint_to_doc[doc.meta["fingerprint"]]
+        source = SourceRead(
+            url=ref.url,
             score=float(doc.score) if doc.score else 0,
+            title=ref.title,
+            favicon=ref.favicon,
+        )
+        sources.append((ref.id, source))
+    return sources
+
+
+def message_read(message: Message, sources: List[SourceRead]) -> MessageRead:
+    """A message which is not written to the database yet."""
+    return MessageRead(
+        id=message.id,
+        role=message.role,
+        content=message.content,
+        non_answer=message.non_answer,
+        feedback=message.feedback,
+        created_at=message.created_at,
+        sources=sources,
+    )
+
+
+async def load_history_async(
+    db: AsyncSession,
+    conversation_id: uuid.UUID,
+    max_messages: int,
+    max_chars: int,
+) -> List[ChatMessage]:
+    """The most recent messages of a conversation, compacted for the prompt. Answers which were cancelled are skipped."""
+    result = await db.execute(
+        select(Message.role, Message.content)
+        .where(
+            Message.conversation_id == conversation_id,
+            Message.cancelled_answer.is_not(True),
         )
-        for doc in documents
+        .order_by(Message.created_at.desc(), Message.id.desc())
+        .limit(max_messages)
+    )
+    messages = [
+        ChatMessage(role=role, content=compact_message(content, max_chars))
+        for role, content in reversed(result.all())
     ]
-    return retrieved_docs
+    # Start the history with a question rather than an answer without its question
+    while messages and messages[0].role != ChatRole.USER:
+        messages.pop(0)
+    return messages
 
 
-async def get_conversation_db_async(
-    db: AsyncSession, conversation_id: uuid.UUID, user: User
+async def verify_conversation_async(
+    db: AsyncSession, conversation_id: uuid.UUID, user_id: int
 ):
-    result = await db.execute(
-        select(Conversation)
-        .where(Conversation.id == conversation_id)
-        .options(selectinload(Conversation.messages))
+    """Raise unless the conversation exists and belongs to the user."""
+    owner_id = await scalar_when_written_async(
+        db, select(Conversation.user_id).where(Conversation.id == conversation_id)
     )
-    conversation = result.scalar_one_or_none()
 
-    if not conversation:
+    if owner_id is None:
         raise HTTPException(
             status_code=http_status.HTTP_404_NOT_FOUND,
             detail="Conversation not found.",
         )
 
-    if conversation.user_id != user.id:
+    if owner_id != user_id:
         raise HTTPException(
             status_code=http_status.HTTP_403_FORBIDDEN,
             detail="You do not have access to this conversation.",
         )
 
-    return conversation
-
 
 @router.post("/feedback")
 def submit_feedback(
     feedback_request: MessageFeedbackRequest,
-    user: User = Depends(get_current_user),
+    user_id: int = Depends(get_current_user_id),
     db: Session = Depends(get_db),
+    log_writer: ChatLogWriter = Depends(get_log_writer),
 ):
-    message = (
-        db.query(Message)
-        .filter(
+    if log_writer.is_pending(message_id=feedback_request.message_id):
+        # Feedback right after the answer: wait until the message is written
+        from_thread.run(log_writer.flush)
+
+    # Another worker might not have written the message yet
+    message = scalar_when_written(
+        db,
+        select(Message).where(
             Message.id == feedback_request.message_id,
             Message.role == "assistant",
-        )
-        .one_or_none()
+        ),
     )
 
     if not message:
         raise HTTPException(status_code=404, detail="Message not found")
 
-    if message.conversation.user_id != user.id:
+    if message.conversation.user_id != user_id:
         raise HTTPException(
             status_code=http_status.HTTP_403_FORBIDDEN,
             detail="You do not have access to this conversation.",
@@ -358,12 +707,13 @@ def submit_feedback(
 @router.post("/rating")
 def submit_rating_feedback(
     feedback_request: ConversationRatingRequest,
-    user: User = Depends(get_current_user),
+    user_id: int = Depends(get_current_user_id),
     db: Session = Depends(get_db),
 ):
-    conversation = db.execute(
-        select(Conversation).where(Conversation.id == feedback_request.conversation_id)
-    ).scalar_one_or_none()
+    conversation = scalar_when_written(
+        db,
+        select(Conversation).where(Conversation.id == feedback_request.conversation_id),
+    )
 
     if not conversation:
         raise HTTPException(
@@ -371,7 +721,7 @@ def submit_rating_feedback(
             detail="Conversation not found.",
         )
 
-    if conversation.user_id != user.id:
+    if conversation.user_id != user_id:
         raise HTTPException(
             status_code=http_status.HTTP_403_FORBIDDEN,
             detail="You do not have access to this conversation.",
@@ -387,7 +737,7 @@ def submit_rating_feedback(
 def get_conversation(
     conversation_id: uuid.UUID,
     db: Session = Depends(get_db),
-    user: User = Depends(get_current_user),
+    user_id: int = Depends(get_current_user_id),
 ):
     conversation = db.execute(
         select(Conversation)
@@ -405,7 +755,7 @@ def get_conversation(
             detail="Conversation not found.",
         )
 
-    if conversation.user_id != user.id:
+    if conversation.user_id != user_id:
         raise HTTPException(
             status_code=http_status.HTTP_403_FORBIDDEN,
             detail="You do not have access to this conversation.",
@@ -420,7 +770,7 @@ def get_conversation(
 def hide_conversation(
     conversation_id: uuid.UUID,
     db: Session = Depends(get_db),
-    user: User = Depends(get_current_user),
+    user_id: int = Depends(get_current_user_id),
 ):
     conversation = db.execute(
         select(Conversation).where(Conversation.id == conversation_id)
@@ -432,7 +782,7 @@ def hide_conversation(
             detail="Conversation not found.",
         )
 
-    if conversation.user_id != user.id:
+    if conversation.user_id != user_id:
         raise HTTPException(
             status_code=http_status.HTTP_403_FORBIDDEN,
             detail="You do not have access to this conversation.",
@@ -446,12 +796,12 @@ def hide_conversation(
 @router.get("/conversations", response_model=List[ConversationListItem])
 def get_conversations(
     db: Session = Depends(get_db),
-    user: User = Depends(get_current_user),
+    user_id: int = Depends(get_current_user_id),
 ):
     result = (
         db.execute(
             select(Conversation)
-            .where(Conversation.user_id == user.id, Conversation.visible)
+            .where(Conversation.user_id == user_id, Conversation.visible)
             .options(selectinload(Conversation.messages))
             .order_by(Conversation.updated_at.desc())
         )
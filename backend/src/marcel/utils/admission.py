@@ -0,0 +1,133 @@
+import asyncio
+import time
+from collections import deque
+from typing import AsyncIterator, Callable, Deque, Dict, Union
+
+
+class QueueFullError(Exception):
+    """The wait queue of an `AdmissionController` is full."""
+
+
+class AdmissionController:
+    """Limits the number of concurrent LLM generations of a worker. Requests beyond the limit wait in a bounded FIFO queue, further requests are rejected.
+
+    The controller lives on the event loop of the worker and is not thread-safe.
+
+    Parameters
+    ----------
+    max_concurrent : int
+        Maximum number of concurrent generations. No limit if 0.
+    max_queue : int
+        Maximum number of waiting requests.
+    status_interval : float
+        Seconds between checks of the queue position while waiting.
+    timer : Callable[[], float]
+        Clock used for wait times (monotonic by default).
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int,
+        max_queue: int,
+        status_interval: float = 1.0,
+        timer: Callable[[], float] = time.monotonic,
+    ):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.status_interval = status_interval
+        self.timer = timer
+        self.active = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.cancelled = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self._waiting: Deque[asyncio.Future] = deque()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiting)
+
+    def _admit(self, wait_seconds: float):
+        self.admitted += 1
+        self.total_wait_seconds += wait_seconds
+        self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+
+    async def admit(self) -> AsyncIterator[int]:
+        """Wait for a free slot. Yields the (1-based) queue position when waiting starts and whenever it changed.
+
+        The slot is held once the iteration ends, and must be given back with `release`. Closing the iterator while waiting leaves the queue.
+
+        Raises
+        ------
+        QueueFullError
+            If the queue is full.
+        """
+        if self.max_concurrent <= 0:
+            self._admit(0.0)
+            return
+        if self.active < self.max_concurrent and not self._waiting:
+            self.active += 1
+            self._admit(0.0)
+            return
+        if len(self._waiting) >= self.max_queue:
+            self.rejected += 1
+            raise QueueFullError()
+
+        slot = asyncio.get_running_loop().create_future()
+        self._waiting.append(slot)
+        start = self.timer()
+        try:
+            position = None
+            while not slot.done():
+                current = self._waiting.index(slot) + 1
+                if current != position:
+                    position = current
+                    yield position
+                try:
+                    await asyncio.wait_for(
+                        asyncio.shield(slot), timeout=self.status_interval
+                    )
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            # Leave the queue, or pass on a slot which was handed over meanwhile
+            if slot.done():
+                self.release()
+            else:
+                self._waiting.remove(slot)
+                slot.cancel()
+            raise
+        self._admit(self.timer() - start)
+
+    def release(self, cancelled: bool = False):
+        """Give back a slot. It is handed over to the first waiting request.
+
+        Parameters
+        ----------
+        cancelled : bool
+            Whether the generation was stopped before the answer was complete, because the client left.
+        """
+        if cancelled:
+            self.cancelled += 1
+        if self.max_concurrent <= 0:
+            return
+        if self._waiting:
+            self._waiting.popleft().set_result(None)
+        else:
+            self.active -= 1
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        return {
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "active": self.active,
+            "queue_depth": self.queue_depth,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "cancelled": self.cancelled,
+            "mean_wait_seconds": self.total_wait_seconds / self.admitted
+            if self.admitted
+            else 0.0,
+            "max_wait_seconds": self.max_wait_seconds,
+        }
@@ -50,6 +50,34 @@ def format_known_links(text: str, links: Dict[int, str]) -> Tuple[str, str]:
     return f"{text}\n\n{formatted_links}".strip(), formatted_links
 
 
+_link_definition_pattern = re.compile(r"^\[\d+\]: \S+$", re.MULTILINE)
+_reference_link_pattern = re.compile(r"\[([^\[\]]*)\]\[\d+\]")
+
+
+def compact_message(text: str, max_chars: int) -> str:
+    """Compacts a stored message for the conversation history of a prompt.
+
+    Drops the link definitions appended by `format_known_links`, replaces reference-style links by their description and truncates the text to `max_chars`.
+
+    Parameters
+    ----------
+    text : str
+        The message content.
+    max_chars : int
+        Maximum length of the compacted message.
+
+    Returns
+    -------
+    str
+        The compacted message.
+    """
+    text = _link_definition_pattern.sub("", text)
+    text = _reference_link_pattern.sub(r"\1", text).strip()
+    if len(text) > max_chars:
+        text = text[:max_chars].rstrip() + " ..."
+    return text
+
+
 _non_answer_pattern = re.compile(
     r"(I (do not|don't) have (any )?(knowledge|information)|"
     r"The text doesn't provide information|"
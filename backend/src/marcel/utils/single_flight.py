@@ -0,0 +1,214 @@
+import asyncio
+from typing import (
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Generic,
+    Hashable,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class StreamAbandoned(Exception):
+    """All subscribers left a `Broadcast` before its stream was complete."""
+
+
+class Broadcast:
+    """Fans out one stream of chunks to several subscribers. Each subscriber receives all chunks from the start, also if it subscribes late.
+
+    The source is consumed by a background task which starts once the leading subscriber starts reading (or calls `start`). If the leader leaves before, the first remaining subscriber becomes the leader (see `Subscription.wait_for_turn`). The task continues as long as anybody subscribes, and is cancelled once all subscribers left.
+
+    Parameters
+    ----------
+    source : AsyncIterator[str]
+        The stream to fan out.
+    on_done : Callable[[], None], optional
+        Called once the stream finished, failed or was abandoned by all subscribers.
+    """
+
+    def __init__(
+        self,
+        source: AsyncIterator[str],
+        on_done: Optional[Callable[[], None]] = None,
+    ):
+        self.source = source
+        self.on_done = on_done
+        self.chunks: List[str] = []
+        self.error: Optional[BaseException] = None
+        self.done = False
+        self._subscriptions: List["Subscription"] = []
+        self._done_callbacks: List[Callable[[], None]] = []
+        self._changed = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def subscribers(self) -> int:
+        return len(self._subscriptions)
+
+    @property
+    def started(self) -> bool:
+        return self._task is not None
+
+    def subscribe(self, leader=False) -> "Subscription":
+        subscription = Subscription(self, leader)
+        self._subscriptions.append(subscription)
+        return subscription
+
+    def start(self):
+        if self._task is None and not self.done:
+            self._task = asyncio.create_task(self._pump())
+            self._notify()
+
+    def add_done_callback(self, fn: Callable[[], None]):
+        """Call `fn` once the stream finished, failed or was abandoned, e.g., to give back what the generation holds."""
+        if self.done:
+            fn()
+        else:
+            self._done_callbacks.append(fn)
+
+    def _notify(self):
+        # Wake up all current waiters, later waiters wait for the next change
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _finish(self):
+        if not self.done:
+            self.done = True
+            self._notify()
+            if self.on_done is not None:
+                self.on_done()
+            for fn in self._done_callbacks:
+                fn()
+
+    async def _pump(self):
+        try:
+            async for chunk in self.source:
+                self.chunks.append(chunk)
+                self._notify()
+        except asyncio.CancelledError:
+            self.error = StreamAbandoned()
+            raise
+        except Exception as e:
+            self.error = e
+        finally:
+            self._finish()
+
+    def _unsubscribe(self, subscription: "Subscription"):
+        self._subscriptions.remove(subscription)
+        if self.done:
+            return
+        if not self._subscriptions:
+            if self._task is not None:
+                self._task.cancel()
+            else:
+                self.error = StreamAbandoned()
+                self._finish()
+        elif subscription.leader and self._task is None:
+            # The followers must not wait for a leader which is gone. The next one takes over (see `Subscription.wait_for_turn`).
+            self._subscriptions[0].leader = True
+            self._notify()
+
+
+class Subscription:
+    """Reads the chunks of a `Broadcast`. Must be closed with `aclose` if it is not read until the end."""
+
+    def __init__(self, broadcast: Broadcast, leader: bool):
+        self.broadcast = broadcast
+        self.leader = leader
+        self.position = 0
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> str:
+        broadcast = self.broadcast
+        if self.closed:
+            raise StopAsyncIteration
+        while True:
+            if self.leader:
+                broadcast.start()
+            if self.position < len(broadcast.chunks):
+                self.position += 1
+                return broadcast.chunks[self.position - 1]
+            if broadcast.done:
+                await self.aclose()
+                if broadcast.error is not None:
+                    raise broadcast.error
+                raise StopAsyncIteration
+            await broadcast._changed.wait()
+
+    async def wait_for_turn(self) -> bool:
+        """Wait until the stream started, or until this subscription has to start it because it leads (also after the leader left). Returns whether it has to start it, e.g., once it got a generation slot."""
+        broadcast = self.broadcast
+        while not (broadcast.started or broadcast.done):
+            if self.leader:
+                return True
+            await broadcast._changed.wait()
+        return False
+
+    async def aclose(self):
+        if not self.closed:
+            self.closed = True
+            self.broadcast._unsubscribe(self)
+
+
+class SingleFlight(Generic[K, V]):
+    """Coalesces concurrent calls with the same key: the first call (the leader) runs, and later calls wait for its result instead of running again. Calls return a value and a stream, which is broadcast to all calls of the flight.
+
+    A flight ends once its stream is complete, later calls start a new flight. If the leader fails, the calls of its flight raise the same error. If it is cancelled, they start over.
+    """
+
+    def __init__(self):
+        self.coalesced = 0
+        self._flights: Dict[K, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    async def run(
+        self,
+        key: K,
+        fn: Callable[[], Awaitable[Tuple[V, AsyncIterator[str]]]],
+    ) -> Tuple[V, Subscription, bool]:
+        """Run `fn`, or join the flight with the same key.
+
+        Returns
+        -------
+        Tuple[V, Subscription, bool]
+            The value, a subscription to the stream, and whether the call joined another flight.
+        """
+        while (flight := self._flights.get(key)) is not None:
+            await asyncio.wait([flight])
+            if not flight.cancelled():
+                self.coalesced += 1
+                value, broadcast = flight.result()
+                return value, broadcast.subscribe(), True
+
+        flight = asyncio.get_running_loop().create_future()
+        self._flights[key] = flight
+        try:
+            value, stream = await fn()
+        except BaseException as e:
+            del self._flights[key]
+            if isinstance(e, Exception):
+                flight.set_exception(e)
+                flight.exception()  # Nobody might wait for it, which is fine
+            else:
+                flight.cancel()
+            raise
+
+        def end_flight():
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+        broadcast = Broadcast(stream, on_done=end_flight)
+        flight.set_result((value, broadcast))
+        return value, broadcast.subscribe(leader=True), False
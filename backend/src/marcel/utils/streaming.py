@@ -0,0 +1,75 @@
+import asyncio
+from typing import AsyncIterator, List, Optional
+
+import anyio
+
+
+async def coalesce_chunks(
+    chunks: AsyncIterator[str], interval: float, max_bytes: int
+) -> AsyncIterator[str]:
+    """Join the chunks of a stream into larger frames. Frames are sent at most every `interval` seconds, or earlier once `max_bytes` are buffered. The first chunk, and the first chunk after an idle interval, is sent right away.
+
+    Chunks which were buffered when the stream fails are sent before the error. The stream is passed through unchanged if `interval` is 0.
+    """
+    if interval <= 0:
+        async for chunk in chunks:
+            yield chunk
+        return
+
+    buffer: List[str] = []
+    size = 0
+    done = False
+    error: Optional[Exception] = None
+    # Wakes up the consumer: the buffer is full, a chunk arrived while it was idle, or the stream ended
+    ready = asyncio.Event()
+    eager = True
+
+    async def pump():
+        nonlocal size, done, error
+        try:
+            async for chunk in chunks:
+                buffer.append(chunk)
+                size += len(chunk.encode())
+                if eager or size >= max_bytes:
+                    ready.set()
+        except Exception as e:
+            error = e
+        finally:
+            done = True
+            ready.set()
+
+    def frame_due():
+        nonlocal eager
+        eager = True
+        if buffer or done:
+            ready.set()
+
+    # The stream is read by a separate task, so that frames can be sent while the next chunk is pending. The consumer only wakes up once per frame.
+    task = asyncio.create_task(pump())
+    timer: Optional[asyncio.TimerHandle] = None
+    try:
+        while True:
+            await ready.wait()
+            ready.clear()
+            if timer is not None:
+                timer.cancel()
+            if buffer:
+                frame = "".join(buffer)
+                buffer.clear()
+                size = 0
+                eager = False
+                timer = asyncio.get_running_loop().call_later(interval, frame_due)
+                yield frame
+            elif done:
+                if error is not None:
+                    raise error
+                return
+            if done:
+                ready.set()
+    finally:
+        if timer is not None:
+            timer.cancel()
+        task.cancel()
+        # The stream is closed by the task. Wait for it also if the consumer is cancelled (e.g., the client left), which anyio repeats at every await.
+        with anyio.CancelScope(shield=True):
+            await asyncio.wait([task])
@@ -46,7 +46,11 @@ def test_get_conversation(authenticated_client: TestClient, session_factory):
             user=User(client_id=uuid.uuid4()),
             messages=[
                 Message(content="Hello!", role="user"),
-                Message(content="How can I help you?", role="assistant"),
+                Message(
+                    content="How can I help you?",
+                    role="assistant",
+                    timings={"classifier": 12, "first_token": 480},
+                ),
             ],
             rating=4,
         )
@@ -61,6 +65,8 @@ def test_get_conversation(authenticated_client: TestClient, session_factory):
     assert len(data["messages"]) == 2
     assert data["messages"][0]["content"] == "Hello!"
     assert data["messages"][1]["content"] == "How can I help you?"
+    assert data["messages"][0]["timings"] is None
+    assert data["messages"][1]["timings"] == {"classifier": 12, "first_token": 480}
     assert data["rating"] == 4
 
 
@@ -199,6 +205,7 @@ def test_get_statistics(authenticated_client, session_factory):
     assert data["totals"]["total_conversations"] == 0
     assert data["totals"]["total_users"] == 0
     assert data["totals"]["total_messages"] == 0
+    assert data["totals"]["total_cancelled_answers"] == 0
     assert data["totals"]["total_average_rating"] is None
 
     # populate data
@@ -228,6 +235,13 @@ def test_get_statistics(authenticated_client, session_factory):
                 Message(
                     content="Sure", role="assistant", created_at=created_at_yesterday
                 ),
+                Message(content="More", role="user", created_at=created_at_yesterday),
+                Message(
+                    content="Su",
+                    role="assistant",
+                    created_at=created_at_yesterday,
+                    cancelled_answer=True,
+                ),
             ],
         )
         c3 = Conversation(
@@ -265,7 +279,8 @@ def test_get_statistics(authenticated_client, session_factory):
     data = resp.json()
     assert data["totals"]["total_conversations"] == 2
     assert data["totals"]["total_users"] == 2
-    assert data["totals"]["total_messages"] == 6
+    assert data["totals"]["total_messages"] == 8
+    assert data["totals"]["total_cancelled_answers"] == 1
     assert data["totals"]["total_average_rating"] == 4.5
     assert len(data["time_series"]["conversations"]) == 2
     assert len(data["time_series"]["users"]) == 2
@@ -278,7 +293,7 @@ def test_get_statistics(authenticated_client, session_factory):
     data = resp.json()
     assert data["totals"]["total_conversations"] == 3
     assert data["totals"]["total_users"] == 3
-    assert data["totals"]["total_messages"] == 8
+    assert data["totals"]["total_messages"] == 10
     assert data["totals"]["total_average_rating"] == 4.0
     assert len(data["time_series"]["conversations"]) == 30
 
@@ -324,7 +339,7 @@ def test_get_statistics(authenticated_client, session_factory):
     data = resp.json()
     assert data["totals"]["total_conversations"] == 3
     assert data["totals"]["total_users"] == 3
-    assert data["totals"]["total_messages"] == 8
+    assert data["totals"]["total_messages"] == 10
     assert data["totals"]["total_average_rating"] == 4.0
     assert len(data["time_series"]["conversations"]) == 53
     assert len(data["time_series"]["users"]) == 53
@@ -465,3 +480,18 @@ def test_aggregate_time_series():
     assert aggregate_time_series(
         [], date(2025, 4, 1), date(2025, 4, 8), "week", avg_flag=True
     ) == [TimeSeriesItem(date=date(2025, 4, 1), value=None)]
+
+
+def test_get_runtime_statistics(authenticated_client: TestClient):
+    response = authenticated_client.get("/admin/runtime")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["process_id"] > 0
+    assert data["answer_cache"] is None
+    assert data["retrieval_cache"] is None
+    assert data["admission"]["queue_depth"] == 0
+
+
+def test_get_runtime_statistics_unauthorized(test_client: TestClient):
+    response = test_client.get("/admin/runtime")
+    assert response.status_code == 401
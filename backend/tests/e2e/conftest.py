@@ -9,8 +9,11 @@ from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
 
 from marcel.app import build_app
+from marcel.chat_log import ChatLogWriter
 from marcel.database import get_database_uri, get_db, get_db_async
 from marcel.models import Base
+from marcel.pipeline_state import PipelineState
+from marcel.routes import user_ids
 
 uri, uri_async = get_database_uri()
 
@@ -54,6 +57,24 @@ async def session_factory_async():
         await async_engine.dispose()
 
 
+@pytest_asyncio.fixture(scope="function")
+async def log_writer(session_factory_async):
+    # Tests call `log_writer.flush()` before they read the messages of a query
+    return ChatLogWriter(session_factory_async, flush_interval=0)
+
+
+@pytest.fixture(autouse=True)
+def chat_log_wait_timeout(mocker):
+    # Lookups of missing conversations and messages are retried, shorter in tests
+    mocker.patch("marcel.chat_log.CHAT_LOG_WAIT_TIMEOUT", 0.5)
+
+
+@pytest.fixture(autouse=True)
+def clear_user_ids():
+    # The users created by a test are rolled back afterwards
+    user_ids.clear()
+
+
 @pytest.fixture(scope="session", autouse=True)
 def setup_database():
     Base.metadata.create_all(bind=engine)
@@ -62,10 +83,12 @@ def setup_database():
 
 
 @pytest.fixture(scope="function")
-def test_client(session_factory, session_factory_async):
+def test_client(session_factory, session_factory_async, log_writer):
     @asynccontextmanager
     async def lifespan(app: FastAPI):
-        yield {"pipeline": None}
+        log_writer.start()
+        yield {"pipeline_state": PipelineState(), "log_writer": log_writer}
+        await log_writer.close()
 
     def override_get_db():
         db = session_factory()
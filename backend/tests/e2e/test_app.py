@@ -0,0 +1,28 @@
+import threading
+
+import pytest
+from asgi_lifespan import LifespanManager
+from pytest_mock import MockerFixture
+
+from marcel.app import build_app
+
+
+@pytest.mark.asyncio
+async def test_shutdown_while_pipeline_is_built(mocker: MockerFixture):
+    building = threading.Event()
+    release = threading.Event()
+
+    def startup(state, factory):
+        building.set()
+        release.wait(timeout=10)
+
+    mocker.patch("marcel.app.startup", startup)
+    try:
+        async with LifespanManager(build_app()):
+            assert building.wait(timeout=1)
+        # The worker shuts down without waiting for the build
+        assert any(
+            thread.name == "pipeline-startup" for thread in threading.enumerate()
+        )
+    finally:
+        release.set()
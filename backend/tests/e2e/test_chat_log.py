@@ -0,0 +1,163 @@
+import asyncio
+import uuid
+from datetime import datetime, timezone
+
+import pytest
+import pytest_asyncio
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from marcel.chat_log import (
+    ChatLog,
+    ChatLogWriter,
+    IdAllocator,
+    scalar_when_written_async,
+)
+from marcel.models import Base, Conversation, Message, User
+
+
+@pytest_asyncio.fixture
+async def session_factory(tmp_path):
+    # A database of its own: failed batches roll back their transaction
+    path = tmp_path / "database.db"
+    Base.metadata.create_all(create_engine(f"sqlite:///{path}"))
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    yield async_sessionmaker(engine, expire_on_commit=False)
+    await engine.dispose()
+
+
+@pytest_asyncio.fixture
+async def user_id(session_factory):
+    async with session_factory() as db:
+        user = User(client_id=uuid.uuid4())
+        db.add(user)
+        await db.commit()
+        return user.id
+
+
+async def chat_log(writer: ChatLogWriter, user_id: int, conversation_id=None):
+    user_message_id, assistant_message_id = await writer.message_ids.allocate(2)
+    messages = [
+        Message(role="user", content="Question"),
+        Message(role="assistant", content="Answer"),
+    ]
+    for message, message_id in zip(messages, [user_message_id, assistant_message_id]):
+        message.id = message_id
+        message.conversation_id = conversation_id or uuid.uuid4()
+    return ChatLog(
+        conversation_id=messages[0].conversation_id,
+        user_id=user_id,
+        new_conversation=conversation_id is None,
+        messages=messages,
+        created_at=datetime.now(timezone.utc),
+    )
+
+
+async def count_messages(session_factory):
+    async with session_factory() as db:
+        return await db.scalar(select(func.count(Message.id)))
+
+
+@pytest.mark.asyncio
+async def test_id_allocator(session_factory):
+    async with session_factory() as db:
+        conversation = Conversation(
+            user=User(client_id=uuid.uuid4()),
+            messages=[Message(role="user", content="Old")],
+        )
+        db.add(conversation)
+        await db.commit()
+        largest_id = conversation.messages[0].id
+
+    # Workers get distinct blocks after the existing messages
+    first = IdAllocator(session_factory, "message", Message.id, block_size=4)
+    second = IdAllocator(session_factory, "message", Message.id, block_size=4)
+    assert await first.allocate(2) == [largest_id + 1, largest_id + 2]
+    assert await second.allocate(2) == [largest_id + 5, largest_id + 6]
+    # The rest of the block, after which the next one is reserved in the background
+    assert await first.allocate(2) == [largest_id + 3, largest_id + 4]
+    assert first._reserving is not None
+    assert await first.allocate(1) == [largest_id + 9]
+
+
+@pytest.mark.asyncio
+async def test_id_allocator_reservation_fails(session_factory, mocker, caplog):
+    allocator = IdAllocator(session_factory, "message", Message.id, block_size=4)
+    await allocator.allocate(2)
+    reserve = mocker.patch.object(
+        allocator, "reserve", side_effect=RuntimeError("Database")
+    )
+    # The next block is reserved in the background
+    await allocator.allocate(1)
+    await asyncio.wait([allocator._reserving])
+    await asyncio.sleep(0)  # Done callbacks run after the task
+    assert allocator._reserving is None
+    assert "Could not reserve message IDs" in caplog.text
+
+    # The next call tries again
+    mocker.stop(reserve)
+    assert await allocator.allocate(2) == [4, 5]
+
+
+@pytest.mark.asyncio
+async def test_scalar_when_written(session_factory, user_id, mocker):
+    # The log is pending in another worker
+    other_worker = ChatLogWriter(session_factory, flush_interval=0.2)
+    other_worker.start()
+    log = await chat_log(other_worker, user_id)
+    await other_worker.submit(log)
+
+    message_id = log.messages[1].id
+    async with session_factory() as db:
+        assert await db.get(Message, message_id) is None
+        statement = select(Message.content).where(Message.id == message_id)
+        assert await scalar_when_written_async(db, statement) == "Answer"
+
+        mocker.patch("marcel.chat_log.CHAT_LOG_WAIT_TIMEOUT", 0.1)
+        statement = select(Message.content).where(Message.id == -1)
+        assert await scalar_when_written_async(db, statement) is None
+    await other_worker.close()
+
+
+@pytest.mark.asyncio
+async def test_writer_batches_logs(session_factory, user_id):
+    writer = ChatLogWriter(session_factory, flush_interval=0.05)
+    writer.start()
+    logs = [await chat_log(writer, user_id) for _ in range(3)]
+    for log in logs:
+        await writer.submit(log)
+    follow_up = await chat_log(writer, user_id, conversation_id=logs[0].conversation_id)
+    assert writer.is_pending(conversation_id=logs[0].conversation_id)
+    assert writer.is_pending(message_id=logs[2].messages[1].id)
+
+    await writer.flush()
+    assert await count_messages(session_factory) == 6
+    assert writer.stats() == {"pending": 0, "written": 3, "failed": 0, "batches": 1}
+    assert not writer.is_pending(conversation_id=logs[0].conversation_id)
+
+    # Pending logs are written on shutdown
+    await writer.submit(follow_up)
+    await writer.close()
+    assert await count_messages(session_factory) == 8
+    async with session_factory() as db:
+        conversation = await db.get(Conversation, logs[0].conversation_id)
+        assert conversation.updated_at == follow_up.created_at.replace(tzinfo=None)
+
+
+@pytest.mark.asyncio
+async def test_writer_retries_failed_batch(session_factory, user_id):
+    writer = ChatLogWriter(session_factory, flush_interval=0.05)
+    writer.start()
+    valid = await chat_log(writer, user_id)
+    duplicate = await chat_log(writer, user_id)
+    for message, existing in zip(duplicate.messages, valid.messages):
+        message.id = existing.id
+
+    await writer.submit(valid)
+    await writer.submit(duplicate)
+    await asyncio.wait_for(writer.close(), timeout=5)
+
+    # Only the broken log is lost
+    assert await count_messages(session_factory) == 2
+    assert writer.stats()["written"] == 1
+    assert writer.stats()["failed"] == 1
@@ -0,0 +1,56 @@
+import pytest
+from pytest_mock import MockerFixture
+
+from marcel.document_catalog import DocumentCatalog, DocumentRef
+from marcel.models import Document
+
+
+def document(i: int) -> Document:
+    return Document(
+        url=f"example{i}.com",
+        content=f"Example {i}" * 1000,
+        title=f"Example {i}",
+        favicon="",
+        fingerprint=f"{i:064d}",
+    )
+
+
+@pytest.mark.asyncio
+async def test_resolve_without_query(session_factory_async, mocker: MockerFixture):
+    async with session_factory_async() as db:
+        db.add_all([document(1), document(2)])
+        await db.commit()
+
+        catalog = DocumentCatalog()
+        await catalog.load_async(db)
+        assert len(catalog) == 2
+
+        execute = mocker.spy(db, "execute")
+        refs = await catalog.resolve([f"{2:064d}", f"{1:064d}"], db)
+        assert [ref.url for ref in refs.values()] == ["example2.com", "example1.com"]
+        assert isinstance(refs[f"{1:064d}"], DocumentRef)
+        execute.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_resolve_reloads_new_documents(session_factory_async):
+    async with session_factory_async() as db:
+        db.add(document(1))
+        await db.commit()
+        # Empty until the first lookup
+        catalog = DocumentCatalog()
+        assert (await catalog.resolve([f"{1:064d}"], db))[f"{1:064d}"].title == (
+            "Example 1"
+        )
+
+        # Documents added by `init_data` after the catalog was loaded
+        db.add(document(2))
+        await db.commit()
+        refs = await catalog.resolve([f"{2:064d}"], db)
+        assert refs[f"{2:064d}"].url == "example2.com"
+        assert catalog.reloads == 2
+
+        # Unknown documents do not reload the unchanged catalog
+        with pytest.raises(KeyError):
+            await catalog.resolve([f"{3:064d}"], db)
+        assert catalog.reloads == 2
@@ -1,12 +1,22 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
 import pytest
 from haystack import Document
 from pytest_mock import MockerFixture
 
+from marcel.experiments import bm25_index
+from marcel.experiments.answer_cache import SemanticAnswerCache
+from marcel.experiments.bm25_index import MmapBM25Retriever
 from marcel.experiments.hybrid_pipeline import (
     FAQ_EMBEDDING_MODEL,
     HybridPipeline,
     get_pipeline,
+    normalize_query,
 )
+from marcel.routes import ChatMessage as InputChatMessage
 
 
 @pytest.fixture(scope="module", autouse=True)
@@ -133,3 +143,455 @@ async def test_run_async_generate_with_history_strategy(mocker: MockerFixture):
     assert len(generated_answer) > 0
     assert result["answer_strategy"] == "generate_with_history"
     assert not result["documents"]
+
+
+def fake_completion_stream(chunks, delay=0.0):
+    async def stream():
+        for chunk in chunks:
+            await asyncio.sleep(delay)
+            yield SimpleNamespace(
+                choices=[SimpleNamespace(delta=SimpleNamespace(content=chunk))]
+            )
+
+    return stream()
+
+
+def mock_generator(mocker: MockerFixture, pipeline: HybridPipeline, chunks, delay=0.0):
+    pipeline.generator_async = mocker.MagicMock()
+    pipeline.generator_async.chat.completions.create = mocker.AsyncMock(
+        side_effect=lambda *args, **kwargs: fake_completion_stream(chunks, delay)
+    )
+
+
+def slow_classifier(verdict: bool, delay: float):
+    async def requires_retrieval(query, **kwargs):
+        await asyncio.sleep(delay)
+        return verdict
+
+    return requires_retrieval
+
+
+@pytest.mark.asyncio
+async def test_run_async_speculative_retrieval(mocker: MockerFixture):
+    documents = [Document(content="Example", meta={"url": "example.com"})]
+    p = HybridPipeline(documents, faqs=[], speculative_retrieval=True)
+    mock_generator(mocker, p, ["Hello"])
+    retrieve = p.retrieve
+    retrieving = threading.Event()
+    classified = threading.Event()
+    overlaps = []
+
+    def blocked_retrieve(*args, **kwargs):
+        retrieving.set()
+        overlaps.append(classified.wait(timeout=5))
+        return retrieve(*args, **kwargs)
+
+    async def requires_retrieval(query, **kwargs):
+        overlaps.append(await asyncio.to_thread(retrieving.wait, 5))
+        classified.set()
+        return True
+
+    p.retrieve = mocker.MagicMock(side_effect=blocked_retrieve)
+    p.requires_retrieval = requires_retrieval
+
+    result = await p.run_async("What is an example?", history=[])
+
+    p.retrieve.assert_called_once()
+    assert result["answer_strategy"] == "retrieve"
+    assert result["speculative_retrieval"] == "used"
+    assert len(result["documents"]) == 1
+    assert overlaps == [True, True], "Classifier and retrieval should overlap"
+    assert result["timings"]["retrieval_wait"] < result["timings"]["retrieval"]
+
+
+@pytest.mark.asyncio
+async def test_run_async_speculative_retrieval_discarded(mocker: MockerFixture):
+    p = HybridPipeline(documents=[], faqs=[], speculative_retrieval=True)
+    p.requires_retrieval = slow_classifier(False, delay=0.1)
+    p.retrieve = mocker.MagicMock()
+    mock_generator(mocker, p, ["Hello"])
+
+    result = await p.run_async("Thank you!", history=[])
+    p.retrieve.assert_called_once()
+    assert result["answer_strategy"] == "generate_with_history"
+    assert result["speculative_retrieval"] == "discarded"
+    assert not result["documents"]
+    assert "retrieval_wait" not in result["timings"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("request_cancelled", [False, True])
+async def test_run_async_speculative_retrieval_stops(
+    request_cancelled, mocker: MockerFixture
+):
+    documents = [Document(content="Example", meta={"url": "example.com"})]
+    p = HybridPipeline(
+        documents, faqs=[], speculative_retrieval=True, retrieval_workers=1
+    )
+    mock_generator(mocker, p, ["Hello"])
+    joining = threading.Event()
+    release = threading.Event()
+    joiner = p.retriever.get_component("result_joiner")
+    join = joiner.run
+
+    def blocked_join(*args, **kwargs):
+        joining.set()
+        release.wait(timeout=5)
+        return join(*args, **kwargs)
+
+    mocker.patch.object(joiner, "run", blocked_join)
+    token_budget = mocker.spy(p.token_budget, "run")
+
+    async def requires_retrieval(query, **kwargs):
+        # Decide while the retrieval is in the middle of its components
+        await asyncio.to_thread(joining.wait, 5)
+        if request_cancelled:
+            await asyncio.Event().wait()
+        return False
+
+    p.requires_retrieval = requires_retrieval
+    task = asyncio.create_task(p.run_async("Thank you!", history=[]))
+    if request_cancelled:
+        await asyncio.to_thread(joining.wait, 5)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+    else:
+        assert (await task)["speculative_retrieval"] == "discarded"
+
+    release.set()
+    # The only retrieval thread is free once the retrieval stopped
+    await asyncio.wrap_future(p.retrieval_executor.submit(lambda: None))
+    token_budget.assert_not_called()
+    p.close()
+
+
+@pytest.mark.asyncio
+async def test_retrieve_async_does_not_block_event_loop(mocker: MockerFixture):
+    p = HybridPipeline(documents=[], faqs=[], retrieval_workers=2)
+    p.requires_retrieval = mocker.AsyncMock(return_value=False)
+    started = threading.Semaphore(0)
+    release = threading.Event()
+    released = []
+
+    def blocked_retrieve(*args, **kwargs):
+        started.release()
+        released.append(release.wait(timeout=5))
+
+    p.retrieve = mocker.MagicMock(side_effect=blocked_retrieve)
+    # Simulates the token stream of another request
+    mock_generator(mocker, p, ["a"] * 10, delay=0.01)
+
+    result = await p.run_async("Thank you!", history=[])
+    retrievals = [asyncio.create_task(p.retrieve_async("query", [])) for _ in range(4)]
+    for _ in range(2):
+        assert await asyncio.to_thread(started.acquire, timeout=5)
+    assert p.retrieve.call_count == 2, "Retrieval concurrency should be bounded"
+
+    # Both retrieval threads are blocked until the stream is consumed
+    tokens = [chunk async for chunk in result["generated_answer"]]
+    release.set()
+    await asyncio.gather(*retrievals)
+
+    assert len(tokens) == 10
+    assert p.retrieve.call_count == 4
+    assert all(released), "Token stream should not stall while retrieval runs"
+
+
+@pytest.mark.asyncio
+async def test_retrieve_runs_branches_concurrently(mocker: MockerFixture):
+    documents = [Document(content="Example", meta={"url": "example.com"})]
+    faqs = [Document(content="What is an example?", meta={"sources": ["example.com"]})]
+    p = HybridPipeline(documents, faqs)
+
+    # Both retrievers run async within the pipeline, so we slow down the sync work they delegate to.
+    bm25_store = p.retriever.get_component("bm25_retriever").document_store
+    faq_embedder = p.retriever.get_component("faq_retriever").pipeline.get_component(
+        "query_embedder"
+    )
+    # Passes only once both branches of both requests are running at the same time
+    barrier = threading.Barrier(4, timeout=5)
+    for obj, method in [(bm25_store, "bm25_retrieval"), (faq_embedder, "run")]:
+        run = getattr(obj, method)
+
+        def blocked_run(*args, run=run, **kwargs):
+            barrier.wait()
+            return run(*args, **kwargs)
+
+        setattr(obj, method, blocked_run)
+
+    timings = {}
+    result, *_ = await asyncio.gather(
+        p.retrieve_async("What is an example?", [], timings),
+        p.retrieve_async("What is an example?", []),
+    )
+
+    assert len(result["content_link_normalizer"]["documents"]) == 1
+    assert not barrier.broken, "Branches and requests should run concurrently"
+    assert set(timings) == {
+        "bm25_retriever",
+        "faq_retriever",
+        "result_joiner",
+        "content_link_normalizer",
+        "token_budget",
+        "prompt_builder",
+    }
+
+
+@pytest.mark.asyncio
+async def test_answer_strategy_source(mocker: MockerFixture):
+    query_classifier = mocker.MagicMock()
+    p = HybridPipeline(documents=[], faqs=[], query_classifier=query_classifier)
+    p.requires_retrieval = mocker.AsyncMock(return_value=False)
+
+    query_classifier.classify.return_value = True
+    assert await p._answer_strategy("What are the fees?", {}) == (
+        "retrieve",
+        "classifier",
+    )
+    p.requires_retrieval.assert_not_called()
+
+    query_classifier.classify.return_value = None
+    assert await p._answer_strategy("Hmm", {}) == ("generate_with_history", "llm")
+
+    p.requires_retrieval.side_effect = ValueError("Unexpected response")
+    assert await p._answer_strategy("Hmm", {}) == ("retrieve", "fallback")
+
+
+@pytest.mark.asyncio
+async def test_requires_retrieval_with_query_classifier(mocker: MockerFixture):
+    query_classifier = mocker.MagicMock()
+    p = HybridPipeline(documents=[], faqs=[], query_classifier=query_classifier)
+    llm_client = mocker.MagicMock()
+    llm_client.chat.completions.create = mocker.AsyncMock(
+        return_value=SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content="NO"))]
+        )
+    )
+    p.generator_async = mocker.MagicMock()
+    p.generator_async.with_options.return_value = llm_client
+
+    # Confident local verdicts are used as is
+    query_classifier.classify.return_value = True
+    assert await p.requires_retrieval("What are the admission requirements?")
+    query_classifier.classify.return_value = False
+    assert not await p.requires_retrieval("Thank you!")
+    llm_client.chat.completions.create.assert_not_called()
+
+    # Fall back to the LLM if the classifier is not confident
+    query_classifier.classify.return_value = None
+    assert not await p.requires_retrieval("Hmm")
+    llm_client.chat.completions.create.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_run_async_answer_cache(mocker: MockerFixture):
+    documents = [Document(content="Example", meta={"url": "example.com"})]
+    p = HybridPipeline(
+        documents, faqs=[], answer_cache=SemanticAnswerCache(maxsize=10, ttl=None)
+    )
+    p.requires_retrieval = mocker.AsyncMock(return_value=True)
+    mock_generator(mocker, p, ["Hello", " world"])
+
+    async def ask(query, history):
+        result = await p.run_async(query, history=history)
+        answer = "".join([chunk async for chunk in result["generated_answer"]])
+        return result, answer
+
+    result, answer = await ask("What is an example?", [])
+    assert not result["answer_cache_hit"]
+    assert answer == "Hello world"
+
+    result, answer = await ask("What is an example?", [])
+    assert result["answer_cache_hit"]
+    assert answer == "Hello world"
+    assert result["answer_strategy"] == "retrieve"
+    assert len(result["documents"]) == 1
+    p.generator_async.chat.completions.create.assert_called_once()
+
+    # Answers to follow-up questions depend on the history and are never cached
+    history = [InputChatMessage(role="user", content="Hi")]
+    result, _ = await ask("What is an example?", history)
+    assert not result["answer_cache_hit"]
+    assert p.answer_cache.stats()["hits"] == 1
+
+
+def test_normalize_query():
+    assert normalize_query("  What is the  Deadline? ") == "what is the deadline"
+    assert normalize_query("what is the deadline") == "what is the deadline"
+
+
+def test_retrieve_cache(mocker: MockerFixture):
+    documents = [Document(content="Example", meta={"url": "example.com"})]
+    faqs = [Document(content="What is an example?", meta={"sources": ["example.com"]})]
+    p = HybridPipeline(documents, faqs)
+    bm25_store = p.retriever.get_component("bm25_retriever").document_store
+    bm25_retrieval = mocker.spy(bm25_store, "bm25_retrieval")
+
+    result = p.retrieve("What is an example?", [])
+    timings = {}
+    cached = p.retrieve(" what is an EXAMPLE ", [], timings)
+    assert bm25_retrieval.call_count == 1
+    assert p.retrieval_cache.stats()["hits"] == 1
+    assert (
+        cached["content_link_normalizer"]["documents"]
+        == result["content_link_normalizer"]["documents"]
+    )
+    assert set(timings) == {"token_budget", "prompt_builder"}
+    # The prompt is built for the actual query
+    assert "what is an EXAMPLE" in cached["prompt_builder"]["prompt"][-1].text
+
+    # Changes to the document stores invalidate cached results
+    bm25_store.write_documents([Document(content="Another example")])
+    result = p.retrieve("What is an example?", [])
+    assert bm25_retrieval.call_count == 2
+    assert len(result["content_link_normalizer"]["documents"]) == 2
+
+
+def test_retrieve_token_budget():
+    documents = [
+        Document(content="Example " * 1000, meta={"url": "example.com"}),
+        Document(content="Another example", meta={"url": "foo.com"}),
+    ]
+    p = HybridPipeline(documents, faqs=[])
+    p.token_budget.max_tokens = 500
+    p.token_budget.max_history_tokens = 0
+
+    result = p.retrieve("Which example?", [InputChatMessage(role="user", content="Hi")])
+    assert len(result["content_link_normalizer"]["documents"]) == 2
+    # The higher-scored document is truncated to the budget, which leaves no room for the other one
+    (document,) = result["token_budget"]["documents"]
+    assert document.meta["url"] == "example.com"
+    assert len(document.content) < len(documents[0].content)
+    prompt = result["prompt_builder"]["prompt"]
+    assert len(prompt) == 2, "The history is dropped"
+    assert (
+        p.token_budget.count_messages(
+            [message.to_openai_dict_format() for message in prompt]
+        )
+        <= 500
+    )
+
+
+def test_prompt_layout_prefix_cache():
+    documents = [
+        Document(content="Example", meta={"url": "example.com", "og:title": "A"}),
+        Document(content="Another example", meta={"url": "foo.com", "og:title": "B"}),
+    ]
+    p = HybridPipeline(documents, faqs=[], prompt_layout="prefix_cache")
+    history = [
+        InputChatMessage(role="user", content="Hi"),
+        InputChatMessage(role="assistant", content="Hello"),
+    ]
+
+    result = p.retrieve("Which example?", history)
+    system, *history_messages, user = result["prompt_builder"]["prompt"]
+    # Documents follow the system prompt, ordered by id rather than score
+    titles = ["### A", "### B"]
+    if documents[0].id > documents[1].id:
+        titles.reverse()
+    assert system.text.index(titles[0]) < system.text.index(titles[1])
+    assert [message.text for message in history_messages] == ["Hi", "Hello"]
+    assert "Which example?" in user.text
+    assert "Example" not in user.text
+
+    # The prefix does not depend on the question or history
+    other = p.retrieve("Another example?", [])["prompt_builder"]["prompt"]
+    assert other[0].text == system.text
+
+    with pytest.raises(ValueError, match="prompt layout"):
+        HybridPipeline(documents, faqs=[], prompt_layout="unknown")
+
+
+def test_retrieve_reuses_event_loop(mocker: MockerFixture):
+    p = HybridPipeline(documents=[], faqs=[], retrieval_workers=1)
+    token_budget = p.token_budget.run
+    threads = []
+
+    def record_thread(*args, **kwargs):
+        threads.append(threading.current_thread().name)
+        return token_budget(*args, **kwargs)
+
+    mocker.patch.object(p.token_budget, "run", record_thread)
+
+    async def retrieve_twice():
+        await p.retrieve_async("What is an example?", [])
+        await p.retrieve_async("Another example?", [])
+
+    asyncio.run(retrieve_twice())
+    # One loop for the retrieval thread, instead of one per call
+    assert len(p._event_loops) == 1
+    # Sync components run on the bounded executor shared by the loops
+    assert len(threads) == 2
+    assert all(name.startswith("retrieval-component") for name in threads)
+    p.close()
+
+
+def test_retrieve_cache_disabled(mocker: MockerFixture):
+    p = HybridPipeline(documents=[], faqs=[], retrieval_cache_size=0)
+    bm25_store = p.retriever.get_component("bm25_retriever").document_store
+    bm25_retrieval = mocker.spy(bm25_store, "bm25_retrieval")
+
+    p.retrieve("What is an example?", [])
+    p.retrieve("What is an example?", [])
+    assert p.retrieval_cache is None
+    assert bm25_retrieval.call_count == 2
+
+
+def test_pipeline_with_mmap_corpus(tmp_path, mocker: MockerFixture):
+    documents = [
+        Document(content="Example", meta={"url": "example.com"}),
+        Document(content="Another document", meta={"url": "foo.com"}),
+    ]
+    faqs = [Document(content="What is an example?", meta={"sources": ["example.com"]})]
+    data_path = tmp_path / "knowledgebase.jsonl"
+    data_path.write_text("...")
+    bm25_index.build(documents, tmp_path / "bm25", bm25_index.file_checksum(data_path))
+    mocker.patch("marcel.experiments.hybrid_pipeline.DATA_PATH", data_path)
+    mocker.patch(
+        "marcel.experiments.hybrid_pipeline.BM25_INDEX_PATH", tmp_path / "bm25"
+    )
+
+    p = HybridPipeline(faqs=faqs)
+    assert isinstance(p.retriever.get_component("bm25_retriever"), MmapBM25Retriever)
+    result = p.retrieve("What is an example?", [])
+    assert result["faq_retriever"]["documents"][0].id == documents[0].id
+    assert result["bm25_retriever"]["documents"][0].id == documents[0].id
+
+
+@pytest.mark.asyncio
+async def test_run_async_coalesced(mocker: MockerFixture):
+    documents = [Document(content="Example", meta={"url": "example.com"})]
+    p = HybridPipeline(documents, faqs=[])
+    p.requires_retrieval = mocker.AsyncMock(return_value=True)
+    mock_generator(mocker, p, ["Hello", " world"], delay=0.05)
+
+    async def ask(query, history):
+        result = await p.run_async(query, history=history)
+        answer = "".join([chunk async for chunk in result["generated_answer"]])
+        return result, answer
+
+    results = await asyncio.gather(
+        ask("What is an example?", []),
+        ask("what is an example", []),
+        ask("What is an example?", []),
+    )
+    p.requires_retrieval.assert_called_once()
+    p.generator_async.chat.completions.create.assert_called_once()
+    assert [result["coalesced"] for result, _ in results] == [False, True, True]
+    assert all(answer == "Hello world" for _, answer in results)
+    assert all(len(result["documents"]) == 1 for result, _ in results)
+    # Only the first request ran the pipeline stages
+    assert "classifier" in results[0][0]["timings"]
+    assert all(
+        list(result["timings"]) == ["coalesced_wait"] and result["stalls"] == []
+        for result, _ in results[1:]
+    )
+
+    # Follow-up questions depend on the history and are never coalesced
+    history = [InputChatMessage(role="user", content="Hi")]
+    results = await asyncio.gather(
+        ask("What is an example?", history), ask("What is an example?", history)
+    )
+    assert not any(result["coalesced"] for result, _ in results)
+    assert p.generator_async.chat.completions.create.call_count == 3
@@ -1,10 +1,18 @@
+import uuid
+
 import haystack
 import pytest
-from sqlalchemy import select
-
+from alembic import command
+from alembic.autogenerate import compare_metadata
+from alembic.config import Config
+from alembic.migration import MigrationContext
+from sqlalchemy import create_engine, inspect, select
+from sqlalchemy.orm import Session
+
+from marcel.database import MIGRATIONS_PATH, upgrade_schema
 from marcel.experiments.data_loader import fingerprint
 from marcel.init_data import ingest_admin_users, ingest_documents
-from marcel.models import AdminUser, Document
+from marcel.models import AdminUser, Base, Conversation, Document, User
 
 
 def test_ingest_documents_database(session_factory):
@@ -136,3 +144,72 @@ def test_ingest_admin_users_empty_input(session_factory):
     ingest_admin_users(db_session, [])
     result = db_session.execute(select(AdminUser)).scalars().all()
     assert result == []
+
+
+def schema_diff(engine):
+    with engine.connect() as connection:
+        return compare_metadata(MigrationContext.configure(connection), Base.metadata)
+
+
+def test_upgrade_schema(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'database.db'}")
+    upgrade_schema(engine)
+    assert schema_diff(engine) == []
+
+    # Upgrading again has no effect
+    upgrade_schema(engine)
+    assert schema_diff(engine) == []
+
+
+def test_upgrade_schema_without_migrations(tmp_path):
+    # A database created before the migrations: tables of the baseline, without alembic_version
+    engine = create_engine(f"sqlite:///{tmp_path / 'database.db'}")
+    upgrade_schema(engine)
+    with engine.begin() as connection:
+        connection.exec_driver_sql("DROP TABLE alembic_version")
+        connection.exec_driver_sql("DROP TABLE id_block")
+        connection.exec_driver_sql("DROP INDEX ix_user_client_id")
+        for column in [
+            "prompt_tokens",
+            "generation_stalls",
+            "timings",
+            "answer_strategy_source",
+        ]:
+            connection.exec_driver_sql(f"ALTER TABLE message DROP COLUMN {column}")
+
+    upgrade_schema(engine)
+    assert {
+        "prompt_tokens",
+        "generation_stalls",
+        "timings",
+        "answer_strategy_source",
+    } <= {column["name"] for column in inspect(engine).get_columns("message")}
+    assert schema_diff(engine) == []
+
+
+def test_upgrade_schema_merges_duplicate_users(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'database.db'}")
+    config = Config()
+    config.set_main_option("script_location", str(MIGRATIONS_PATH))
+    with engine.begin() as connection:
+        config.attributes["connection"] = connection
+        command.upgrade(config, "0004")
+
+    # Users created by concurrent first requests of a client, before the unique index
+    client_id = uuid.uuid4()
+    with Session(engine) as db_session:
+        first, second = User(client_id=client_id), User(client_id=client_id)
+        second.consent_given = True
+        conversation = Conversation(user=second)
+        db_session.add_all([first, second, conversation, User(client_id=uuid.uuid4())])
+        db_session.commit()
+        first_id, conversation_id = first.id, conversation.id
+
+    upgrade_schema(engine)
+    assert schema_diff(engine) == []
+    with Session(engine) as db_session:
+        user = db_session.query(User).filter_by(client_id=client_id).one()
+        assert user.id == first_id
+        assert user.consent_given
+        assert db_session.get(Conversation, conversation_id).user_id == first_id
+        assert db_session.query(User).count() == 2
@@ -0,0 +1,235 @@
+import asyncio
+import json
+import socket
+import threading
+import time
+from types import SimpleNamespace
+
+import httpx
+import openai
+import pytest
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from marcel.experiments.llm_pool import GenerationStalled, LLMPool
+
+
+class FakeLLMServer:
+    """A local OpenAI-compatible server which streams a fixed answer after `delay` seconds, or fails."""
+
+    def __init__(self, delay=0.0, fail=False, stall=0.0):
+        self.delay = delay
+        self.stall = stall
+        self.fail = fail
+        self.requests = 0
+        self.app = FastAPI()
+
+        @self.app.post("/v1/chat/completions")
+        async def completions():
+            self.requests += 1
+            if self.fail:
+                return JSONResponse({"error": {"message": "down"}}, status_code=503)
+            await asyncio.sleep(self.delay)
+            return StreamingResponse(stream(), media_type="text/event-stream")
+
+        async def stream():
+            for word in ["Hello", " world"]:
+                chunk = {
+                    "id": "chatcmpl-0",
+                    "object": "chat.completion.chunk",
+                    "created": 0,
+                    "model": "fake",
+                    "choices": [
+                        {"index": 0, "delta": {"content": word}, "finish_reason": None}
+                    ],
+                }
+                yield f"data: {json.dumps(chunk)}\n\n"
+                await asyncio.sleep(self.stall or 0.05)
+            yield "data: [DONE]\n\n"
+
+    def start(self):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        self.server = uvicorn.Server(
+            uvicorn.Config(self.app, host="127.0.0.1", port=port, log_level="warning")
+        )
+        threading.Thread(target=self.server.run, daemon=True).start()
+        while not self.server.started:
+            time.sleep(0.01)
+        return f"http://127.0.0.1:{port}/v1"
+
+    def stop(self):
+        self.server.should_exit = True
+
+
+@pytest.fixture
+def fake_servers():
+    servers = []
+
+    def start(**kwargs):
+        server = FakeLLMServer(**kwargs)
+        servers.append(server)
+        return server, server.start()
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+def closed_port_url():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return f"http://127.0.0.1:{sock.getsockname()[1]}/v1"
+
+
+async def ask(pool: LLMPool, **kwargs):
+    stream = await pool.chat.completions.create(
+        model="fake",
+        messages=[{"role": "user", "content": "Hi"}],
+        stream=True,
+        **kwargs,
+    )
+    return "".join([chunk.choices[0].delta.content or "" async for chunk in stream])
+
+
+def pool(urls, **kwargs):
+    return LLMPool(urls, api_key="fake", **kwargs).with_options(max_retries=0)
+
+
+@pytest.mark.asyncio
+async def test_least_outstanding_requests(fake_servers):
+    first, first_url = fake_servers(delay=0.2)
+    second, second_url = fake_servers(delay=0.2)
+    p = pool([first_url, second_url])
+
+    answers = await asyncio.gather(*[ask(p) for _ in range(6)])
+    assert answers == ["Hello world"] * 6
+    assert first.requests == second.requests == 3
+    assert all(endpoint["outstanding"] == 0 for endpoint in p.stats())
+
+
+@pytest.mark.asyncio
+async def test_failing_endpoints_are_ejected(fake_servers):
+    healthy, healthy_url = fake_servers()
+    failing, failing_url = fake_servers(fail=True)
+    p = pool([failing_url, closed_port_url(), healthy_url], failure_threshold=2)
+
+    # Failed requests are retried on other endpoints
+    for _ in range(6):
+        assert await ask(p) == "Hello world"
+    assert healthy.requests == 6
+    assert failing.requests == 2
+    stats = p.stats()
+    assert [endpoint["healthy"] for endpoint in stats] == [False, False, True]
+    assert [endpoint["ejections"] for endpoint in stats] == [1, 1, 0]
+
+    # Errors of the request are not failures of the endpoint
+    bad_request = openai.BadRequestError(
+        "invalid",
+        response=httpx.Response(400, request=httpx.Request("POST", healthy_url)),
+        body=None,
+    )
+    p.endpoints[2].client = failing_client(bad_request)
+    with pytest.raises(openai.BadRequestError):
+        await ask(p)
+    assert p.stats()[2]["healthy"]
+    assert p.stats()[2]["failures"] == 0
+
+
+@pytest.mark.asyncio
+async def test_all_endpoints_failing(fake_servers):
+    _, failing_url = fake_servers(fail=True)
+    p = pool([failing_url, closed_port_url()], failure_threshold=1)
+
+    with pytest.raises(openai.APIError):
+        await ask(p)
+    # Ejected endpoints are still used if there is no other one
+    with pytest.raises(openai.APIError):
+        await ask(p)
+    assert all(endpoint["requests"] == 2 for endpoint in p.stats())
+
+
+@pytest.mark.asyncio
+async def test_slow_endpoints_are_ejected(fake_servers):
+    fast, fast_url = fake_servers()
+    slow, slow_url = fake_servers(delay=0.5)
+    p = pool([fast_url, slow_url], slow_factor=3, slow_seconds=0.2)
+
+    for _ in range(4):
+        await ask(p)
+    assert slow.requests == 1
+    assert fast.requests == 3
+    assert not p.stats()[1]["healthy"]
+
+
+def test_latency_per_request_kind():
+    p = LLMPool(
+        ["a", "b"],
+        api_key="fake",
+        slow_factor=3,
+        slow_seconds=0.2,
+        client_factory=lambda base_url: None,
+    )
+    first, second = p.endpoints
+    # Short classifier calls on one endpoint do not make the streams of the other one look slow
+    p._record_latency(first, 0.1, "response")
+    p._record_latency(second, 1.0, "first_token")
+    assert all(endpoint["healthy"] for endpoint in p.stats())
+    assert p.stats()[0]["latency_seconds"] == 0.1
+    assert p.stats()[1]["first_token_seconds"] == 1.0
+
+    p._record_latency(first, 0.2, "first_token")
+    assert not p.stats()[1]["healthy"]
+
+
+@pytest.mark.asyncio
+async def test_stalled_first_token(fake_servers):
+    stalled, stalled_url = fake_servers(delay=10)
+    healthy, healthy_url = fake_servers()
+    p = pool([stalled_url, healthy_url], first_token_timeout=0.3)
+    p.endpoints[1].outstanding = 1  # Make sure that the stalled endpoint is tried first
+
+    stalls = []
+    assert await ask(p, on_stall=stalls.append) == "Hello world"
+    assert stalled.requests == healthy.requests == 1
+    assert len(stalls) == 1 and stalled_url in stalls[0]
+    assert p.stats()[0]["failures"] == 1
+
+    # Fails if no endpoint is left
+    p = pool([stalled_url], first_token_timeout=0.3)
+    with pytest.raises(GenerationStalled):
+        await ask(p)
+
+
+@pytest.mark.asyncio
+async def test_stalled_stream(fake_servers):
+    _, url = fake_servers(stall=10)
+    p = pool([url], token_timeout=0.3)
+
+    stalls = []
+    stream = await p.chat.completions.create(
+        model="fake",
+        messages=[{"role": "user", "content": "Hi"}],
+        stream=True,
+        on_stall=stalls.append,
+    )
+    answer = ""
+    with pytest.raises(GenerationStalled):
+        async for chunk in stream:
+            answer += chunk.choices[0].delta.content or ""
+    assert answer == "Hello"
+    assert len(stalls) == 1
+    assert p.stats()[0]["outstanding"] == 0
+
+
+def failing_client(error):
+    async def create(**kwargs):
+        raise error
+
+    client = SimpleNamespace(
+        chat=SimpleNamespace(completions=SimpleNamespace(create=create))
+    )
+    client.with_options = lambda **options: client
+    return client
@@ -1,12 +1,16 @@
+import asyncio
 import hashlib
 import uuid
 from datetime import datetime, timedelta, timezone
 
 import pytest
 from fastapi.testclient import TestClient
+from pytest_mock import MockerFixture
+from sqlalchemy.dialects import mysql
 
+from marcel.chat_log import ChatLog
 from marcel.models import Conversation, Document, Message, RetrievedDocument, User
-from marcel.routes import get_current_user
+from marcel.routes import get_current_user, get_current_user_id, insert_user
 
 TEST_USER_ID = uuid.uuid4()
 
@@ -108,6 +112,48 @@ def test_feedback_forbidden(test_client, session_factory):
     assert response.status_code == 403
 
 
+def test_feedback_before_log_is_written(
+    test_client, session_factory, log_writer, mocker: MockerFixture
+):
+    with session_factory() as db_session:
+        user = User(client_id=TEST_USER_ID)
+        db_session.add(user)
+        db_session.commit()
+        user_id = user.id
+
+    async def slow_insert(batch):
+        await asyncio.sleep(0.2)
+        with session_factory() as db_session:
+            message = Message(role="assistant", content="Test message")
+            message.id = batch[0].messages[0].id
+            conversation = Conversation(
+                user=db_session.get(User, user_id), messages=[message]
+            )
+            db_session.add(conversation)
+            db_session.commit()
+
+    mocker.patch.object(log_writer, "_insert", slow_insert)
+    message = Message(role="assistant", content="Test message")
+    message.id = 1_000_000
+    log = ChatLog(
+        conversation_id=uuid.uuid4(),
+        user_id=user_id,
+        new_conversation=True,
+        messages=[message],
+        created_at=datetime.now(timezone.utc),
+    )
+    test_client.portal.call(log_writer.submit, log)
+
+    # The feedback waits until the answer is written
+    test_client.cookies = {"user_id": str(TEST_USER_ID)}
+    response = test_client.post(
+        "/feedback", json={"message_id": message.id, "feedback": "good"}
+    )
+    assert response.status_code == 200
+    with session_factory() as db_session:
+        assert db_session.get(Message, message.id).feedback == "good"
+
+
 def test_rating(test_client, session_factory):
     with session_factory() as db_session:
         conversation = Conversation(
@@ -440,3 +486,44 @@ def test_get_current_user(session_factory):
     with session_factory() as db_session:
         user = db_session.query(User).where(User.client_id == user_id).one_or_none()
         assert user is not None
+
+
+def test_get_current_user_id(session_factory, mocker: MockerFixture):
+    client_id = uuid.uuid4()
+    with session_factory() as db_session:
+        user_id = get_current_user_id(client_id, db_session)
+        # A concurrent first request of the same client inserts no second user
+        db_session.execute(insert_user("sqlite", client_id))
+        assert db_session.query(User).filter_by(client_id=client_id).one().id == user_id
+
+    # Later requests are answered from the cache
+    db_session = mocker.Mock()
+    assert get_current_user_id(client_id, db_session) == user_id
+    db_session.scalar.assert_not_called()
+
+
+def test_insert_user_mysql():
+    statement = insert_user("mysql", uuid.uuid4())
+    assert "ON DUPLICATE KEY UPDATE" in str(statement.compile(dialect=mysql.dialect()))
+
+
+def test_status_and_ready_while_starting(test_client):
+    # The test app never builds its pipeline
+    response = test_client.get("/status")
+    assert response.status_code == 200
+    assert response.json() == {"status": "ok"}
+
+    response = test_client.get("/ready")
+    assert response.status_code == 503
+    assert response.json()["status"] == "starting"
+    assert response.json()["phase"] == "starting"
+
+
+def test_query_while_starting(test_client):
+    test_client.cookies = {"user_id": str(uuid.uuid4())}
+    response = test_client.post(
+        "/query", json={"messages": [{"role": "user", "content": "Hello"}]}
+    )
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "5"
+    assert "starting" in response.json()["detail"]
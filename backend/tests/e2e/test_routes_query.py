@@ -1,8 +1,9 @@
+import asyncio
 import hashlib
 import json
 import uuid
 from contextlib import asynccontextmanager
-from datetime import timedelta
+from datetime import datetime, timedelta, timezone
 
 import haystack
 import numpy as np
@@ -11,13 +12,18 @@ import pytest_asyncio
 from asgi_lifespan import LifespanManager
 from fastapi import FastAPI
 from httpx import ASGITransport, AsyncClient
+from prometheus_client import REGISTRY
 from pytest_mock import MockerFixture
 from sqlalchemy import select
 from sqlalchemy.orm import selectinload
 
 from marcel.app import build_app
 from marcel.database import get_db, get_db_async
+from marcel.experiments.llm_pool import GenerationStalled
 from marcel.models import Conversation, Document, Message, RetrievedDocument, User
+from marcel.pipeline_state import PipelineState
+from marcel.utils.admission import AdmissionController
+from marcel.utils.single_flight import Broadcast
 
 
 def raw_documents():
@@ -68,6 +74,9 @@ class FakePipeline:
             "generated_answer": chunk_generator(),
             "documents": retrieved,
             "answer_strategy": "retrieve",
+            "answer_strategy_source": "llm",
+            "prompt_tokens": 42,
+            "timings": {"classifier": 0.012, "retrieval": 0.0804},
         }
 
     async def requires_retrieval(self, *args, **kwargs):
@@ -127,10 +136,15 @@ class FakePipelineWithGeneratorError:
 
 def create_test_client(pipeline_cls, raise_server_exceptions=False):
     @pytest_asyncio.fixture(scope="function")
-    async def _fixture(session_factory_async):
+    async def _fixture(session_factory_async, log_writer):
         @asynccontextmanager
         async def lifespan(app: FastAPI):
-            yield {"pipeline": pipeline_cls()}
+            log_writer.start()
+            yield {
+                "pipeline_state": PipelineState(pipeline_cls()),
+                "log_writer": log_writer,
+            }
+            await log_writer.close()
 
         def override_get_db():
             pass
@@ -167,7 +181,7 @@ test_client_with_retriever_error = create_test_client(FakePipelineWithRetrieverE
 
 
 @pytest.mark.asyncio
-async def test_query(test_client, session_factory_async, mocker):
+async def test_query(test_client, session_factory_async, log_writer, mocker):
     async with session_factory_async() as db_session:
         docs = [Document(**doc) for doc in raw_documents()]
         db_session.add_all(docs)
@@ -241,6 +255,7 @@ async def test_query(test_client, session_factory_async, mocker):
 
     conversation_id = uuid.UUID(streamed_chunks[-1]["conversation_id"])
     updated_at_creation = None
+    await log_writer.flush()
     async with session_factory_async() as db_session:
         result = await db_session.execute(
             select(Conversation)
@@ -268,12 +283,28 @@ async def test_query(test_client, session_factory_async, mocker):
             == "What's the duration of the data science master (msc) program?"
         )
         assert messages[0].answer_strategy == "retrieve"
+        assert messages[0].answer_strategy_source == "llm"
         assert messages[1].role == "assistant"
         assert messages[1].content == "This is a test answer"
         assert not messages[1].answer_strategy
         assert messages[1].e2e_latency and messages[1].e2e_latency > 0
         assert messages[1].generator_latency and messages[1].generator_latency > 0
         assert messages[1].e2e_latency > messages[1].generator_latency
+        assert messages[0].prompt_tokens is None
+        assert messages[1].prompt_tokens == 42
+        # Stages of the pipeline and of the request, in milliseconds
+        assert messages[0].timings is None
+        assert messages[1].timings["classifier"] == 12
+        assert messages[1].timings["retrieval"] == 80
+        assert {
+            "pipeline",
+            "admission",
+            "first_token",
+            "generation",
+            "sources",
+            "message_ids",
+            "total",
+        } <= set(messages[1].timings)
 
         assert len(messages[0].documents) == 0
         assert len(messages[1].documents) == 2
@@ -305,6 +336,7 @@ async def test_query(test_client, session_factory_async, mocker):
         },
     )
 
+    await log_writer.flush()
     async with session_factory_async() as db_session:
         result = await db_session.execute(
             select(Conversation)
@@ -320,7 +352,7 @@ async def test_query(test_client, session_factory_async, mocker):
 
 @pytest.mark.asyncio
 async def test_query_with_no_retrieval(
-    session_factory_async, test_client_no_retrieval, mocker: MockerFixture
+    session_factory_async, test_client_no_retrieval, log_writer, mocker: MockerFixture
 ):
     test_client_no_retrieval.cookies = {"user_id": str(uuid.uuid4())}
     streamed_chunks = []
@@ -347,6 +379,7 @@ async def test_query_with_no_retrieval(
     )
     assert generated_answer == "How can I help you?"
     conversation_id = uuid.UUID(streamed_chunks[-1]["conversation_id"])
+    await log_writer.flush()
 
     async with session_factory_async() as db_session:
         result = await db_session.execute(
@@ -418,6 +451,526 @@ async def test_query_conversation_forbidden(test_client, session_factory_async):
     assert response.status_code == 403
 
 
+@pytest.mark.asyncio
+async def test_query_server_history(
+    test_client, session_factory_async, mocker: MockerFixture
+):
+    user_id = uuid.uuid4()
+    created_at = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    contents = [
+        ("user", "Old question", False),
+        ("assistant", "Old answer", False),
+        ("user", "When is the deadline?", False),
+        ("assistant", "See the [website][0].\n\n[0]: https://example.com", False),
+        ("user", "Thanks!", False),
+        ("assistant", "You're welcome", True),
+    ]
+    async with session_factory_async() as db_session:
+        conversation = Conversation(
+            user=User(client_id=user_id),
+            messages=[
+                Message(
+                    role=role,
+                    content=content,
+                    cancelled_answer=cancelled,
+                    created_at=created_at + timedelta(minutes=i),
+                )
+                for i, (role, content, cancelled) in enumerate(contents)
+            ],
+        )
+        db_session.add(conversation)
+        await db_session.flush()
+        conversation_id = str(conversation.id)
+        await db_session.commit()
+
+    run_async = mocker.spy(FakePipeline, "run_async")
+    mocker.patch("marcel.routes.SERVER_HISTORY_MESSAGES", 4)
+    test_client.cookies = {"user_id": str(user_id)}
+    response = await test_client.post(
+        "/query",
+        json={
+            "conversation_id": conversation_id,
+            "messages": [{"role": "user", "content": "And the fees?"}],
+            "server_history": True,
+        },
+    )
+    assert response.status_code == 200
+
+    # The most recent messages, without cancelled answers, starting with a question
+    _, query, history = run_async.call_args.args
+    assert query == "And the fees?"
+    assert [(message.role, message.content) for message in history] == [
+        ("user", "When is the deadline?"),
+        ("assistant", "See the website."),
+        ("user", "Thanks!"),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_query_server_history_with_messages(test_client):
+    test_client.cookies = {"user_id": str(uuid.uuid4())}
+    response = await test_client.post(
+        "/query",
+        json={
+            "messages": [
+                {"role": "user", "content": "Hi"},
+                {"role": "assistant", "content": "Hello"},
+                {"role": "user", "content": "What are the fees?"},
+            ],
+            "server_history": True,
+        },
+    )
+    assert response.status_code == 422
+
+
+async def add_documents(session_factory_async):
+    async with session_factory_async() as db:
+        db.add_all([Document(**doc) for doc in raw_documents()])
+        await db.commit()
+
+
+def delay_chat_log_writes(log_writer, mocker: MockerFixture):
+    insert = log_writer._insert
+
+    async def slow_insert(batch):
+        await asyncio.sleep(0.2)
+        await insert(batch)
+
+    mocker.patch.object(log_writer, "_insert", slow_insert)
+
+
+@pytest.mark.asyncio
+async def test_query_follow_up_before_log_is_written(
+    test_client, session_factory_async, log_writer, mocker: MockerFixture
+):
+    await add_documents(session_factory_async)
+    delay_chat_log_writes(log_writer, mocker)
+    run_async = mocker.spy(FakePipeline, "run_async")
+    test_client.cookies = {"user_id": str(uuid.uuid4())}
+    response = await test_client.post(
+        "/query", json={"messages": [{"role": "user", "content": "Hello"}]}
+    )
+    conversation_id = json.loads(response.text.splitlines()[-1])["conversation_id"]
+    assert log_writer.is_pending(conversation_id=uuid.UUID(conversation_id))
+
+    # The follow-up waits for the previous answer to be written
+    response = await test_client.post(
+        "/query",
+        json={
+            "conversation_id": conversation_id,
+            "messages": [{"role": "user", "content": "And the fees?"}],
+            "server_history": True,
+        },
+    )
+    assert response.status_code == 200
+    _, _, history = run_async.call_args.args
+    assert [(message.role, message.content) for message in history] == [
+        ("user", "Hello"),
+        ("assistant", "This is a test answer"),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_query_follow_up_written_by_other_worker(
+    test_client, session_factory_async, log_writer, mocker: MockerFixture
+):
+    await add_documents(session_factory_async)
+    delay_chat_log_writes(log_writer, mocker)
+    run_async = mocker.spy(FakePipeline, "run_async")
+    test_client.cookies = {"user_id": str(uuid.uuid4())}
+    response = await test_client.post(
+        "/query", json={"messages": [{"role": "user", "content": "Hello"}]}
+    )
+    last_chunk = json.loads(response.text.splitlines()[-1])
+    # This worker does not know about the pending log
+    mocker.patch.object(log_writer, "is_pending", return_value=False)
+
+    response = await test_client.post(
+        "/query",
+        json={
+            "conversation_id": last_chunk["conversation_id"],
+            "messages": [{"role": "user", "content": "And the fees?"}],
+            "server_history": True,
+            "last_message_id": last_chunk["assistant_message"]["id"],
+        },
+    )
+    assert response.status_code == 200
+    assert "error_status_code" not in response.text
+    _, _, history = run_async.call_args.args
+    assert [(message.role, message.content) for message in history] == [
+        ("user", "Hello"),
+        ("assistant", "This is a test answer"),
+    ]
+
+
+async def post_query(test_client):
+    test_client.cookies = {"user_id": str(uuid.uuid4())}
+    response = await test_client.post(
+        "/query", json={"messages": [{"role": "user", "content": "Hello"}]}
+    )
+    assert response.status_code == 200
+    return [json.loads(line) for line in response.text.splitlines() if line.strip()]
+
+
+@pytest.mark.asyncio
+async def test_query_queued(test_client, mocker: MockerFixture):
+    admission = AdmissionController(max_concurrent=1, max_queue=1, status_interval=0.01)
+    mocker.patch("marcel.routes.admission", admission)
+    async for _ in admission.admit():
+        pass  # Occupy the only slot
+
+    async def release_once_queued():
+        while admission.queue_depth == 0:
+            await asyncio.sleep(0.01)
+        admission.release()
+
+    release = asyncio.create_task(release_once_queued())
+    chunks = await post_query(test_client)
+    await release
+
+    assert chunks[0] == {"queue_position": 1}
+    assert "".join(chunk.get("content", "") for chunk in chunks).startswith(
+        "This is a test answer"
+    )
+    assert admission.stats()["active"] == 0
+
+
+@pytest.mark.asyncio
+async def test_query_queue_full(test_client, mocker: MockerFixture):
+    admission = AdmissionController(max_concurrent=1, max_queue=0)
+    mocker.patch("marcel.routes.admission", admission)
+    async for _ in admission.admit():
+        pass
+
+    chunks = await post_query(test_client)
+    assert chunks == [
+        {
+            "error_status_code": 503,
+            "error_content": {"detail": "Too many requests right now. Please retry."},
+        }
+    ]
+
+
+@pytest.mark.asyncio
+async def test_query_coalesced_skips_queue(test_client, mocker: MockerFixture):
+    admission = AdmissionController(max_concurrent=1, max_queue=0)
+    mocker.patch("marcel.routes.admission", admission)
+    async for _ in admission.admit():
+        pass
+    run_async = FakePipeline.run_async
+
+    async def coalesced_run_async(self, *args, **kwargs):
+        return {**await run_async(self, *args, **kwargs), "coalesced": True}
+
+    mocker.patch.object(FakePipeline, "run_async", coalesced_run_async)
+
+    # The request shares the generation of another request and does not need a slot
+    chunks = await post_query(test_client)
+    assert "".join(chunk.get("content", "") for chunk in chunks).startswith(
+        "This is a test answer"
+    )
+    assert admission.stats()["rejected"] == 0
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("flag", ["answer_cache_hit", "coalesced"])
+async def test_query_without_slot_keeps_limit(
+    test_client, session_factory_async, mocker: MockerFixture, flag: str
+):
+    await add_documents(session_factory_async)
+    # LLM_MAX_CONCURRENCY=1
+    admission = AdmissionController(max_concurrent=1, max_queue=10)
+    mocker.patch("marcel.routes.admission", admission)
+    run_async = FakePipeline.run_async
+
+    async def run_async_without_slot(self, *args, **kwargs):
+        return {**await run_async(self, *args, **kwargs), flag: True}
+
+    mocker.patch.object(FakePipeline, "run_async", run_async_without_slot)
+
+    chunks = await post_query(test_client)
+    assert "conversation_id" in chunks[-1]
+    # The answer did not take a slot, so it must not give one back
+    assert admission.stats()["active"] == 0
+    assert [position async for position in admission.admit()] == []
+    second = admission.admit()
+    assert await anext(second) == 1
+    await second.aclose()
+    admission.release()
+    assert admission.stats()["active"] == 0
+
+
+@pytest.mark.asyncio
+async def test_query_coalesced_takes_over_slot(
+    test_client, session_factory_async, mocker: MockerFixture
+):
+    await add_documents(session_factory_async)
+    admission = AdmissionController(max_concurrent=1, max_queue=10)
+    mocker.patch("marcel.routes.admission", admission)
+    async for _ in admission.admit():
+        pass  # Occupy the only slot
+    run_async = FakePipeline.run_async
+    broadcasts = []
+
+    async def coalesced_run_async(self, *args, **kwargs):
+        result = await run_async(self, *args, **kwargs)
+        broadcast = Broadcast(result["generated_answer"])
+        broadcasts.append(broadcast)
+        leader = broadcast.subscribe(leader=True)
+        follower = broadcast.subscribe()
+        # The request which ran the pipeline left while it waited for a slot
+        await leader.aclose()
+        return {**result, "generated_answer": follower, "coalesced": True}
+
+    mocker.patch.object(FakePipeline, "run_async", coalesced_run_async)
+
+    async def release_once_queued():
+        while admission.queue_depth == 0:
+            await asyncio.sleep(0.01)
+        # The generation does not start without a slot
+        assert not broadcasts[0].started
+        admission.release()
+
+    release = asyncio.create_task(release_once_queued())
+    chunks = await post_query(test_client)
+    await release
+
+    # The coalesced request waits in the queue in place of the one which left
+    assert chunks[0] == {"queue_position": 1}
+    assert "".join(chunk.get("content", "") for chunk in chunks).startswith(
+        "This is a test answer"
+    )
+    assert admission.stats()["admitted"] == 2
+    assert admission.stats()["active"] == 0
+
+
+@pytest.mark.asyncio
+async def test_query_leader_leaves_shared_generation(
+    test_client, session_factory_async, mocker: MockerFixture
+):
+    admission = AdmissionController(max_concurrent=1, max_queue=10)
+    mocker.patch("marcel.routes.admission", admission)
+    followers = []
+
+    async def shared_run_async(self, *args, **kwargs):
+        async def chunk_generator():
+            for _ in range(20):
+                await asyncio.sleep(0.01)
+                yield "token "
+
+        broadcast = Broadcast(chunk_generator())
+        # Another request shares the generation
+        followers.append(broadcast.subscribe())
+        return {
+            "generated_answer": broadcast.subscribe(leader=True),
+            "documents": [],
+            "answer_strategy": "retrieve",
+        }
+
+    mocker.patch.object(FakePipeline, "run_async", shared_run_async)
+
+    await post_query_and_disconnect(test_client._transport.app, 1)
+    # The generation goes on for the other request and keeps its slot
+    assert admission.stats()["active"] == 1
+    assert "".join([chunk async for chunk in followers[0]]) == "token " * 20
+    assert admission.stats()["active"] == 0
+    assert admission.stats()["cancelled"] == 0
+
+
+@pytest.mark.asyncio
+async def test_query_generation_stalled(
+    test_client, session_factory_async, log_writer, mocker: MockerFixture
+):
+    async def stalled_run_async(self, *args, **kwargs):
+        stalls = ["No first token within 30s", "No token for 15s"]
+
+        async def chunk_generator():
+            yield "This "
+            raise GenerationStalled(stalls[-1])
+
+        return {
+            "generated_answer": chunk_generator(),
+            "documents": [],
+            "answer_strategy": "retrieve",
+            "stalls": stalls,
+        }
+
+    mocker.patch.object(FakePipeline, "run_async", stalled_run_async)
+
+    chunks = await post_query(test_client)
+    assert chunks == [
+        {"content": "This "},
+        {
+            "error_status_code": 504,
+            "error_content": {"detail": "The answer took too long. Please retry."},
+        },
+    ]
+
+    # The stalls are recorded with the partial answer, which is left out of the history
+    await log_writer.flush()
+    async with session_factory_async() as db:
+        message = (
+            await db.execute(select(Message).where(Message.role == "assistant"))
+        ).scalar_one()
+        assert message.content == "This"
+        assert message.generation_stalls == 2
+        assert message.cancelled_answer
+
+
+async def post_query_and_disconnect(app, received_chunks: int):
+    """Send a query directly to the ASGI app, and disconnect after the given number of chunks."""
+    body = json.dumps({"messages": [{"role": "user", "content": "Hello"}]}).encode()
+    requests = [{"type": "http.request", "body": body, "more_body": False}]
+    disconnected = asyncio.Event()
+    chunks = []
+
+    async def receive():
+        if requests:
+            return requests.pop()
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.body" and message.get("body"):
+            chunks.extend(json.loads(line) for line in message["body"].splitlines())
+            if len(chunks) >= received_chunks:
+                disconnected.set()
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0", "spec_version": "2.3"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/query",
+        "raw_path": b"/query",
+        "root_path": "",
+        "query_string": b"",
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"cookie", f"user_id={uuid.uuid4()}".encode()),
+        ],
+        "client": ("127.0.0.1", 12345),
+        "server": ("127.0.0.1", 9000),
+    }
+    await asyncio.wait_for(app(scope, receive, send), timeout=5)
+    return chunks
+
+
+@pytest.mark.asyncio
+async def test_query_client_disconnected(
+    test_client, session_factory_async, log_writer, mocker: MockerFixture
+):
+    admission = AdmissionController(max_concurrent=1, max_queue=1)
+    mocker.patch("marcel.routes.admission", admission)
+    tokens = 0
+    closed = asyncio.Event()
+
+    async def endless_run_async(self, *args, **kwargs):
+        async def chunk_generator():
+            nonlocal tokens
+            try:
+                while True:
+                    await asyncio.sleep(0.01)
+                    tokens += 1
+                    yield "token "
+            finally:
+                # Closing the stream of the LLM
+                await asyncio.sleep(0.01)
+                closed.set()
+
+        return {
+            "generated_answer": chunk_generator(),
+            "documents": [],
+            "answer_strategy": "retrieve",
+        }
+
+    mocker.patch.object(FakePipeline, "run_async", endless_run_async)
+
+    chunks = await post_query_and_disconnect(test_client._transport.app, 2)
+    assert chunks[0] == {"content": "token "}
+
+    # The generation stops right away and frees its slot
+    assert closed.is_set()
+    generated_tokens = tokens
+    await asyncio.sleep(0.05)
+    assert tokens == generated_tokens
+    assert admission.stats()["active"] == 0
+    assert admission.stats()["cancelled"] == 1
+
+    # The partial answer is kept
+    await log_writer.flush()
+    async with session_factory_async() as db:
+        message = (
+            await db.execute(select(Message).where(Message.role == "assistant"))
+        ).scalar_one()
+        assert message.content.startswith("".join(c["content"] for c in chunks).strip())
+        assert message.cancelled_answer
+
+
+def sample_value(name: str, **labels) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+@pytest.mark.asyncio
+async def test_query_metrics(test_client, session_factory_async):
+    await add_documents(session_factory_async)
+    before = {
+        "e2e": sample_value("marcel_e2e_seconds_count"),
+        "classifier": sample_value("marcel_classifier_seconds_count"),
+        "retrieval": sample_value("marcel_retrieval_seconds_count", branch="total"),
+        "first_token": sample_value("marcel_time_to_first_token_seconds_count"),
+    }
+    await post_query(test_client)
+
+    response = await test_client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert "marcel_e2e_seconds_bucket" in response.text
+    # Stage timings of the answer (the fake pipeline reports the classifier and retrieval)
+    assert sample_value("marcel_e2e_seconds_count") == before["e2e"] + 1
+    assert sample_value("marcel_classifier_seconds_count") == before["classifier"] + 1
+    assert (
+        sample_value("marcel_retrieval_seconds_count", branch="total")
+        == before["retrieval"] + 1
+    )
+    assert (
+        sample_value("marcel_time_to_first_token_seconds_count")
+        == before["first_token"] + 1
+    )
+    assert sample_value("marcel_streams_in_flight") == 0
+
+
+@pytest.mark.asyncio
+async def test_query_metrics_coalesced(
+    test_client, session_factory_async, mocker: MockerFixture
+):
+    await add_documents(session_factory_async)
+    run_async = FakePipeline.run_async
+
+    async def coalesced_run_async(self, *args, **kwargs):
+        return {**await run_async(self, *args, **kwargs), "coalesced": True}
+
+    mocker.patch.object(FakePipeline, "run_async", coalesced_run_async)
+    before = {
+        "e2e": sample_value("marcel_e2e_seconds_count"),
+        "classifier": sample_value("marcel_classifier_seconds_count"),
+    }
+    await post_query(test_client)
+
+    # Only the stages of the request itself count, not those of the shared pipeline run
+    assert sample_value("marcel_e2e_seconds_count") == before["e2e"] + 1
+    assert sample_value("marcel_classifier_seconds_count") == before["classifier"]
+
+
+@pytest.mark.asyncio
+async def test_ready(test_client):
+    response = await test_client.get("/ready")
+    assert response.status_code == 200
+    assert response.json()["status"] == "ready"
+    assert response.json()["startup_seconds"] is not None
+
+
 @pytest.mark.asyncio
 async def test_query_empty_messages(test_client):
     test_client.cookies = {"user_id": str(uuid.uuid4())}
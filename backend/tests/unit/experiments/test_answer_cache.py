@@ -0,0 +1,73 @@
+import numpy as np
+from haystack import Document
+
+from marcel.experiments.answer_cache import CachedAnswer, SemanticAnswerCache
+
+
+def normalize(x):
+    x = np.array(x, dtype=float)
+    return x / np.linalg.norm(x)
+
+
+def make_entry(query, embedding, corpus_version="v1"):
+    return CachedAnswer(
+        query=query,
+        embedding=normalize(embedding),
+        answer=f"Answer to: {query}",
+        documents=[Document(content="Example")],
+        answer_strategy="retrieve",
+        corpus_version=corpus_version,
+        generator_latency=2.0,
+    )
+
+
+def test_lookup():
+    cache = SemanticAnswerCache(maxsize=10, ttl=None, similarity_threshold=0.95)
+    cache.put(make_entry("What is the deadline?", [1, 0, 0]))
+    cache.put(make_entry("Who are you?", [0, 1, 0]))
+
+    hit = cache.lookup(normalize([1, 0.1, 0]), "v1")
+    assert hit is not None
+    assert hit.answer == "Answer to: What is the deadline?"
+
+    assert cache.lookup(normalize([1, 1, 0]), "v1") is None, "Not similar enough"
+    assert cache.lookup(normalize([0, 0, 1]), "v1") is None
+
+
+def test_lookup_other_corpus_version():
+    cache = SemanticAnswerCache(maxsize=10, ttl=None)
+    cache.put(make_entry("What is the deadline?", [1, 0, 0], corpus_version="v1"))
+    assert cache.lookup(normalize([1, 0, 0]), "v2") is None
+
+
+def test_lookup_empty():
+    cache = SemanticAnswerCache(maxsize=10, ttl=None)
+    assert cache.lookup(normalize([1, 0, 0]), "v1") is None
+
+
+def test_put_evicts_least_recently_used():
+    cache = SemanticAnswerCache(maxsize=2, ttl=None)
+    cache.put(make_entry("a", [1, 0, 0]))
+    cache.put(make_entry("b", [0, 1, 0]))
+    assert cache.lookup(normalize([1, 0, 0]), "v1")  # "b" is now least recently used
+    cache.put(make_entry("c", [0, 0, 1]))
+
+    assert cache.lookup(normalize([0, 1, 0]), "v1") is None
+    assert cache.lookup(normalize([1, 0, 0]), "v1")
+
+
+def test_stats():
+    cache = SemanticAnswerCache(maxsize=10, ttl=None)
+    cache.put(make_entry("What is the deadline?", [1, 0, 0]))
+    cache.lookup(normalize([1, 0, 0]), "v1")
+    cache.lookup(normalize([1, 0, 0]), "v1")
+    cache.lookup(normalize([0, 1, 0]), "v1")
+
+    assert cache.stats() == {
+        "size": 1,
+        "maxsize": 10,
+        "hits": 2,
+        "misses": 1,
+        "hit_rate": 2 / 3,
+        "saved_generation_seconds": 4.0,
+    }
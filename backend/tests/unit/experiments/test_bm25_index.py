@@ -0,0 +1,121 @@
+import json
+
+import pytest
+from haystack import Document
+from haystack.components.retrievers.in_memory import InMemoryBM25Retriever
+
+from marcel.experiments import bm25_index
+from marcel.experiments.bm25_index import (
+    CorruptIndexError,
+    MmapBM25Retriever,
+    MmapCorpus,
+    StringTable,
+)
+from marcel.experiments.components import VersionedInMemoryDocumentStore
+
+DOCUMENTS = [
+    Document(content="My name is Jean and I live in Paris.", meta={"url": "jean.fr"}),
+    Document(content="My name is Mark and I live in Berlin.", meta={"url": "mark.de"}),
+    Document(
+        content="Giorgio lives in Rome. Rome is the capital of Italy.",
+        meta={"url": "giorgio.it", "links": {1: "example.com"}},
+    ),
+    Document(content="", meta={"url": "empty.com"}),
+    Document(content="Zoë lebt in Köln.", meta={"url": "zoe.de"}),
+]
+
+
+def test_string_table(tmp_path):
+    StringTable.write(tmp_path, "strings", ["b", "", "Köln"])
+    table = StringTable.open(tmp_path, "strings")
+    assert len(table) == 3
+    assert list(table) == ["b", "", "Köln"]
+    with pytest.raises(IndexError):
+        table[3]
+
+    StringTable.write(tmp_path, "empty", [])
+    assert list(StringTable.open(tmp_path, "empty")) == []
+
+
+def test_build_and_open(tmp_path):
+    bm25_index.build(DOCUMENTS, tmp_path, source_checksum="abc")
+
+    corpus = MmapCorpus.open(tmp_path, source_checksum="abc")
+    assert len(corpus) == len(DOCUMENTS)
+    assert list(corpus) == DOCUMENTS
+    assert corpus[2].meta == {"url": "giorgio.it", "links": {1: "example.com"}}
+    assert dict(corpus.iter_meta())[DOCUMENTS[0].id] == {"url": "jean.fr"}
+
+    doc_indices, term_freqs = corpus.postings("rome")
+    assert doc_indices.tolist() == [2]
+    assert term_freqs.tolist() == [2]
+    assert len(corpus.postings("madrid")[0]) == 0
+
+
+def test_retriever(tmp_path):
+    bm25_index.build(DOCUMENTS, tmp_path, source_checksum="abc")
+    corpus = MmapCorpus.open(tmp_path, source_checksum="abc")
+
+    # Same documents and scores as indexing the documents
+    document_store = VersionedInMemoryDocumentStore()
+    document_store.write_documents(DOCUMENTS)
+    for scale_score in [True, False]:
+        retriever = MmapBM25Retriever(corpus, top_k=3, scale_score=scale_score)
+        expected_retriever = InMemoryBM25Retriever(
+            document_store, top_k=3, scale_score=scale_score
+        )
+        for query in ["Who lives in Rome?", "Jean", "capital of Germany", "köln"]:
+            assert (
+                retriever.run(query=query)["documents"]
+                == expected_retriever.run(query=query)["documents"]
+            )
+
+    with pytest.raises(ValueError):
+        retriever.run(query="")
+
+
+@pytest.mark.asyncio
+async def test_retriever_async(tmp_path):
+    bm25_index.build(DOCUMENTS, tmp_path, source_checksum="abc")
+    retriever = MmapBM25Retriever(MmapCorpus.open(tmp_path, "abc"), top_k=1)
+    result = await retriever.run_async(query="Who lives in Rome?")
+    assert result["documents"][0].id == DOCUMENTS[2].id
+
+
+def test_build_replaces_previous_index(tmp_path):
+    bm25_index.build(DOCUMENTS, tmp_path, source_checksum="abc")
+    bm25_index.build(DOCUMENTS[:1], tmp_path, source_checksum="def")
+
+    assert len(MmapCorpus.open(tmp_path, source_checksum="def")) == 1
+    assert len(list(tmp_path.glob("build-*"))) == 1
+
+
+def test_open_missing_or_outdated(tmp_path):
+    assert MmapCorpus.open(tmp_path, source_checksum="abc") is None
+
+    bm25_index.build(DOCUMENTS, tmp_path, source_checksum="abc")
+    assert MmapCorpus.open(tmp_path, source_checksum="other") is None
+
+
+def test_open_corrupt(tmp_path):
+    bm25_index.build(DOCUMENTS, tmp_path, source_checksum="abc")
+    manifest = json.loads((tmp_path / bm25_index.MANIFEST).read_text())
+    data_path = tmp_path / manifest["data"]
+
+    with open(data_path / "indptr.npy", "ab") as fout:
+        fout.write(b"\0")
+    with pytest.raises(CorruptIndexError, match="Checksum mismatch"):
+        MmapCorpus.open(tmp_path, "abc")
+
+    (data_path / "content.bin").unlink()
+    with pytest.raises(CorruptIndexError, match="Missing file"):
+        MmapCorpus.open(tmp_path, "abc")
+
+    manifest["format_version"] = 1
+    (tmp_path / bm25_index.MANIFEST).write_text(json.dumps(manifest))
+    with pytest.raises(CorruptIndexError, match="format version"):
+        MmapCorpus.open(tmp_path, "abc")
+
+    (tmp_path / bm25_index.MANIFEST).write_text("{")
+    with pytest.raises(CorruptIndexError, match="Invalid manifest"):
+        MmapCorpus.open(tmp_path, "abc")
@@ -5,6 +5,7 @@ from marcel.experiments.components import (
     MostRelevantFirstReranker,
     MostRelevantLastReranker,
     RandomReranker,
+    VersionedInMemoryDocumentStore,
     clean_unlinked_references,
 )
 
@@ -127,3 +128,15 @@ def test_clean_unlinked_references():
     content = "[            Forward                               ][60]"
     matched = "[60]"
     assert clean_unlinked_references(content, matched) == ""
+
+
+def test_versioned_document_store():
+    store = VersionedInMemoryDocumentStore()
+    assert store.version == 0
+
+    doc = Document(content="Example")
+    store.write_documents([doc])
+    assert store.version == 1
+    store.delete_documents([doc.id])
+    assert store.version == 2
+    assert store.count_documents() == 0
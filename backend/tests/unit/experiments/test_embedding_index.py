@@ -0,0 +1,95 @@
+from dataclasses import replace
+
+import numpy as np
+from haystack import Document
+
+from marcel.experiments.data_loader import fingerprint
+from marcel.experiments.embedding_index import EmbeddingIndex
+
+
+class FakeEmbedder:
+    """Embeds documents by content length and records what it embedded."""
+
+    def __init__(self):
+        self.embedded = []
+
+    def warm_up(self):
+        pass
+
+    def run(self, documents):
+        self.embedded.extend(doc.content for doc in documents)
+        return {
+            "documents": [
+                replace(doc, embedding=[float(len(doc.content)), 1.0])
+                for doc in documents
+            ]
+        }
+
+
+def test_embed(tmp_path):
+    docs = [Document(content="Hello"), Document(content="Hi")]
+    embedder = FakeEmbedder()
+    embedded = EmbeddingIndex(tmp_path, "model").embed(docs, embedder)
+    assert embedder.embedded == ["Hello", "Hi"]
+    assert [doc.embedding for doc in embedded] == [[5.0, 1.0], [2.0, 1.0]]
+    assert [doc.id for doc in embedded] == [doc.id for doc in docs]
+
+    # A new index instance (e.g., another worker) reuses the persisted embeddings
+    embedder = FakeEmbedder()
+    embedded = EmbeddingIndex(tmp_path, "model").embed(docs, embedder)
+    assert embedder.embedded == []
+    assert [doc.embedding for doc in embedded] == [[5.0, 1.0], [2.0, 1.0]]
+
+
+def test_embed_only_new_documents(tmp_path):
+    index = EmbeddingIndex(tmp_path, "model")
+    index.embed([Document(content="Hello"), Document(content="Hi")], FakeEmbedder())
+
+    embedder = FakeEmbedder()
+    embedded = index.embed(
+        [Document(content="Hello"), Document(content="Hey there")], embedder
+    )
+    assert embedder.embedded == ["Hey there"]
+    assert [doc.embedding for doc in embedded] == [[5.0, 1.0], [9.0, 1.0]]
+
+    # Outdated content is dropped from the index
+    assert set(index.load()) == {fingerprint("Hello"), fingerprint("Hey there")}
+    assert len(list(tmp_path.glob("embeddings-*.npy"))) == 1
+
+
+def test_embed_without_save(tmp_path):
+    index = EmbeddingIndex(tmp_path, "model")
+    index.embed([Document(content="Hello"), Document(content="Hi")], FakeEmbedder())
+    manifest = (tmp_path / EmbeddingIndex.MANIFEST).read_text()
+
+    # Readers of the index (e.g., workers with a subset of the documents) neither add to nor prune it
+    embedder = FakeEmbedder()
+    embedded = index.embed(
+        [Document(content="Hello"), Document(content="Hey there")],
+        embedder,
+        save=False,
+    )
+    assert embedder.embedded == ["Hey there"]
+    assert [doc.embedding for doc in embedded] == [[5.0, 1.0], [9.0, 1.0]]
+    assert (tmp_path / EmbeddingIndex.MANIFEST).read_text() == manifest
+    assert set(index.load()) == {fingerprint("Hello"), fingerprint("Hi")}
+
+
+def test_embed_other_model(tmp_path):
+    docs = [Document(content="Hello")]
+    EmbeddingIndex(tmp_path, "model").embed(docs, FakeEmbedder())
+
+    embedder = FakeEmbedder()
+    EmbeddingIndex(tmp_path, "other-model").embed(docs, embedder)
+    assert embedder.embedded == ["Hello"]
+
+
+def test_load_corrupt_index(tmp_path):
+    index = EmbeddingIndex(tmp_path, "model")
+    assert index.load() == {}
+
+    (tmp_path / EmbeddingIndex.MANIFEST).write_text("{")
+    assert index.load() == {}
+
+    index.save(["a", "b"], np.zeros((1, 2), dtype=np.float32))
+    assert index.load() == {}, "Number of rows does not match the manifest"
@@ -0,0 +1,121 @@
+import uuid
+
+import numpy as np
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from marcel.experiments.query_classifier import (
+    QueryClassifier,
+    evaluate,
+    fit_logistic_regression,
+    load_training_data,
+)
+from marcel.models import Base, Conversation, Message, User
+
+# Toy embeddings: questions point along the first axis, chit-chat along the second
+EMBEDDINGS = {
+    "What are the admission requirements?": np.array([1.0, 0.0]),
+    "When is the application deadline?": np.array([0.9, 0.1]),
+    "Thank you!": np.array([0.0, 1.0]),
+    "Hello there": np.array([0.1, 0.9]),
+    "Hmm": np.array([0.5, 0.5]),
+}
+
+
+def get_classifier(threshold=0.9):
+    X = np.stack(
+        [
+            EMBEDDINGS["What are the admission requirements?"],
+            EMBEDDINGS["When is the application deadline?"],
+            EMBEDDINGS["Thank you!"],
+            EMBEDDINGS["Hello there"],
+        ]
+    )
+    y = np.array([1, 1, 0, 0])
+    weights, bias = fit_logistic_regression(X, y, epochs=2000, l2=0)
+    classifier = QueryClassifier(weights, bias, threshold=threshold)
+    classifier.warm_up = lambda: None
+    classifier.embed = lambda text: EMBEDDINGS[text]
+    return classifier
+
+
+def test_fit_logistic_regression():
+    classifier = get_classifier()
+    X = np.stack(list(EMBEDDINGS.values()))
+    probabilities = classifier.predict_proba(X)
+    assert probabilities[0] > 0.9
+    assert probabilities[1] > 0.9
+    assert probabilities[2] < 0.1
+    assert probabilities[3] < 0.1
+    assert 0.4 < probabilities[4] < 0.6
+
+
+def test_classify():
+    classifier = get_classifier()
+    assert classifier.classify("What are the admission requirements?") is True
+    assert classifier.classify("Thank you!") is False
+    assert classifier.classify("Hmm") is None, "Should defer to the LLM"
+
+
+def test_save_and_load(tmp_path):
+    classifier = get_classifier()
+    classifier.metrics = {"test": {"agreement": 1.0}}
+    path = tmp_path / "query_classifier.json"
+    classifier.save(path)
+
+    loaded = QueryClassifier.load(path)
+    assert np.allclose(loaded.weights, classifier.weights)
+    assert loaded.bias == classifier.bias
+    assert loaded.threshold == 0.9
+    assert loaded.embedding_model == "all-MiniLM-L6-v2"
+    assert loaded.metrics == {"test": {"agreement": 1.0}}
+
+    assert QueryClassifier.load(path, threshold=0.8).threshold == 0.8
+
+
+def test_evaluate():
+    classifier = get_classifier()
+    metrics = evaluate(
+        classifier,
+        ["What are the admission requirements?", "Thank you!", "Hmm"],
+        np.array([1, 0, 0]),
+    )
+    assert metrics["n"] == 3
+    assert metrics["coverage"] == 2 / 3
+    assert metrics["confident_agreement"] == 1.0
+    assert metrics["latency_ms"]["p95"] >= metrics["latency_ms"]["p50"]
+
+
+def test_load_training_data():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add(
+            Conversation(
+                user=User(client_id=uuid.uuid4()),
+                messages=[
+                    Message(
+                        role=role,
+                        content=content,
+                        answer_strategy=strategy,
+                        answer_strategy_source=source,
+                    )
+                    for role, content, strategy, source in [
+                        ("user", "What are the fees?", "retrieve", "llm"),
+                        ("assistant", "The fees are...", None, None),
+                        ("user", "Thanks!", "generate_with_history", "llm"),
+                        ("user", "Hello", "generate_with_history", "classifier"),
+                        ("user", "What are the fees?", "retrieve", "cache"),
+                        ("user", "Hmm", "retrieve", "fallback"),
+                        ("user", "When is the deadline?", "retrieve", None),
+                    ]
+                ],
+            )
+        )
+        session.commit()
+
+        # Only the verdicts of the LLM
+        assert sorted(load_training_data(session)) == [
+            ("Thanks!", 0),
+            ("What are the fees?", 1),
+        ]
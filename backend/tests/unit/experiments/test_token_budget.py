@@ -0,0 +1,94 @@
+import pytest
+from haystack import Document
+from haystack.dataclasses import ChatMessage
+
+from marcel.experiments.token_budget import MESSAGE_OVERHEAD, TokenBudget
+
+
+@pytest.fixture(scope="module")
+def budget():
+    budget = TokenBudget(max_tokens=0, max_history_tokens=0, min_document_tokens=5)
+    budget.warm_up()
+    return budget
+
+
+def document(words, score, title="Title"):
+    return Document(
+        content=" ".join(f"word{i}" for i in range(words)),
+        score=score,
+        meta={"og:title": title},
+    )
+
+
+def template(*history):
+    return [
+        ChatMessage.from_system("system"),
+        *[ChatMessage.from_user(text) for text in history],
+        ChatMessage.from_user("template"),
+    ]
+
+
+def test_count(budget):
+    assert budget.count("") == 0
+    assert budget.count(None) == 0
+    assert budget.count("hello world") == 2
+    assert (
+        budget.count_messages([{"role": "user", "content": "hello world"}])
+        == 2 + MESSAGE_OVERHEAD
+    )
+
+
+def test_truncate(budget):
+    text = "hello world, how are you?"
+    assert budget.truncate(text, 2) == "hello world"
+    assert budget.truncate(text, 100) == text
+    assert budget.truncate(text, 0) == ""
+
+
+def test_no_budget(budget):
+    budget.max_tokens = 0
+    documents = [document(1000, 1.0)]
+    result = budget.run(documents=documents, template=template("a"), query="q")
+    assert result == {"documents": documents, "template": template("a")}
+
+
+def test_fit_documents(budget):
+    fixed = budget.count("system template q") + 2 * MESSAGE_OVERHEAD
+    header = budget.count("Title") + MESSAGE_OVERHEAD
+    small, large = document(2, 0.5), document(50, 1.0)
+    tokens = header + budget.count(large.content)
+    budget.max_tokens = fixed + tokens + header + 2
+
+    # The lowest-scored document is dropped, order is kept
+    result = budget.run(
+        documents=[small, large, document(10, 0.1)], template=template(), query="q"
+    )
+    assert result["documents"] == [small, large]
+
+    # The budget does not hold the highest-scored document: truncated to the remaining tokens
+    budget.max_tokens = fixed + header + 10
+    result = budget.run(documents=[small, large], template=template(), query="q")
+    assert [doc.id for doc in result["documents"]] == [large.id]
+    assert budget.count(result["documents"][0].content) == 10
+    assert large.content.startswith(result["documents"][0].content)
+
+    # Too little budget left to truncate
+    budget.max_tokens = fixed + header + 4
+    result = budget.run(documents=[large], template=template(), query="q")
+    assert result["documents"] == []
+
+
+def test_fit_history(budget):
+    fixed = budget.count("system template q") + 2 * MESSAGE_OVERHEAD
+    budget.max_tokens = fixed + 100
+    budget.max_history_tokens = 2 * (2 + MESSAGE_OVERHEAD)
+
+    # The most recent messages are kept
+    result = budget.run(documents=[], template=template("a b", "c d", "e f"), query="q")
+    assert result["template"] == template("c d", "e f")
+
+    # Older messages are dropped after the first message which does not fit
+    result = budget.run(
+        documents=[], template=template("a", "b c d e f g", "h"), query="q"
+    )
+    assert result["template"] == template("h")
@@ -0,0 +1,50 @@
+import json
+import uuid
+from datetime import datetime, timezone
+
+import pytest
+from fastapi.encoders import jsonable_encoder
+
+from marcel.models import SourceRead
+from marcel.routes import ChatResponseChunk, MessageRead, encode_chunk, encode_content
+
+MESSAGE = MessageRead(
+    id=1,
+    role="assistant",
+    content="Die Bewerbungsfrist ist der 15. Juli.",
+    non_answer=False,
+    feedback=None,
+    created_at=datetime(2025, 1, 2, 3, 4, 5, 678, tzinfo=timezone.utc),
+    sources=[SourceRead(url="example.com", score=1.5, title="Example", favicon="")],
+)
+
+
+@pytest.mark.parametrize(
+    "chunk",
+    [
+        ChatResponseChunk(content="Hello"),
+        ChatResponseChunk(non_answer=True),
+        ChatResponseChunk(queue_position=3),
+        ChatResponseChunk(error_status_code=503, error_content={"detail": "Retry."}),
+        ChatResponseChunk(
+            conversation_id=uuid.uuid4(),
+            user_message=MESSAGE,
+            assistant_message=MESSAGE,
+        ),
+    ],
+)
+def test_encode_chunk(chunk):
+    encoded = encode_chunk(chunk)
+    assert encoded.endswith("\n") and "\n" not in encoded[:-1]
+    assert json.loads(encoded) == jsonable_encoder(chunk, exclude_unset=True)
+
+
+@pytest.mark.parametrize(
+    "content", ["Hello", ' "quoted" ', "line\nbreak", "Prüfung ✓", "\\", ""]
+)
+def test_encode_content(content):
+    encoded = encode_content(content)
+    assert encoded.endswith("\n") and "\n" not in encoded[:-1]
+    assert json.loads(encoded) == json.loads(
+        encode_chunk(ChatResponseChunk(content=content))
+    )
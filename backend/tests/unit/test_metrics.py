@@ -0,0 +1,71 @@
+import os
+import subprocess
+import sys
+
+from prometheus_client import REGISTRY
+from prometheus_client.parser import text_string_to_metric_families
+from sqlalchemy import create_engine, text
+
+from marcel.database import TimedQueuePool
+
+WORKER = """
+import os
+from marcel import metrics
+
+metrics.observe_answer({"classifier": 0.02, "retrieval": 0.1, "total": float(os.environ["E2E"])})
+metrics.STREAMS_IN_FLIGHT.inc()
+"""
+
+RENDER = """
+import sys
+from marcel import metrics
+
+sys.stdout.write(metrics.render().decode())
+"""
+
+
+def run(code: str, multiproc_dir, **env) -> str:
+    return subprocess.run(
+        [sys.executable, "-c", code],
+        env={**os.environ, "PROMETHEUS_MULTIPROC_DIR": str(multiproc_dir), **env},
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+
+
+def test_metrics_of_several_workers(tmp_path):
+    # Each process stands in for a uvicorn worker
+    run(WORKER, tmp_path, E2E="1.5")
+    run(WORKER, tmp_path, E2E="4")
+    samples = {
+        (sample.name, tuple(sorted(sample.labels.items()))): sample.value
+        for family in text_string_to_metric_families(run(RENDER, tmp_path))
+        for sample in family.samples
+    }
+
+    assert samples[("marcel_e2e_seconds_count", ())] == 2
+    assert samples[("marcel_e2e_seconds_sum", ())] == 5.5
+    assert samples[("marcel_e2e_seconds_bucket", (("le", "2.0"),))] == 1
+    assert samples[("marcel_classifier_seconds_count", ())] == 2
+    assert samples[("marcel_retrieval_seconds_count", (("branch", "total"),))] == 2
+    # One series per worker (by pid), the rendering process reports 0
+    streams = [
+        value
+        for (name, _), value in samples.items()
+        if name == "marcel_streams_in_flight"
+    ]
+    assert sorted(streams) == [0, 1, 1]
+
+
+def test_db_pool_wait(tmp_path):
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'database.db'}", poolclass=TimedQueuePool
+    )
+    labels = {"pool": "sync"}
+    before = REGISTRY.get_sample_value("marcel_db_pool_wait_seconds_count", labels)
+    for _ in range(2):
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+    count = REGISTRY.get_sample_value("marcel_db_pool_wait_seconds_count", labels)
+    assert count == (before or 0) + 2
@@ -0,0 +1,39 @@
+from marcel.pipeline_state import PipelineState
+
+
+def test_build():
+    state = PipelineState()
+    assert state.status == "starting"
+
+    phases = []
+
+    def factory(on_progress):
+        on_progress("loading documents")
+        phases.append(state.phase)
+        return "pipeline"
+
+    state.build(factory)
+    assert phases == ["loading documents"]
+    assert state.status == "ready"
+    assert state.phase == "ready"
+    assert state.pipeline == "pipeline"
+    assert state.startup_seconds is not None
+
+
+def test_build_failed():
+    state = PipelineState()
+
+    def factory(on_progress):
+        on_progress("loading models")
+        raise FileNotFoundError("model not found")
+
+    state.build(factory)
+    assert state.status == "failed"
+    assert state.pipeline is None
+    assert state.error == "FileNotFoundError: model not found"
+
+
+def test_ready_pipeline():
+    state = PipelineState(pipeline="pipeline")
+    assert state.status == "ready"
+    assert state.startup_seconds == 0.0
@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+
+from marcel.utils.admission import AdmissionController, QueueFullError
+
+
+async def admit(controller):
+    """Wait for a slot and return the reported queue positions."""
+    return [position async for position in controller.admit()]
+
+
+@pytest.mark.asyncio
+async def test_admission():
+    controller = AdmissionController(
+        max_concurrent=1, max_queue=2, status_interval=0.01
+    )
+    assert await admit(controller) == []
+    assert controller.active == 1
+
+    first = asyncio.create_task(admit(controller))
+    second = asyncio.create_task(admit(controller))
+    await asyncio.sleep(0.05)
+    assert controller.queue_depth == 2
+
+    # The queue is full
+    with pytest.raises(QueueFullError):
+        await admit(controller)
+
+    # Slots are handed over in order, and positions are updated while waiting
+    controller.release()
+    assert await first == [1]
+    await asyncio.sleep(0.05)
+    controller.release()
+    assert await second == [2, 1]
+    controller.release()
+
+    stats = controller.stats()
+    assert stats["active"] == 0
+    assert stats["queue_depth"] == 0
+    assert stats["admitted"] == 3
+    assert stats["rejected"] == 1
+    assert stats["max_wait_seconds"] > 0
+
+
+@pytest.mark.asyncio
+async def test_admission_cancelled_while_waiting():
+    controller = AdmissionController(max_concurrent=1, max_queue=1)
+    await admit(controller)
+
+    waiting = asyncio.create_task(admit(controller))
+    await asyncio.sleep(0.01)
+    waiting.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiting
+    assert controller.queue_depth == 0
+
+    # The slot is free again once released
+    controller.release()
+    assert controller.active == 0
+
+
+@pytest.mark.asyncio
+async def test_admission_unlimited():
+    controller = AdmissionController(max_concurrent=0, max_queue=0)
+    for _ in range(10):
+        assert await admit(controller) == []
+    controller.release()
+    assert controller.stats()["admitted"] == 10
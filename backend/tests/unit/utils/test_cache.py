@@ -0,0 +1,64 @@
+from marcel.utils.cache import LRUCache
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_lru_eviction():
+    cache = LRUCache(maxsize=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1  # "b" is now least recently used
+    cache.put("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert len(cache) == 2
+
+
+def test_ttl_expiry():
+    timer = FakeTimer()
+    cache = LRUCache(maxsize=10, ttl=60, timer=timer)
+    cache.put("a", 1)
+    timer.now = 30
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+
+    timer.now = 61
+    assert cache.get("a") is None
+    assert cache.items() == [("b", 2)]
+    assert len(cache) == 1
+
+
+def test_touch_and_items_do_not_count():
+    cache = LRUCache(maxsize=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.touch("a")
+    cache.put("c", 3)
+
+    assert cache.items() == [("a", 1), ("c", 3)]
+    assert cache.hits == 0
+    assert cache.misses == 0
+
+
+def test_stats():
+    cache = LRUCache(maxsize=2)
+    assert cache.stats()["hit_rate"] is None
+
+    cache.put("a", 1)
+    cache.get("a")
+    cache.get("b")
+    assert cache.stats() == {
+        "size": 1,
+        "maxsize": 2,
+        "hits": 1,
+        "misses": 1,
+        "hit_rate": 0.5,
+    }
@@ -1,4 +1,5 @@
 from marcel.utils.route_preprocessing import (
+    compact_message,
     detect_non_answer,
     find_links,
     format_known_links,
@@ -53,3 +54,11 @@ def test_detect_non_answer():
     assert not detect_non_answer(
         "I don't have any information on that topic. However, I can tell you about a couple of options: There are emergency accommodation options where you can stay in a common room with 3 to 8 people ..."
     )
+
+
+def test_compact_message():
+    text, _ = format_known_links(
+        "See the [website][1] and [this page][2].", {1: "http://foo.com/"}
+    )
+    assert compact_message(text, max_chars=100) == "See the website and this page."
+    assert compact_message(text, max_chars=7) == "See the ..."
@@ -0,0 +1,116 @@
+import asyncio
+
+import pytest
+
+from marcel.utils.single_flight import SingleFlight, StreamAbandoned
+
+
+def flight_fn(calls, chunks, delay=0.01):
+    async def stream():
+        for chunk in chunks:
+            await asyncio.sleep(delay)
+            yield chunk
+
+    async def fn():
+        calls.append(1)
+        await asyncio.sleep(delay)
+        return "value", stream()
+
+    return fn
+
+
+async def read(single_flight, key, fn):
+    value, stream, coalesced = await single_flight.run(key, fn)
+    return value, "".join([chunk async for chunk in stream]), coalesced
+
+
+async def read_all(subscription):
+    return "".join([chunk async for chunk in subscription])
+
+
+@pytest.mark.asyncio
+async def test_single_flight():
+    single_flight = SingleFlight()
+    calls = []
+    fn = flight_fn(calls, ["a", "b", "c"])
+
+    results = await asyncio.gather(*[read(single_flight, "key", fn) for _ in range(3)])
+    assert len(calls) == 1
+    assert [coalesced for _, _, coalesced in results] == [False, True, True]
+    assert all(value == "value" and text == "abc" for value, text, _ in results)
+    assert single_flight.coalesced == 2
+    assert len(single_flight) == 0
+
+    # Finished flights are not joined, other keys do not share a flight
+    await asyncio.gather(read(single_flight, "key", fn), read(single_flight, "x", fn))
+    assert len(calls) == 3
+
+
+@pytest.mark.asyncio
+async def test_single_flight_leader_leaves():
+    single_flight = SingleFlight()
+    calls = []
+    fn = flight_fn(calls, ["a", "b"])
+
+    _, leader, _ = await single_flight.run("key", fn)
+    follower = asyncio.create_task(read(single_flight, "key", fn))
+    await asyncio.sleep(0.05)
+    # The stream starts for the follower although the leader never read it
+    await leader.aclose()
+    assert await follower == ("value", "ab", True)
+    assert len(calls) == 1
+
+    # The stream is cancelled once everybody left
+    _, leader, _ = await single_flight.run("key", fn)
+    assert await leader.__anext__() == "a"
+    await leader.aclose()
+    await asyncio.sleep(0.05)
+    assert leader.broadcast.done
+    assert isinstance(leader.broadcast.error, StreamAbandoned)
+    assert len(single_flight) == 0
+
+
+@pytest.mark.asyncio
+async def test_single_flight_error():
+    single_flight = SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("failed")
+
+    results = await asyncio.gather(
+        *[single_flight.run("key", fail) for _ in range(2)], return_exceptions=True
+    )
+    assert all(isinstance(result, ValueError) for result in results)
+    assert len(single_flight) == 0
+
+
+@pytest.mark.asyncio
+async def test_single_flight_follower_takes_over():
+    single_flight = SingleFlight()
+    calls = []
+    fn = flight_fn(calls, ["a", "b"])
+    released = []
+
+    async def take_turn(subscription, name):
+        # E.g., wait for a generation slot which is given back once the stream ended
+        if await subscription.wait_for_turn():
+            subscription.broadcast.add_done_callback(lambda: released.append(name))
+            subscription.broadcast.start()
+        return await read_all(subscription)
+
+    _, leader, _ = await single_flight.run("key", fn)
+    followers = [(await single_flight.run("key", fn))[1] for _ in range(2)]
+    reads = [
+        asyncio.create_task(take_turn(follower, name))
+        for follower, name in zip(followers, ["first", "second"])
+    ]
+    await asyncio.sleep(0.05)
+    # Nobody starts the stream while the leader waits (e.g., in the admission queue)
+    assert not leader.broadcast.started
+
+    # The leader leaves before it started the stream: the first follower takes over
+    await leader.aclose()
+    assert await asyncio.gather(*reads) == ["ab", "ab"]
+    assert released == ["first"]
+    assert len(calls) == 1
@@ -0,0 +1,84 @@
+import asyncio
+
+import anyio
+import pytest
+
+from marcel.utils.streaming import coalesce_chunks
+
+
+async def tokens(chunks, delay, error=None):
+    for chunk in chunks:
+        await asyncio.sleep(delay)
+        yield chunk
+    if error is not None:
+        raise error
+
+
+async def frames(chunks, **kwargs):
+    return [frame async for frame in coalesce_chunks(chunks, **kwargs)]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_chunks():
+    chunks = [f"t{i} " for i in range(20)]
+
+    # The first token is sent right away, later ones in frames
+    result = await frames(tokens(chunks, delay=0.01), interval=0.05, max_bytes=1024)
+    assert result[0] == "t0 "
+    assert "".join(result) == "".join(chunks)
+    assert 3 <= len(result) <= 8
+
+    # Frames are sent once they are large enough
+    result = await frames(tokens(chunks, delay=0), interval=10, max_bytes=9)
+    assert result[:3] == ["t0 ", "t1 t2 t3 ", "t4 t5 t6 "]
+    assert "".join(result) == "".join(chunks)
+
+    # Disabled
+    result = await frames(tokens(chunks, delay=0), interval=0, max_bytes=1024)
+    assert result == chunks
+
+
+@pytest.mark.asyncio
+async def test_coalesce_chunks_slow_tokens():
+    # Frames are due after the interval, also if no further token arrives
+    received = []
+    async for frame in coalesce_chunks(
+        tokens(["a", "b", "c"], delay=0.1), interval=0.01, max_bytes=1024
+    ):
+        received.append(frame)
+    assert received == ["a", "b", "c"]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_chunks_error():
+    # Buffered tokens are sent before the error
+    received = []
+    with pytest.raises(ValueError):
+        async for frame in coalesce_chunks(
+            tokens(["a", "b", "c"], delay=0, error=ValueError()),
+            interval=10,
+            max_bytes=1024,
+        ):
+            received.append(frame)
+    assert received == ["a", "bc"]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_chunks_cancelled():
+    closed = asyncio.Event()
+
+    async def endless():
+        try:
+            while True:
+                await asyncio.sleep(0.01)
+                yield "t "
+        finally:
+            # Closing the upstream stream takes a moment
+            await asyncio.sleep(0.05)
+            closed.set()
+
+    # Cancelled like a response whose client left: the stream is closed before the consumer ends
+    with anyio.move_on_after(0.1):
+        async for _ in coalesce_chunks(endless(), interval=0.02, max_bytes=1024):
+            pass
+    assert closed.is_set()
@@ -24,6 +24,8 @@ export interface MessageRead {
   feedback?: MessageFeedback
   created_at: string
   sources: Array<SourceRead>
+  // Milliseconds per stage of the answer
+  timings?: Record<string, number> | null
 }
 
 export interface ConversationRead {
@@ -67,6 +69,7 @@ export interface StatsTotal {
   total_conversations: number
   total_users: number
   total_messages: number
+  total_cancelled_answers: number
   total_average_rating: number | null
 }
 
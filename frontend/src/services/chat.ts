@@ -13,6 +13,8 @@ export interface ChatMessage {
 export interface ChatRequest {
   conversation_id?: string // uuid
   messages: Array<ChatMessage>
+  server_history?: boolean // only send the new message, the server loads the history
+  last_message_id?: number // the server waits until it is written
 }
 
 export interface SourceRead {
@@ -38,6 +40,8 @@ export interface ChatResponseChunk {
   assistant_message?: MessageRead
   content?: string
   non_answer?: boolean
+  // Sent while the request waits for a free generation slot
+  queue_position?: number
 
   // Returned by API on streaming errors
   error_status_code?: number
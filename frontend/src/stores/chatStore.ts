@@ -18,6 +18,7 @@ export interface Message {
   feedback?: MessageFeedback
   created_at?: string // iso date
   sources: Array<Source>
+  queue_position?: number // while waiting for the answer
 }
 
 export interface Conversation {